@@ -0,0 +1,37 @@
+"""
+Debug toolbar panel showing what each action of the page cost (see resolver.py).
+Add 'twistranet.actions.panels.ActionsDebugPanel' to DEBUG_TOOLBAR_PANELS to use it.
+"""
+from django.template.loader import render_to_string
+from debug_toolbar.panels import DebugPanel
+
+
+class ActionsDebugPanel(DebugPanel):
+    name = "Actions"
+    has_content = True
+
+    def __init__(self, *args, **kw):
+        super(ActionsDebugPanel, self).__init__(*args, **kw)
+        self.stats = []
+
+    def process_response(self, request, response):
+        self.stats = getattr(request, "twistranet_actions", [])
+
+    def nav_title(self):
+        return "Actions"
+
+    def nav_subtitle(self):
+        total = sum([ s["duration"] for s in self.stats ])
+        cached = [ s for s in self.stats if s["cached"] ]
+        return "%.1f ms%s" % (total * 1000, cached and " (cached)" or "", )
+
+    def title(self):
+        return "Actions resolution"
+
+    def url(self):
+        return ""
+
+    def content(self):
+        return render_to_string("actions/debug_panel.html", {
+            "stats": [ dict(s, duration = "%.2f" % (s["duration"] * 1000)) for s in self.stats ],
+        })
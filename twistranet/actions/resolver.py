@@ -0,0 +1,207 @@
+"""
+Resolution of the actions available on a view (see BaseView.get_actions).
+
+Finding out which actions are available means instanciating each action view
+and asking it (as_action()), which wakes quite a lot of permission and network checks.
+So actions are:
+- resolved lazily, ie. only when the template asks for them ;
+- memoized in the shared cache per view class, object (id, modification date and,
+  for accounts, network node version, which changes with a community's members and managers),
+  viewer (id and network node version, which changes with its memberships and pending requests),
+  site configuration version and language. Node versions are read without loading the nodes.
+Caching is opt-in: views set cache_actions = True when their actions only depend on that.
+
+The cost of each action is recorded on the request for the debug toolbar (see panels.py).
+"""
+import time
+import hashlib
+
+from django.conf import settings
+from django.utils import translation
+from django.utils.encoding import force_unicode
+from django.utils.safestring import SafeData, mark_safe
+
+from twistranet.core import caches
+from twistranet.twistapp.lib.log import log
+from models import Action
+
+
+class LazyActions(dict):
+    """
+    The { category id: [ actions ] } dict given to templates, filled on first access.
+    """
+    def __init__(self, resolve):
+        super(LazyActions, self).__init__()
+        self._resolve = resolve
+        self._resolved = False
+
+    def resolve(self):
+        if not self._resolved:
+            self._resolved = True
+            self.update(self._resolve())
+        return self
+
+    def __getitem__(self, key):     return dict.__getitem__(self.resolve(), key)
+    def __contains__(self, key):    return dict.__contains__(self.resolve(), key)
+    def __iter__(self):             return dict.__iter__(self.resolve())
+    def __len__(self):              return dict.__len__(self.resolve())
+    def __repr__(self):             return dict.__repr__(self.resolve())
+    def has_key(self, key):         return dict.has_key(self.resolve(), key)
+    def get(self, key, default = None): return dict.get(self.resolve(), key, default)
+    def keys(self):                 return dict.keys(self.resolve())
+    def values(self):               return dict.values(self.resolve())
+    def items(self):                return dict.items(self.resolve())
+
+
+class ActionResolver(object):
+    """
+    Compute (or fetch from the cache) the actions of a given view.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.request = getattr(view, "request", None)
+
+    #                                                                   #
+    #                           Cache key                               #
+    #                                                                   #
+
+    def _node_stamp(self, account_id):
+        """
+        The version of an account's relations, approved or not (see NetworkManager.version()).
+        """
+        from twistranet.twistapp.models.network import network_graph
+        return "%d:%s" % (account_id, network_graph.version(account_id), )
+        
+    def _viewer_stamp(self, auth):
+        """
+        What the actions depend on regarding the viewer.
+        """
+        if auth is None or auth.is_anonymous or not auth.id:
+            return "anonymous"
+        return self._node_stamp(auth.id)
+        
+    def _object_stamp(self, obj):
+        """
+        What the actions depend on regarding the object.
+        """
+        from twistranet.twistapp.models import Account
+        obj_id = getattr(obj, "id", None)
+        modified_at = getattr(obj, "modified_at", None)
+        stamp = "%s:%s" % (obj_id, modified_at and modified_at.isoformat(), )
+        if obj_id and isinstance(obj, Account):
+            stamp = "%s:%s" % (stamp, self._node_stamp(obj_id), )
+        return stamp
+
+    def cache_key(self):
+        """
+        Return the key of the view's actions, or None if they can't be cached.
+        """
+        if not getattr(self.view, "cache_actions", False) or self.request is None:
+            return None
+        if self.request.method != "GET":
+            return None             # Forms being posted may change what's available
+        return hashlib.sha1("|".join([
+            "%s.%s" % (self.view.__class__.__module__, self.view.__class__.__name__, ),
+            self._object_stamp(getattr(self.view, "object", None)),
+            self._viewer_stamp(getattr(self.view, "auth", None)),
+            str(caches.SiteConfigCache.get_version()),
+            str(translation.get_language()),
+        ])).hexdigest()
+
+    #                                                                   #
+    #                           Resolution                              #
+    #                                                                   #
+
+    def _freeze(self, action):
+        """
+        Make sure action can be pickled: translations must be actual strings.
+        """
+        for attr in ("label", "confirm", ):
+            v = getattr(action, attr)
+            if v is None:
+                continue
+            if isinstance(v, SafeData):
+                setattr(action, attr, mark_safe(force_unicode(v)))
+            else:
+                setattr(action, attr, force_unicode(v))
+        return action
+
+    def flat_actions(self):
+        """
+        Instanciate every available action view and ask it for its action(s).
+        """
+        flat_actions = []
+        for act in self.view.available_actions:
+            start = time.time()
+            if isinstance(act, Action):
+                flat_actions.append(act)
+                continue
+            view_instance = act(other_view = self.view)
+            as_action = view_instance.as_action()
+            if isinstance(as_action, Action):
+                flat_actions.append(as_action)
+            elif isinstance(as_action, list) or isinstance(as_action, tuple):
+                flat_actions.extend(as_action)
+            elif as_action is not None:
+                raise ValueError("Invalid action type: %s for %s" % (as_action, act))
+            self.record(act.__name__, time.time() - start, as_action is not None)
+        return [ self._freeze(action) for action in flat_actions ]
+
+    def resolve(self):
+        """
+        Return the { category id: [ actions ] } dict.
+        """
+        start = time.time()
+        key = self.cache_key()
+        cache = key and caches.ActionsCache(key)
+        flat_actions = cache and cache.actions
+        if flat_actions is not None:
+            self.record(None, time.time() - start, True, cached = True)
+        else:
+            flat_actions = self.flat_actions()
+            if cache:
+                try:
+                    cache.actions = flat_actions
+                except:
+                    log.exception("Unable to cache actions of %s" % self.view.__class__.__name__)
+
+        ret = {}
+        for action in flat_actions:
+            # Mark the confirm msg as html_safe
+            if action.confirm:
+                action.confirm = mark_safe(action.confirm)
+
+            # Append it to the proper actions category
+            if not ret.has_key(action.category.id):
+                ret[action.category.id] = [ action ]
+            else:
+                ret[action.category.id].append(action)
+
+        # Check that we've got only 1 main action at most
+        if len(ret.get("main", [])) > 1:
+            raise ValueError("More than 1 action in 'main' category: %s" % ret)
+        return ret
+
+    def lazy(self):
+        return LazyActions(self.resolve)
+
+    #                                                                   #
+    #                           Statistics                              #
+    #                                                                   #
+
+    def record(self, name, duration, available, cached = False):
+        """
+        Keep the cost of each action on the request, for the debug toolbar.
+        """
+        if self.request is None or not settings.DEBUG:
+            return
+        stats = getattr(self.request, "twistranet_actions", None)
+        if stats is None:
+            stats = self.request.twistranet_actions = []
+        stats.append({
+            "view":         self.view.__class__.__name__,
+            "action":       name,
+            "duration":     duration,
+            "available":    available,
+            "cached":       cached,
+        })
@@ -3,8 +3,10 @@ Default content types for twistranet
 """
 import mimetypes
 from django.db import models
+from django.db.models.query import QuerySet
 from twistranet.twistapp.lib import permissions   
 from twistranet.twistapp.lib.utils import formatbytes
+from twistranet.twistapp.lib.bulk import get_bulk_state
 from twistranet.twistapp.models.content import Content
 from twistranet.twistapp.models import fields
 
@@ -55,7 +57,13 @@ class Comment(StatusUpdate):
         
         # Additional notifications for comments (we don't care about checking if we're
         # in the creation mode, as comments should never be edited).
-        listener_ids = [ l.id for l in self.listeners ]
+        if get_bulk_state() is not None:
+            return
+        listeners = self.listeners
+        if isinstance(listeners, QuerySet):
+            listener_ids = set(listeners.values_list("id", flat = True))
+        else:
+            listener_ids = [ l.id for l in listeners ]
         current = self.in_reply_to
         additional_listeners = []
         while current.id != self.root_content.id:
@@ -1,6 +1,7 @@
 """
 Various caching help functions and classes.
 """
+import time
 from django.core.cache import cache
 
 DEFAULT_CACHE_DELAY = 60 * 60           # Default cache delay is 1hour. It's quite long.
@@ -29,6 +30,41 @@ class _AbstractCache(object):
         
     def _set(self, attr, value):
         cache.set("%s#%s" % (self.key_prefix, attr), value, self.delay)
+        
+    def _delete(self, attr):
+        cache.delete("%s#%s" % (self.key_prefix, attr))
+
+
+def next_version(previous = None):
+    """
+    Return a new version number, greater than previous.
+    We use a timestamp so that we never reuse a version number if its key is evicted.
+    """
+    v = int(time.time() * 1000)
+    if previous is not None and v <= previous:
+        v = previous + 1            # Bumped twice within the same millisecond
+    return v
+
+class _VersionedCache(object):
+    """
+    A global version number, stored under version_key.
+    Caches including it in their keys are dropped at once by bump_version().
+    """
+    version_key = None
+    delay = DEFAULT_CACHE_DELAY
+    
+    @classmethod
+    def get_version(cls):
+        v = cache.get(cls.version_key)
+        if v is None:
+            v = next_version()
+            cache.set(cls.version_key, v, cls.delay)
+        return v
+        
+    @classmethod
+    def bump_version(cls):
+        cache.set(cls.version_key, next_version(cache.get(cls.version_key)), cls.delay)
+
 
 class UserAccountCache(_AbstractCache):
     
@@ -51,3 +87,197 @@ class UserAccountCache(_AbstractCache):
         
 
 
+class PrincipalsCache(_AbstractCache):
+    """
+    The principal set of an account (see Account.principal_ids).
+    """
+    def __init__(self, account_id):
+        super(PrincipalsCache, self).__init__("AP%d" % account_id)
+        
+    def get_ids(self):          return self._get("ids")
+    def set_ids(self, v):       return self._set("ids", v)
+    ids = property(get_ids, set_ids)
+    
+    def invalidate(self):
+        self._delete("ids")
+
+
+class NetworkGraphCache(_AbstractCache, _VersionedCache):
+    """
+    The relations of an account, as stored by network.NetworkManager.
+    Keys include a global version number, so that bump_version() drops the whole graph at once.
+    Each node has a version as well, changed whenever it's invalidated, so that one can
+    depend on a node without loading it.
+    """
+    version_key = "NG_version"
+    
+    def __init__(self, account_id):
+        super(NetworkGraphCache, self).__init__("NG%s_%d" % (self.get_version(), account_id))
+        
+    def get_node(self):         return self._get("node")
+    def set_node(self, v):      return self._set("node", v)
+    node = property(get_node, set_node)
+    
+    def get_node_version(self):
+        v = self._get("version")
+        if v is None:
+            v = next_version()
+            self._set("version", v)
+        return "%s.%s" % (self.get_version(), v, )
+    
+    def invalidate(self):
+        self._delete("node")
+        self._set("version", next_version(self._get("version")))
+
+
+class PictureCache(_AbstractCache):
+    """
+    What's needed to display a picture (ie. a Resource) without loading it: its thumbnails URLs.
+    See lib.thumbnails.
+    """
+    def __init__(self, picture_id):
+        super(PictureCache, self).__init__("PC%d" % picture_id)
+        
+    def get_thumbnail_urls(self):       return self._get("thumbnails")
+    def set_thumbnail_urls(self, v):    return self._set("thumbnails", v)
+    thumbnail_urls = property(get_thumbnail_urls, set_thumbnail_urls)
+    
+    def invalidate(self):
+        self._delete("thumbnails")
+
+
+class DefaultPicturesCache(_VersionedCache):
+    """
+    Version number of the default pictures registry (see resource.DefaultPictureRegistry).
+    Bumping it makes every process reload its registry.
+    """
+    version_key = "DP_version"
+
+
+class SiteConfigCache(_VersionedCache):
+    """
+    Version number of the site configuration snapshot (see lib.utils.SiteConfig).
+    """
+    version_key = "SC_version"
+
+
+class AccessNetworkCache(_VersionedCache):
+    """
+    Version number of the access networks, bumped whenever they're propagated (see models.access_network)
+    or an account's listing changes.
+    """
+    version_key = "AN_version"
+
+
+class LikesCache(_AbstractCache):
+    """
+    The featured likers (a bounded list of account ids, newest first) of a Twistable.
+    See sharing.models.
+    """
+    def __init__(self, twistable_id):
+        super(LikesCache, self).__init__("LK%d" % twistable_id)
+        
+    def get_featured_ids(self):     return self._get("featured")
+    def set_featured_ids(self, v):  return self._set("featured", v)
+    featured_ids = property(get_featured_ids, set_featured_ids)
+    
+    def invalidate(self):
+        self._delete("featured")
+
+
+class LikedCache(_AbstractCache):
+    """
+    The set of Twistable ids an account likes, used to answer 'do I like it?' without SQL.
+    """
+    def __init__(self, account_id):
+        super(LikedCache, self).__init__("LD%d" % account_id)
+        
+    def get_ids(self):          return self._get("ids")
+    def set_ids(self, v):       return self._set("ids", v)
+    ids = property(get_ids, set_ids)
+    
+    def invalidate(self):
+        self._delete("ids")
+
+
+class WikiCache(_AbstractCache):
+    """
+    Rendered wiki markup, by hash of the source text (see templatetags.wiki).
+    The key changes whenever the text changes, so it never has to be invalidated.
+    """
+    delay = 24 * DEFAULT_CACHE_DELAY
+    
+    def __init__(self, text_hash):
+        super(WikiCache, self).__init__("WK%s" % text_hash)
+        
+    def get_html(self):         return self._get("html")
+    def set_html(self, v):      return self._set("html", v)
+    html = property(get_html, set_html)
+
+
+class ActionsCache(_AbstractCache):
+    """
+    Actions available on a view, by hash of what they depend on (see actions.resolver).
+    """
+    delay = 60 * 10
+    
+    def __init__(self, key):
+        super(ActionsCache, self).__init__("AC%s" % key)
+        
+    def get_actions(self):      return self._get("actions")
+    def set_actions(self, v):   return self._set("actions", v)
+    actions = property(get_actions, set_actions)
+
+
+class SummaryCache(_AbstractCache):
+    """
+    Version of the summary fragments of a content (see templatetags.fragments).
+    Bumped when the content, its comments or its likes change.
+    Accounts have one too, bumped when they're saved: summaries display their title and picture.
+    """
+    def __init__(self, twistable_id):
+        super(SummaryCache, self).__init__("SV%d" % twistable_id)
+        
+    def get_version(self):
+        v = self._get("version")
+        if v is None:
+            v = next_version()
+            self._set("version", v)
+        return v
+        
+    @classmethod
+    def get_versions(cls, twistable_ids):
+        """
+        Return the versions of the given twistables, with a single cache hit.
+        """
+        keys = dict([ ("SV%d#version" % i, i) for i in twistable_ids ])
+        found = cache.get_many(keys.keys())
+        versions = {}
+        for key, twistable_id in keys.items():
+            v = found.get(key)
+            if v is None:
+                v = cls(twistable_id).get_version()
+            versions[twistable_id] = v
+        return versions
+        
+    # Visibility information of the last comments, as a ((version, access network version), rows) tuple
+    def get_comments(self):     return self._get("comments")
+    def set_comments(self, v):  return self._set("comments", v)
+    comments = property(get_comments, set_comments)
+        
+    def bump_version(self):
+        self._set("version", next_version(self._get("version")))
+
+
+class FragmentCache(_AbstractCache):
+    """
+    A rendered template fragment, by hash of what it depends on (see templatetags.fragments).
+    """
+    delay = 60 * 10
+    
+    def __init__(self, key):
+        super(FragmentCache, self).__init__("FR%s" % key)
+        
+    def get_html(self):         return self._get("html")
+    def set_html(self, v):      return self._set("html", v)
+    html = property(get_html, set_html)
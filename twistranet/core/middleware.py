@@ -5,6 +5,7 @@ from django.conf import settings
 from django.core import signals
 from django.core.urlresolvers import get_script_prefix
 from twistranet.twistapp.lib.log import *
+from twistranet.twistapp.lib import auth_context
 
 def set_runtime_paths(sender,**kwds):
     """Dynamically adjust path settings based on runtime configuration.
@@ -52,4 +53,16 @@ class RuntimePathsMiddleware:
         signals.request_started.connect(set_runtime_paths)
 
 
+class AuthContextMiddleware:
+    """Bind the current request to the authentication context.
 
+    This is what makes Twistable.objects._getAuthenticatedAccount() aware
+    of the authenticated account without digging into the stack.
+    Must be placed AFTER django's AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        auth_context.bind_request(request)
+
+    def process_response(self, request, response):
+        auth_context.unbind_request()
+        return response
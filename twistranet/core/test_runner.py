@@ -1,4 +1,5 @@
 from django.test.simple import *
+from django.conf import settings
 
 def tn_get_tests(app_module):
     try:
@@ -127,6 +128,15 @@ def tn_build_test(app_name, app_module, label):
 
 class TwistranetTestRunner(DjangoTestSuiteRunner):
 
+    def setup_test_environment(self, **kwargs):
+        super(TwistranetTestRunner, self).setup_test_environment(**kwargs)
+        # Many tests still switch accounts with the '__account__ = xxx' idiom.
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = True
+        # Keep the search index away from the real one
+        settings.HAYSTACK_TWISTRANET_INDEX_PATH = ":memory:"
+        # Worker threads wouldn't see the test transaction: render thumbnails synchronously
+        settings.TWISTRANET_THUMBNAIL_WORKERS = 0
+
     def build_suite(self, test_labels, extra_tests=None, **kwargs):
         suite = unittest.TestSuite()
 
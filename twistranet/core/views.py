@@ -25,6 +25,7 @@ from twistranet.core import caches
 from twistranet.content_types.forms import CommentForm
 
 from twistranet.actions import *
+from twistranet.actions.resolver import ActionResolver
 
 class MustRedirect(Exception):
     """
@@ -84,8 +85,7 @@ class AsView(AsPublicView):
     Same as AsPublicView but for a (possibly) restricted view.
     """
     def has_access(self, request):
-        from twistranet.twistapp.models import GlobalCommunity, AnonymousAccount
-        return GlobalCommunity.objects.get_query_set(request = request).exists()
+        return utils.can_access_site(request)
             
 class BaseView(object):
     """
@@ -94,7 +94,6 @@ class BaseView(object):
     Just overload the view() method in your classes.
     
     Default behaviour is to block access to non-authorized ppl (ppl who can't access GlobalCommunity).
-    XXX I SHOULD OPTIMIZE THIS, BTW (avoiding an unnecessary query?)
     """
     # Overload those properties in your base classes
     context_boxes = []
@@ -109,16 +108,20 @@ class BaseView(object):
     body_class = ''
     comment_form = None
     available_actions = []      # List of either Action objects or BaseView classes (that will be instanciated and called with view.as_action() method)
+    cache_actions = False       # Set to True if your actions only depend on the object (and its relations), the viewer's relations and the site config
     name = None                 # The name that this will be mapped to in url.py. But you can of course override this in url.py.
     # category = GLOBAL_ACTIONS   # Override this if you want to give another default category to this view.
 
     page = 1
     nextpage = 2
+    before = None       # Keyset pagination: only list objects with an id lower than this one
+    nextbefore = None
     # The view attribute which will be passed to the templates
     template_variables = [
         ("title", "get_title"),
         "page",
         "nextpage",
+        "nextbefore",
         "path",
         "context_boxes",
         "global_boxes",
@@ -153,6 +156,10 @@ class BaseView(object):
             self.current_url = self.get_current_url()
             self.page = int(request.GET.get('page',1))
             self.nextpage = self.page + 1
+            try:
+                self.before = int(request.GET['before'])
+            except (KeyError, ValueError):
+                self.before = None
             if not self.auth.is_anonymous:
                 self.useraccount_cache = caches.UserAccountCache(self.auth)
                 self.useraccount_cache.online = True            # Set as online
@@ -188,8 +195,8 @@ class BaseView(object):
         It's most convenient to save it here, while we have the 'request' object...
         XXX TODO: Move this out from the view, but in the core product.
         """
-        # If we've got it in the cache, just return it.
-        cached_domain = cache.get("twistranet_site_domain")
+        # If we already know it, just return it.
+        cached_domain = utils.get_site_domain()
         if cached_domain:
             return cached_domain
         
@@ -211,7 +218,7 @@ class BaseView(object):
         cached_domain = "%s://%s" % (protocol, current_site.domain, )
         while cached_domain.endswith('/'):
             cached_domain = cached_domain[:-1]
-        cache.set("twistranet_site_domain", cached_domain, 60 * 60 * 24)  # 1 day is enough here
+        utils.set_site_domain(cached_domain)
         return cached_domain
                             
     #                                                                                               #
@@ -221,41 +228,9 @@ class BaseView(object):
     def get_actions(self,):
         """
         Transform the available_actions list into an actions{} dict.
+        Actions are only resolved when they're used, and cached (see actions.resolver).
         """
-        ret = {}
-        flat_actions = []
-
-        # Flatten the actions list
-        for act in self.available_actions:
-            if isinstance(act, Action):
-                flat_actions.append(act)
-            elif issubclass(act, BaseView):
-                view_instance = act(other_view = self)
-                as_action = view_instance.as_action()
-                if isinstance(as_action, Action):
-                    flat_actions.append(as_action)
-                elif isinstance(as_action, list) or isinstance(as_action, tuple):
-                    flat_actions.extend(as_action)
-                elif as_action is None:
-                    continue
-                else:
-                    raise ValueError("Invalid action type: %s for %s" % (as_action, act))
-            
-        for action in flat_actions:
-            # Mark the confirm msg as html_safe
-            if action.confirm:
-                action.confirm = mark_safe(action.confirm)
-            
-            # Append it to the proper actions category
-            if not ret.has_key(action.category.id):
-                ret[action.category.id] = [ action ]
-            else:
-                ret[action.category.id].append(action)
-
-        # Check that we've got only 1 main action at most
-        if len(ret.get("main", [])) > 1:
-            raise ValueError("More than 1 action in 'main' category: %s" % ret)
-        return ret
+        return ActionResolver(self).lazy()
             
     def as_action(self):
         """
@@ -635,18 +610,55 @@ class BaseWallView(BaseIndividualView):
         must be overloaded
         """
         pass
+
+    def batch_before(self, objects_list):
+        """
+        Keyset batch: return the objects older than self.before (or the most recent ones).
+        We fetch one more object than needed to know if there's a next page, so we never count().
+        Set self.nextbefore accordingly.
+        """
+        page_size = settings.TWISTRANET_CONTENT_PER_PAGE
+        if self.before is not None:
+            objects_list = objects_list.filter(id__lt = self.before)
+        latest_list = list(objects_list.order_by("-id")[:page_size + 1])
+        self.nextpage = 0
+        self.nextbefore = None
+        if len(latest_list) > page_size:
+            latest_list = latest_list[:page_size]
+            self.nextbefore = latest_list[-1].id
+        return latest_list
+
+    def batch_offset(self, objects_list):
+        """
+        Former ?page=xxx batch, kept as a fallback for existing links.
+        Same as batch_before(), but with (slower) offsets.
+        """
+        nb_from, nb_to = self.batch_list(None)
+        latest_list = list(objects_list.order_by("-id")[nb_from:nb_to + 1])
+        if len(latest_list) <= nb_to - nb_from:
+            self.nextpage = 0
+        return latest_list[:nb_to - nb_from]
     
+    def enrich_content_list(self, latest_list):
+        """
+        Fetch what the summary views of the batch display (comments, likes, display owners)
+        with a few grouped queries, instead of letting each summary issue its own.
+        """
+        from twistranet.sharing.models import Like
+        if latest_list:
+            Content.objects.prefetch_summaries(latest_list)
+            Like.objects.prefetch_likes(latest_list)
+        return latest_list
+
     def prepare_view(self, value = None):
         """
         Fetch the individual object, plus its latest content.
         """
         super(BaseWallView, self).prepare_view(value)
         # if self.object:
-        self.objects_list = total_list = self.get_objects_list()
-        self.latest_content_list = self.get_recent_content_list()
+        self.objects_list = self.get_objects_list()
+        self.latest_content_list = self.enrich_content_list(self.get_recent_content_list())
         self.content_forms = self.get_inline_forms(self.object)
-        if len(total_list)< settings.TWISTRANET_CONTENT_PER_PAGE:
-            self.nextpage= 0
 
     def render_last_post(self, params):
         "could be improved in each subclass for better performance"
@@ -3,7 +3,7 @@ from twistranet.twistapp.models import *
 from twistranet.content_types.models import *
 from twistranet.twistapp.lib.python_fixture import Fixture
 
-__account__ = SystemAccount.get()
+# This module is imported by bootstrap(), while acting as SystemAccount.
 
 FIXTURES = [
     Fixture(
@@ -6,28 +6,106 @@ We use classes instead of functions to allow inheritance between handlers.
 
 Don't forget to connect to your signals with 'weak = False' !!
 """
+from __future__ import with_statement
 import logging
 import traceback
 import re
+import itertools
 from os import path
 from email.MIMEImage import MIMEImage
 from django.conf import settings
 from django.template import Context
+from django.utils import html, translation
 from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.core.cache import cache
 from django.template.loader import get_template
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.db.models import Model, Q
 from django.db.models.query import QuerySet
 
 from twistranet.twistapp.lib.log import log
 from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib.auth_context import acting_as
 
 DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS = True
 
 SUBJECT_REGEX = re.compile(r"^[\s]*Subject:[ \t]?([^\n$]*)\n", re.IGNORECASE | re.DOTALL)
 EMPTY_LINE_REGEX = re.compile(r"\n\n+", re.DOTALL)
 
+# Rendered in place of the recipient, so that templates are rendered only once per language.
+RECIPIENT_MARKER = "__twistranet_recipient__"
+
+# Number of recipients fetched at once when resolving large recipient lists
+RECIPIENTS_CHUNK_SIZE = 500
+
+# Normalized email, recipients are sorted (and deduplicated) on it
+EMAIL_KEY_SQL = "LOWER(TRIM(auth_user.email))"
+
+def iter_recipients(accounts, author_id = None, chunk_size = RECIPIENTS_CHUNK_SIZE):
+    """
+    Stream (account_id, email, language) tuples for the user accounts of the 'accounts' queryset,
+    except the author's.
+    
+    We never instanciate Account objects: each chunk is a single values_list() query joined
+    on auth_user (and on the preferred language, if any), sorted and paginated on the
+    lower-cased email. So accounts sharing an address come in a row and only the first one
+    (and its preferred language) is yielded: memory stays flat whatever the size of the community.
+    """
+    from twistranet.twistapp.models import UserAccount
+    qs = UserAccount.objects.__booster__.filter(
+        id__in = accounts.values("id"),
+    ).exclude(user__email = "")
+    if author_id:
+        qs = qs.exclude(id = author_id)
+    qs = qs.extra(
+        select = { "email_key": EMAIL_KEY_SQL },
+    ).order_by("email_key", "id", "account_languages__order").values_list(
+        "email_key", "id", "user__email", "account_languages__language",
+    )
+    last_key = None
+    while True:
+        chunk = qs
+        if last_key is not None:
+            chunk = chunk.extra(where = [ "%s > %%s" % EMAIL_KEY_SQL ], params = [ last_key ])
+        rows = list(chunk[:chunk_size])
+        for email_key, account_id, email, language in rows:
+            if email_key == last_key:
+                continue                # Another account with that address, or a less preferred language
+            last_key = email_key
+            yield account_id, email, language or None
+        if len(rows) < chunk_size:
+            break
+
+class Reference(object):
+    """
+    A picklable stand-in for a database object or queryset given to a queued MailHandler.
+    The mail worker resolves it back when it processes the job.
+    """
+    def __init__(self, value):
+        from twistranet.twistapp.models import Twistable
+        self.pk = self.query = None
+        if isinstance(value, QuerySet):
+            self.model = value.model
+            self.query = value.query            # Pickling the query doesn't evaluate it
+        elif isinstance(value, Twistable):
+            self.model = Twistable
+            self.pk = value.id
+        else:
+            self.model = value.__class__
+            self.pk = value.pk
+            
+    def resolve(self):
+        from twistranet.twistapp.models import Twistable
+        if self.query is not None:
+            qs = self.model._default_manager.all()
+            qs.query = self.query
+            return qs
+        if self.model is Twistable:
+            return Twistable.objects.get(id = self.pk).object
+        return self.model._default_manager.get(pk = self.pk)
+
+
 class NotifierHandler(object):
     def __call__(self, sender, **kwargs):
         """
@@ -83,20 +161,20 @@ class NotificationHandler(NotifierHandler):
             if isinstance(value, Twistable):
                 message_dict[param] = value.id
 
-        # We force __account__ to fake user login.
+        # We act as SystemAccount to fake user login.
         system = SystemAccount.get()
-        __account__ = system
-        owner = kwargs.get(self.owner_arg, system)
-        publisher = kwargs.get(self.publisher_arg, owner.publisher)
-        n = Notification(
-            publisher = publisher,
-            owner = owner,
-            title = "",
-            description = self.message,
-            parameters = message_dict,
-            permissions = self.permissions,
-        )
-        n.save()
+        with acting_as(system):
+            owner = kwargs.get(self.owner_arg, system)
+            publisher = kwargs.get(self.publisher_arg, owner.publisher)
+            n = Notification(
+                publisher = publisher,
+                owner = owner,
+                title = "",
+                description = self.message,
+                parameters = message_dict,
+                permissions = self.permissions,
+            )
+            n.save()
 
 class MailHandler(NotifierHandler):
     """
@@ -118,6 +196,11 @@ class MailHandler(NotifierHandler):
     
     One last thing: a signal can overload the templates. Just pass 'text_template' and/or 'html_template' in
     the signal kw arguments to have the templates overloaded for that particular signal instance.
+    
+    If TWISTRANET_MAIL_QUEUE is set, the notification is only enqueued as one job (see notifier.models.MailJob):
+    the twistranet_send_mail management command expands the recipients, renders and sends the messages.
+    
+    The author of the notification (the account sending the signal) never gets it.
     """
     def __init__(self, recipient_arg, text_template, subject = None, html_template = None, managers_only = False):
         self.recipient_arg = recipient_arg
@@ -128,142 +211,229 @@ class MailHandler(NotifierHandler):
         
     def __call__(self, sender, **kwargs):
         """
-        Generate the message itself.
-        XXX TODO: Handle translation correctly (not from the request only)
+        Fake-Login with SystemAccount so that everybody can be notified,
+        even users this current user can't list.
         """
-        # Fake-Login with SystemAccount so that everybody can be notified,
-        # even users this current user can't list.
-        from twistranet.twistapp.models import SystemAccount, Account, UserAccount, Community, Twistable
-        __account__ = SystemAccount.get()
-        from_email = settings.SERVER_EMAIL
+        from twistranet.twistapp.models import SystemAccount, Twistable
+        author = Twistable.objects._getAuthenticatedAccount()
+        author_id = author and not author.is_anonymous and author.id or None
+        with acting_as(SystemAccount.get()):
+            return self.send(sender, author_id = author_id, **kwargs)
+
+    def send(self, sender, author_id = None, **kwargs):
+        """
+        Enqueue the notification, or deliver it at once if there's no mail queue.
+        """
+        from twistranet.notifier.models import MailJob
         host = settings.EMAIL_HOST
-        cache_mimeimages = {}
         if not host:
             # If host is disabled (EMAIL_HOST is None), skip that
             return
+        if getattr(settings, "TWISTRANET_MAIL_QUEUE", False):
+            log.debug("Queuing mail job: '%s' from '%s'" % (self.__class__.__name__, sender, ))
+            MailJob.objects.enqueue(self, "%s" % (sender, ), self.freeze(kwargs), author_id)
+            return
+        self.deliver(sender, kwargs, self.send_now, author_id)
+        
+    def freeze(self, value):
+        """
+        Return a picklable version of value: database objects and querysets become References.
+        """
+        if isinstance(value, dict):
+            return dict([ (k, self.freeze(v)) for k, v in value.items() ])
+        if isinstance(value, (list, tuple, )):
+            return [ self.freeze(v) for v in value ]
+        if isinstance(value, (Model, QuerySet, )):
+            return Reference(value)
+        return value
+        
+    def thaw(self, value):
+        """
+        Reverse of freeze().
+        """
+        if isinstance(value, dict):
+            return dict([ (k, self.thaw(v)) for k, v in value.items() ])
+        if isinstance(value, list):
+            return [ self.thaw(v) for v in value ]
+        if isinstance(value, Reference):
+            return value.resolve()
+        return value
         
-        # Handle recipients emails
+    def send_now(self, msg):
+        """
+        Send a message safely, within the request.
+        """
+        try:
+            log.debug("Sending mail: '%s' from '%s' to '%s'" % (msg.subject, msg.from_email, msg.to))
+            msg.send()
+        except:
+            log.warning("Unable to send message to %s" % msg.to)
+            log.exception("Here's what we've got as an error.")
+
+    def deliver(self, sender, kwargs, send, author_id = None):
+        """
+        Generate the messages and give them to the send(msg) callable.
+        Templates are rendered once per language, and only the recipient is substituted
+        in each message (see render()).
+        """
+        from twistranet.twistapp.models import Account, UserAccount, Community, Twistable
+        from_email = settings.SERVER_EMAIL
+        
+        # Handle recipients emails, as (email, language) pairs.
+        # A None language means the current one.
+        # Accounts, account querysets and communities are gathered in a single query
+        # which is streamed and deduplicated, see iter_recipients().
         recipients = kwargs.get(self.recipient_arg, None)
-        if not recipients:
-            raise ValueError("Recipient must be provided as a '%s' parameter" % self.recipient_arg)
         to_list = []
-        if not isinstance(recipients, (list, tuple, QuerySet, )):
-            recipients = (recipients, )
-        for recipient in recipients:
-            if isinstance(recipient, Twistable):
-                recipient = recipient.object
-            if isinstance(recipient, UserAccount):
-                to = recipient.email
-                if not to:
-                    log.warning("Can't send email for '%s': %s doesn't have an email registered." % (sender, recipient, ))
-                    return
-                to_list.append(to)
-            elif isinstance(recipient, Community):
-                if self.managers_only:
-                    members = recipient.managers
+        accounts = None
+        if isinstance(recipients, QuerySet):
+            accounts = Q(id__in = recipients.values("id"))
+        else:
+            if not recipients:
+                raise ValueError("Recipient must be provided as a '%s' parameter" % self.recipient_arg)
+            if not isinstance(recipients, (list, tuple, )):
+                recipients = (recipients, )
+            account_ids = []
+            for recipient in recipients:
+                if isinstance(recipient, Twistable):
+                    recipient = recipient.object
+                if isinstance(recipient, UserAccount):
+                    if not recipient.email:
+                        log.warning("Can't send email for '%s': %s doesn't have an email registered." % (sender, recipient, ))
+                        return
+                    account_ids.append(recipient.id)
+                elif isinstance(recipient, Community):
+                    if self.managers_only:
+                        members = recipient.managers
+                    else:
+                        members = recipient.members
+                    q = Q(id__in = members.values("id"))
+                    accounts = accounts is None and q or accounts | q
+                elif type(recipient) in (str, unicode, ):
+                    to_list.append((recipient, None))        # XXX Todo: check the '@'
                 else:
-                    members = recipient.members
-                # XXX Suboptimal for very large communities
-                to_list.extend([ member.email for member in members if member.email ])
-            elif type(recipient) in (str, unicode, ):
-                to_list.append(recipient)        # XXX Todo: check the '@'
-            else:
-                raise ValueError("Invalid recipient: %s (%s)" % (recipient, type(recipient), ))
+                    raise ValueError("Invalid recipient: %s (%s)" % (recipient, type(recipient), ))
+            if account_ids:
+                q = Q(id__in = account_ids)
+                accounts = accounts is None and q or accounts | q
+        to_lists = [ to_list, ]
+        if accounts is not None:
+            to_lists.append(
+                (email, language) for account_id, email, language in iter_recipients(Account.objects.filter(accounts), author_id)
+            )
                 
         # Fetch templates
         text_template = kwargs.get('text_template', self.text_template)
         html_template = kwargs.get('html_template', self.html_template)
-                
-        # Now generate template and send mail for each recipient
-        # XXX TODO: See http://docs.djangoproject.com/en/1.2/topics/email/#sending-multiple-e-mails
-        # for the good approach to use.
-        for to in to_list:
-            # Append domain (and site info) to kwargs
-            d = kwargs.copy()
-            domain = cache.get("twistranet_site_domain")
-            d.update({
-                "domain":       domain,
-                "site_name":    utils.get_site_name(),
-                "baseline":     utils.get_baseline(),
-                "recipient":    to,     # A string
-            })
         
+        # Append domain (and site info) to kwargs
+        d = kwargs.copy()
+        d.update({
+            "domain":       utils.get_site_domain(),
+            "site_name":    utils.get_site_name(),
+            "baseline":     utils.get_baseline(),
+            "recipient":    RECIPIENT_MARKER,
+        })
+
+        # Now build and send mail for each recipient
+        rendered = {}
+        image_cache = {}
+        for to, language in itertools.chain(*to_lists):
+            if not rendered.has_key(language):
+                rendered[language] = self.render(text_template, html_template, d, language, image_cache)
+            subject, text_content, html_content, mimeimages = rendered[language]
+        
+            # Prepare messages
+            msg = EmailMultiAlternatives(
+                subject.replace(RECIPIENT_MARKER, to),
+                text_content.replace(RECIPIENT_MARKER, to),
+                from_email,
+                [ to ],
+            )
+            if html_content:
+                msg.attach_alternative(html_content.replace(RECIPIENT_MARKER, html.escape(to)), "text/html")
+                if mimeimages:
+                    msg.mixed_subtype = 'related'
+                    for msgImage in mimeimages:
+                        msg.attach(msgImage)
+            send(msg)
+
+    def render(self, text_template, html_template, context, language = None, image_cache = None):
+        """
+        Render the recipient-independent part of the message in the given language.
+        Return a (subject, text_content, html_content, mimeimages) tuple, where mimeimages
+        is the list of MIMEImage parts to attach to the message.
+        The recipient is rendered as RECIPIENT_MARKER, replace it to get the actual message.
+        """
+        if image_cache is None:
+            image_cache = {}
+        if language:
+            previous_language = translation.get_language()
+            translation.activate(language)
+        try:
             # Load both templates and render them with kwargs context
             text_tpl = get_template(text_template)
-            c = Context(d)
+            c = Context(context)
             text_content = text_tpl.render(c).strip()
             if html_template:
                 html_tpl = get_template(html_template)
                 html_content = html_tpl.render(c)
             else:
                 html_content = None
+        finally:
+            if language:
+                translation.activate(previous_language)
             
-            # Fetch back subject from text template
-            subject = self.subject
-            if not subject:
-                match = SUBJECT_REGEX.search(text_content)
-                if match:
-                    subject = match.groups()[0]
-            if not subject:
-                raise ValueError("No subject provided nor 'Subject:' first line in your text template")
-            
-            # Remove empty lines and "Subject:" line from text templates
-            text_content = SUBJECT_REGEX.sub('', text_content)
-            text_content = EMPTY_LINE_REGEX.sub('\n', text_content)
+        # Fetch back subject from text template
+        subject = self.subject
+        if not subject:
+            match = SUBJECT_REGEX.search(text_content)
+            if match:
+                subject = match.groups()[0]
+        if not subject:
+            raise ValueError("No subject provided nor 'Subject:' first line in your text template")
         
-            # Prepare messages
-            msg = EmailMultiAlternatives(subject, text_content, from_email, [ to ], )
-            if html_content:
-                if getattr(settings, 'SEND_EMAIL_IMAGES_AS_ATTACHMENTS', DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS):
-                    # we replace img links by img Mime Images
-                    mimeimages = []
-                    def replace_img_url(match):
-                        """Change src url by mimeurl
-                           fill the mimeimages list
-                        """
-                        urlpath = str(match.group('urlpath'))
-                        attribute = str(match.group('attribute'))
-
-                        is_static = False
-                        pathSplit = urlpath.split('/')
-                        if 'static' in pathSplit:
-                            filename = urlpath.split('/static/')[-1]
-                            is_static = True
-                        else:
-                            # XXX TODO : need to be improved split with site path (for vhosts)
-                            filename = urlpath.split('/')[-1]
-                        nb = len(mimeimages)+1
-                        mimeimages.append((filename, 'img%i'%nb, is_static))
-                        mimeurl = "cid:img%i" %nb
-                        return '%s="%s"' % (attribute,mimeurl)
+        # Remove empty lines and "Subject:" line from text templates
+        text_content = SUBJECT_REGEX.sub('', text_content)
+        text_content = EMPTY_LINE_REGEX.sub('\n', text_content)
+        
+        # we replace img links by img Mime Images
+        mimeimages = []
+        if html_content and getattr(settings, 'SEND_EMAIL_IMAGES_AS_ATTACHMENTS', DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS):
+            images = []
+            def replace_img_url(match):
+                """Change src url by mimeurl
+                   fill the images list
+                """
+                urlpath = str(match.group('urlpath'))
+                attribute = str(match.group('attribute'))
 
-                    img_url_expr = re.compile('(?P<attribute>src)\s*=\s*([\'\"])(%s)?(?P<urlpath>[^\"\']*)\\2' %domain, re.IGNORECASE)
-                    html_content = img_url_expr.sub(replace_img_url, html_content)
-                    msg.attach_alternative(html_content, "text/html")
-                    if mimeimages:
-                        msg.mixed_subtype = 'related'
-                        for fkey, name, is_static in mimeimages:
-                            if cache_mimeimages.has_key(fkey):
-                                msgImage = cache_mimeimages[fkey]
-                            else:
-                                if is_static:
-                                    f = open(path.join(settings.TWISTRANET_STATIC_PATH, fkey), 'rb')
-                                else:
-                                    f = open(path.join(settings.MEDIA_ROOT, fkey), 'rb')
-                                cache_mimeimages[fkey] = msgImage = MIMEImage(f.read())
-                                f.close()
-                            msgImage.add_header('Content-ID', '<%s>' % name)
-                            msgImage.add_header('Content-Disposition', 'inline')
-                            msg.attach(msgImage)
-                # just inline images
+                is_static = False
+                pathSplit = urlpath.split('/')
+                if 'static' in pathSplit:
+                    filename = urlpath.split('/static/')[-1]
+                    is_static = True
                 else:
-                    msg.attach_alternative(html_content, "text/html")
-            # Send safely
-            try:
-                log.debug("Sending mail: '%s' from '%s' to '%s'" % (subject, from_email, to))
-                msg.send()
-            except:
-                log.warning("Unable to send message to %s" % to)
-                log.exception("Here's what we've got as an error.")
-
+                    # XXX TODO : need to be improved split with site path (for vhosts)
+                    filename = urlpath.split('/')[-1]
+                nb = len(images)+1
+                images.append((filename, 'img%i'%nb, is_static))
+                mimeurl = "cid:img%i" %nb
+                return '%s="%s"' % (attribute,mimeurl)
 
+            img_url_expr = re.compile('(?P<attribute>src)\s*=\s*([\'\"])(%s)?(?P<urlpath>[^\"\']*)\\2' % context['domain'], re.IGNORECASE)
+            html_content = img_url_expr.sub(replace_img_url, html_content)
+            for fkey, name, is_static in images:
+                if image_cache.has_key((fkey, name)):
+                    msgImage = image_cache[(fkey, name)]
+                else:
+                    if is_static:
+                        f = open(path.join(settings.TWISTRANET_STATIC_PATH, fkey), 'rb')
+                    else:
+                        f = open(path.join(settings.MEDIA_ROOT, fkey), 'rb')
+                    image_cache[(fkey, name)] = msgImage = MIMEImage(f.read())
+                    f.close()
+                    msgImage.add_header('Content-ID', '<%s>' % name)
+                    msgImage.add_header('Content-Disposition', 'inline')
+                mimeimages.append(msgImage)
+        return subject, text_content, html_content, mimeimages
@@ -1,9 +1,13 @@
 """
-This is the content used as a notification.
+This is the content used as a notification,
+plus the outgoing mail queues used by MailHandler.
 """
 import pickle
+import base64
+import datetime
 
 from django.db import models
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from twistranet.twistapp.models import Twistable, Content
@@ -70,3 +74,163 @@ class Notification(Content):
     
     class Meta:
         app_label = 'twistapp'
+
+
+class _QueueManager(models.Manager):
+    """
+    Common methods of the mail queues.
+    """
+    def due(self, limit):
+        """
+        Return the (at most) 'limit' items to be processed now, oldest first.
+        """
+        return self.filter(next_attempt_at__lte = datetime.datetime.now()).order_by("id")[:limit]
+        
+    def claim(self, limit, lease = None):
+        """
+        Lease at most 'limit' due items to the calling worker and return them.
+        Each item is claimed with an UPDATE ... WHERE next_attempt_at = <what we've read>:
+        if another worker read it at the same time, only one of them gets a row count of 1.
+        Items which are neither done nor failed within the lease (eg. the worker died)
+        become due again.
+        """
+        if lease is None:
+            lease = getattr(settings, "TWISTRANET_MAIL_LEASE", 300)
+        until = datetime.datetime.now() + datetime.timedelta(seconds = lease)
+        claimed = []
+        for item in self.due(limit):
+            if self.filter(id = item.id, next_attempt_at = item.next_attempt_at).update(next_attempt_at = until) == 1:
+                item.next_attempt_at = until
+                claimed.append(item)
+        return claimed
+        
+    def stats(self):
+        """
+        Return queue depth metrics as a dict:
+        pending (waiting for their first or next attempt), failed (given up), oldest (creation date of the oldest pending item)
+        """
+        pending = self.filter(next_attempt_at__isnull = False)
+        oldest = pending.order_by("id").values_list("created_at", flat = True)[:1]
+        return {
+            "pending":  pending.count(),
+            "failed":   self.filter(next_attempt_at__isnull = True).count(),
+            "oldest":   oldest and oldest[0] or None,
+        }
+
+
+class _QueuedItem(models.Model):
+    """
+    Something the twistranet_send_mail worker has to process.
+    Done items are deleted. After TWISTRANET_MAIL_MAX_ATTEMPTS failures,
+    next_attempt_at is set to None and the item is kept for inspection.
+    """
+    created_at = models.DateTimeField(auto_now_add = True)
+    next_attempt_at = models.DateTimeField(null = True, db_index = True)
+    attempts = models.IntegerField(default = 0)
+    last_error = models.TextField(blank = True)
+    
+    def failed(self, error):
+        """
+        Record a failed attempt and schedule the next one with an exponential backoff.
+        """
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= getattr(settings, "TWISTRANET_MAIL_MAX_ATTEMPTS", 5):
+            self.next_attempt_at = None
+        else:
+            delay = getattr(settings, "TWISTRANET_MAIL_RETRY_DELAY", 60) * 2 ** (self.attempts - 1)
+            self.next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds = delay)
+        self.save()
+        
+    class Meta:
+        abstract = True
+
+
+class MailJobManager(_QueueManager):
+    """
+    One job per notification: MailHandler enqueues the event, the twistranet_send_mail
+    management command expands its recipients, renders and sends the messages.
+    """
+    def enqueue(self, handler, sender, kwargs, author_id = None):
+        """
+        Store a MailHandler call for later processing.
+        kwargs must have been made picklable by handler (see MailHandler.freeze()).
+        """
+        j = MailJob(
+            handler = ("%s.%s" % (handler.__class__.__module__, handler.__class__.__name__, ))[:256],
+            subject = (handler.subject or kwargs.get("text_template") or handler.text_template or "")[:256],
+            next_attempt_at = datetime.datetime.now(),
+        )
+        j.job = (handler, sender, kwargs, author_id, )
+        j.save()
+        return j
+
+
+class MailJob(_QueuedItem):
+    """
+    A pickled (handler, sender, kwargs, author_id) notification waiting to be mailed.
+    Database objects in kwargs are stored as references (see notifier.handlers.Reference).
+    """
+    handler = models.CharField(max_length = 256)
+    subject = models.CharField(max_length = 256)
+    _encoded_job = models.TextField()
+    
+    objects = MailJobManager()
+    
+    def get_job(self,):
+        return pickle.loads(base64.b64decode(self._encoded_job))
+        
+    def set_job(self, job):
+        self._encoded_job = base64.b64encode(pickle.dumps(job, pickle.HIGHEST_PROTOCOL))
+        
+    job = property(get_job, set_job)
+    
+    def __unicode__(self):
+        return u"%s: %s" % (self.handler, self.subject, )
+        
+    class Meta:
+        app_label = 'twistapp'
+
+
+class OutgoingMailManager(_QueueManager):
+    """
+    Messages which couldn't be sent at once by the twistranet_send_mail management
+    command, kept here to be retried.
+    """
+    def enqueue(self, msg):
+        """
+        Store an EmailMessage for later sending.
+        """
+        m = OutgoingMail(
+            recipient = u", ".join(msg.to)[:256],
+            subject = msg.subject[:256],
+            next_attempt_at = datetime.datetime.now(),
+        )
+        m.message = msg
+        m.save()
+        return m
+
+
+class OutgoingMail(_QueuedItem):
+    """
+    A pickled EmailMessage waiting to be sent.
+    """
+    recipient = models.CharField(max_length = 256)
+    subject = models.CharField(max_length = 256)
+    _encoded_message = models.TextField()
+    
+    objects = OutgoingMailManager()
+    
+    def get_message(self,):
+        return pickle.loads(base64.b64decode(self._encoded_message))
+        
+    def set_message(self, msg):
+        self._encoded_message = base64.b64encode(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        
+    message = property(get_message, set_message)
+    
+    def __unicode__(self):
+        return u"%s: %s" % (self.recipient, self.subject, )
+        
+    class Meta:
+        app_label = 'twistapp'
@@ -15,14 +15,35 @@ if os.environ.has_key("TWISTRANET_DEBUG"):
     DEBUG_TOOLBAR_CONFIG = {
         'INTERCEPT_REDIRECTS':      False,
     }
+    DEBUG_TOOLBAR_PANELS = (
+        'debug_toolbar.panels.version.VersionDebugPanel',
+        'debug_toolbar.panels.timer.TimerDebugPanel',
+        'debug_toolbar.panels.settings_vars.SettingsVarsDebugPanel',
+        'debug_toolbar.panels.headers.HeaderDebugPanel',
+        'debug_toolbar.panels.request_vars.RequestVarsDebugPanel',
+        'debug_toolbar.panels.template.TemplateDebugPanel',
+        'debug_toolbar.panels.sql.SQLDebugPanel',
+        'debug_toolbar.panels.signals.SignalDebugPanel',
+        'debug_toolbar.panels.logger.LoggingPanel',
+        'twistranet.actions.panels.ActionsDebugPanel',
+    )
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 else:
     DEBUG = False
 
+# Outgoing mail queue. When True, notification emails are only queued by the web process
+# and sent by the twistranet_send_mail management command (run it from cron).
+TWISTRANET_MAIL_QUEUE = True
+TWISTRANET_MAIL_BATCH_SIZE = 100        # Messages sent over a single SMTP connection
+TWISTRANET_MAIL_MAX_ATTEMPTS = 5
+TWISTRANET_MAIL_RETRY_DELAY = 60        # In seconds, doubled after each failed attempt
+TWISTRANET_MAIL_LEASE = 300             # In seconds, time a worker has to process what it has claimed
+
 # Use TWISTRANET_NOMAIL environ variable to completely disable email sending.
 # This is useful when boostraping TN
 if os.environ.has_key("TWISTRANET_NOMAIL"):
     EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+    TWISTRANET_MAIL_QUEUE = False
 
 # Defined database engines.
 # You can always overload yours in your local_settings.py file.
@@ -65,6 +86,7 @@ USE_L10N = True
 # Example: "/home/media/media.lawrence.com/"
 MEDIA_ROOT = os.path.join(HERE, 'www', )
 TWISTRANET_MEDIA_ROOT = os.path.join(HERE, 'var', 'upload')
+TWISTRANET_CONTENT_ADDRESSED_STORAGE = True     # Store identical files once (needs hard links). See twistranet_dedupe_storage.
 
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash if there is a path component (optional in other cases).
@@ -102,7 +124,9 @@ _MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'twistranet.core.middleware.AuthContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'twistranet.twistapp.lib.thumbnails.ThumbnailsMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'twistranet.core.middleware.RuntimePathsMiddleware',
     DEBUG and 'debug_toolbar.middleware.DebugToolbarMiddleware' or None,
@@ -132,6 +156,10 @@ TWISTRANET_STATIC_PATH = os.path.join(HERE, 'www', 'static')
 TINYMCE_JS_URL = "/static/js/tiny_mce/tiny_mce.js"
 TINYMCE_JS_ROOT = "%s/static/tiny_mce" % HERE
 
+# Authentication context. Set this to True to fall back on (slow) stack inspection
+# when no account is bound by AuthContextMiddleware or acting_as().
+TWISTRANET_AUTH_STACK_FALLBACK = False
+
 # Cache tuning
 CACHE_BACKEND = "locmem:///"
 TWISTRANET_CACHE_USER = 60*5            # User-centric data stored for xx second
@@ -146,6 +174,11 @@ TWISTRANET_CACHE_USER = 60*5            # User-centric data stored for xx second
 TWISTRANET_NETWORK_IN_BOXES = 6
 TWISTRANET_FRIENDS_IN_BOXES = 9
 TWISTRANET_CONTENT_PER_PAGE = 25
+TWISTRANET_TIMELINE_BACKFILL = 100      # Content copied to your timeline when you start following someone
+TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT = 1000     # Larger loosened listings are propagated by twistranet_propagate_access
+TWISTRANET_THUMBNAIL_WORKERS = 0        # Threads pre-generating thumbnails of uploaded resources (0 = synchronously)
+TWISTRANET_SENDFILE = None              # Let the web server send files: "x-sendfile" (Apache, lighttpd) or "x-accel-redirect" (nginx)
+TWISTRANET_SENDFILE_PREFIX = "/protected"       # With nginx, 'internal' location prepended to the absolute file path
 TWISTRANET_COMMUNITIES_PER_PAGE = 25
 TWISTRANET_DISPLAYED_COMMUNITY_MEMBERS = 9
 
@@ -185,10 +218,12 @@ QUICKUPLOAD_AUTO_UPLOAD = True
 QUICKUPLOAD_FILL_TITLES = False 
 QUICKUPLOAD_SIZE_LIMIT = 0  
 QUICKUPLOAD_SIM_UPLOAD_LIMIT = 1
+TWISTRANET_UPLOAD_TEMP_DIR = os.path.join(HERE, 'var', 'uploads')      # Where XHR uploads are received
 
 # Search engine (Haystack) configuration
 HAYSTACK_SITECONF = 'twistranet.search.search_sites'
-HAYSTACK_SEARCH_ENGINE = "twistranet.search.haystack_simplehack"
+HAYSTACK_SEARCH_ENGINE = "twistranet.search.haystack_index"
+HAYSTACK_TWISTRANET_INDEX_PATH = os.path.join(HERE, 'var', 'search_index.sqlite')
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 20
 
 # Model Translation registry module name
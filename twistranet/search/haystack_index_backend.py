@@ -0,0 +1,351 @@
+"""
+A local, file-based inverted index backend for Haystack.
+
+Documents are tokenized in Python and stored as postings (term, document, term frequency)
+in a SQLite file (HAYSTACK_TWISTRANET_INDEX_PATH). We only use plain SQLite tables,
+so this doesn't depend on the FTS extensions being compiled in.
+
+Queries are AND queries: every term must match, as a prefix, one of the document's terms.
+Results are ranked with BM25, then filtered through the secured managers so that
+you only get (and count) what you're allowed to see.
+"""
+import os
+import re
+import math
+import threading
+import unicodedata
+import sqlite3
+
+from django.conf import settings
+from django.db.models.loading import get_model
+from django.utils.encoding import force_unicode
+from haystack.backends import BaseSearchBackend, BaseSearchQuery, SearchNode, log_query
+from haystack.models import SearchResult
+
+from twistranet.twistapp.lib.log import log
+
+
+BACKEND_NAME = 'twistranet_index'
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Number of ids checked at once against the secured managers
+SECURITY_CHUNK_SIZE = 500
+
+WORD_REGEX = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    """
+    Return the (lowercased, accent-free) words of text.
+    """
+    text = unicodedata.normalize("NFKD", force_unicode(text).lower())
+    text = u"".join([ c for c in text if not unicodedata.combining(c) ])
+    return WORD_REGEX.findall(text)
+
+
+class InvertedIndex(object):
+    """
+    The index storage. One SQLite connection per thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            if self.path != ":memory:":
+                dirname = os.path.dirname(self.path)
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+            conn = self._local.connection = sqlite3.connect(self.path)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    django_ct TEXT NOT NULL,
+                    django_id TEXT NOT NULL,
+                    length INTEGER NOT NULL,
+                    UNIQUE (django_ct, django_id)
+                );
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    doc_id INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, doc_id)
+                );
+                CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id);
+            """)
+        return conn
+
+    def _delete(self, cursor, django_ct, django_id):
+        cursor.execute("SELECT doc_id FROM documents WHERE django_ct = ? AND django_id = ?", (django_ct, django_id, ))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("DELETE FROM postings WHERE doc_id = ?", row)
+            cursor.execute("DELETE FROM documents WHERE doc_id = ?", row)
+
+    def index(self, documents):
+        """
+        (Re)index the given (django_ct, django_id, text) documents.
+        """
+        conn = self.connection
+        cursor = conn.cursor()
+        try:
+            for django_ct, django_id, text in documents:
+                self._delete(cursor, django_ct, django_id)
+                tf = {}
+                words = tokenize(text)
+                for word in words:
+                    tf[word] = tf.get(word, 0) + 1
+                cursor.execute(
+                    "INSERT INTO documents (django_ct, django_id, length) VALUES (?, ?, ?)",
+                    (django_ct, django_id, len(words), ),
+                )
+                doc_id = cursor.lastrowid
+                cursor.executemany(
+                    "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [ (term, doc_id, n) for term, n in tf.items() ],
+                )
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    def remove(self, django_ct, django_id):
+        conn = self.connection
+        self._delete(conn.cursor(), django_ct, django_id)
+        conn.commit()
+
+    def clear(self, django_cts = None):
+        conn = self.connection
+        if django_cts:
+            for django_ct in django_cts:
+                conn.execute("DELETE FROM postings WHERE doc_id IN (SELECT doc_id FROM documents WHERE django_ct = ?)", (django_ct, ))
+                conn.execute("DELETE FROM documents WHERE django_ct = ?", (django_ct, ))
+        else:
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM documents")
+        conn.commit()
+
+    def search(self, terms, django_cts = None):
+        """
+        Return [ (score, doc_id, django_ct, django_id), ...] for documents matching ALL terms,
+        best first. If terms is empty, return every document (newest first).
+        """
+        conn = self.connection
+        if django_cts is not None and not django_cts:
+            return []
+        if not terms:
+            rows = conn.execute("SELECT 0, doc_id, django_ct, django_id FROM documents ORDER BY doc_id DESC").fetchall()
+            return [ r for r in rows if django_cts is None or r[2] in django_cts ]
+
+        n_docs, avg_length = conn.execute("SELECT COUNT(*), AVG(length) FROM documents").fetchone()
+        if not n_docs:
+            return []
+        avg_length = avg_length or 1.0
+
+        # Fetch postings of each term (as a prefix), intersecting as we go
+        matches = []
+        candidates = None
+        for term in terms:
+            tfs = {}
+            matching = set()
+            for doc_id, tf in conn.execute(
+                "SELECT doc_id, tf FROM postings WHERE term >= ? AND term < ?",
+                (term, term + u"\uffff", ),
+            ):
+                matching.add(doc_id)
+                if candidates is None or doc_id in candidates:
+                    tfs[doc_id] = tfs.get(doc_id, 0) + tf
+            candidates = set(tfs.keys())
+            matches.append((tfs, len(matching)))
+            if not candidates:
+                return []
+
+        # Rank what's left with BM25
+        results = []
+        ids = list(candidates)
+        for i in range(0, len(ids), SECURITY_CHUNK_SIZE):
+            chunk = ids[i:i + SECURITY_CHUNK_SIZE]
+            for doc_id, django_ct, django_id, length in conn.execute(
+                "SELECT doc_id, django_ct, django_id, length FROM documents WHERE doc_id IN (%s)" % ",".join(["?"] * len(chunk)),
+                chunk,
+            ):
+                if django_cts is not None and not django_ct in django_cts:
+                    continue
+                score = 0.0
+                for tfs, df in matches:
+                    idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                    tf = tfs[doc_id]
+                    score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                results.append((score, doc_id, django_ct, django_id))
+        results.sort(key = lambda r: (-r[0], -r[1]))
+        return results
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index():
+    """
+    Return the InvertedIndex configured in settings (one per path).
+    """
+    path = getattr(settings, "HAYSTACK_TWISTRANET_INDEX_PATH", None)
+    if not path:
+        path = os.path.join(settings.HERE, "var", "search_index.sqlite")
+    _indexes_lock.acquire()
+    try:
+        if not _indexes.has_key(path):
+            _indexes[path] = InvertedIndex(path)
+        return _indexes[path]
+    finally:
+        _indexes_lock.release()
+
+
+def get_django_ct(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.module_name)
+
+
+class SearchBackend(BaseSearchBackend):
+    def update(self, indexer, iterable, commit=True):
+        django_ct = get_django_ct(indexer.model)
+        content_field = indexer.get_content_field()
+        documents = []
+        for obj in iterable:
+            try:
+                text = indexer.prepare(obj).get(content_field) or u""
+            except:
+                log.exception("Unable to index %s %s" % (django_ct, obj.pk))
+                continue
+            documents.append((django_ct, force_unicode(obj.pk), text))
+        get_index().index(documents)
+
+    def remove(self, obj, commit=True):
+        """
+        Remove an object from every index it may be registered in.
+        obj can be an instance or an 'app_label.module_name.pk' string.
+        """
+        if isinstance(obj, basestring):
+            app_label, module_name, pk = obj.split(".")
+            get_index().remove("%s.%s" % (app_label, module_name), pk)
+            return
+        for model in self.site.get_indexed_models():
+            if isinstance(obj, model):
+                get_index().remove(get_django_ct(model), force_unicode(obj.pk))
+
+    def clear(self, models=[], commit=True):
+        if models:
+            get_index().clear([ get_django_ct(model) for model in models ])
+        else:
+            get_index().clear()
+
+    def _visible(self, django_ct, ids):
+        """
+        Return the subset of ids the current user can list, through the model's secured manager.
+        """
+        model = get_model(*django_ct.split("."))
+        visible = set()
+        for i in range(0, len(ids), SECURITY_CHUNK_SIZE):
+            visible.update([
+                force_unicode(pk) for pk in
+                model.objects.filter(pk__in = ids[i:i + SECURITY_CHUNK_SIZE]).values_list("pk", flat = True)
+            ])
+        return visible
+
+    @log_query
+    def search(self, query_string, sort_by=None, start_offset=0, end_offset=None,
+               fields='', highlight=False, facets=None, date_facets=None, query_facets=None,
+               narrow_queries=None, spelling_query=None,
+               limit_to_registered_models=None, result_class=None, models=None, **kwargs):
+        if not query_string:
+            return {
+                'results': [],
+                'hits': 0,
+            }
+        if result_class is None:
+            result_class = SearchResult
+
+        # Restrict to the asked (or else registered) models
+        if models:
+            django_cts = set([ get_django_ct(model) for model in models ])
+        else:
+            django_cts = set([ get_django_ct(model) for model in self.site.get_indexed_models() ])
+
+        if query_string == '*':
+            terms = []
+        else:
+            terms = tokenize(query_string)
+            if not terms:
+                return {
+                    'results': [],
+                    'hits': 0,
+                }
+        matches = get_index().search(terms, django_cts)
+
+        # Security check
+        ids_by_ct = {}
+        for score, doc_id, django_ct, django_id in matches:
+            ids_by_ct.setdefault(django_ct, []).append(django_id)
+        visible = {}
+        for django_ct, ids in ids_by_ct.items():
+            visible[django_ct] = self._visible(django_ct, ids)
+        matches = [ m for m in matches if m[3] in visible[m[2]] ]
+
+        # Slice and build results
+        results = []
+        for score, doc_id, django_ct, django_id in matches[start_offset:end_offset]:
+            app_label, module_name = django_ct.split(".")
+            results.append(result_class(app_label, module_name, django_id, score))
+        return {
+            'results': results,
+            'hits': len(matches),
+        }
+
+    def prep_value(self, db_field, value):
+        return value
+
+    def more_like_this(self, model_instance, additional_query_string=None,
+                       start_offset=0, end_offset=None,
+                       limit_to_registered_models=None, **kwargs):
+        return {
+            'results': [],
+            'hits': 0
+        }
+
+
+class SearchQuery(BaseSearchQuery):
+    def __init__(self, site=None, backend=None):
+        super(SearchQuery, self).__init__(backend=backend)
+
+        if backend is not None:
+            self.backend = backend
+        else:
+            self.backend = SearchBackend(site=site)
+
+    def build_params(self, *args, **kwargs):
+        """
+        Pass models restrictions (SearchQuerySet.models()) to the backend.
+        """
+        params = super(SearchQuery, self).build_params(*args, **kwargs)
+        if self.models:
+            params['models'] = self.models
+        return params
+
+    def build_query(self):
+        if not self.query_filter:
+            return '*'
+
+        return self._build_sub_query(self.query_filter)
+
+    def _build_sub_query(self, search_node):
+        term_list = []
+
+        for child in search_node.children:
+            if isinstance(child, SearchNode):
+                term_list.append(self._build_sub_query(child))
+            else:
+                term_list.append(force_unicode(child[1]))
+
+        return (' ').join(term_list)
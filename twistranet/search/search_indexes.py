@@ -1,24 +1,80 @@
 import datetime
+from django.db.models.signals import post_delete
 from haystack.indexes import *
 from haystack import site
 from twistranet.twistapp.models import *
+from twistranet.twistapp.signals import twistable_post_save, twistables_bulk_created
+from twistranet.twistapp.lib.log import log
 from twistranet.content_types.models import *
 
 
-class StatusUpdateIndex(SearchIndex):
+class TwistableIndex(SearchIndex):
+    """
+    Keep the index up to date as Twistables are saved / deleted.
+    We listen to twistable_post_save (and not post_save), after TN's DB work is done.
+    Only objects of the indexed model itself are handled (a Comment is not a StatusUpdate
+    to the index), unless index_subclasses is set (eg. UserAccount for Account).
+    """
+    index_subclasses = False
+    
+    def handles(self, instance):
+        if self.index_subclasses:
+            return isinstance(instance, self.model)
+        return isinstance(instance, Twistable) and instance.model_name == self.model.__name__
+
+    def _setup_save(self, model):
+        twistable_post_save.connect(self.twistable_saved)
+        twistables_bulk_created.connect(self.twistables_created)
+
+    def _setup_delete(self, model):
+        post_delete.connect(self.twistable_deleted)
+
+    def _teardown_save(self, model):
+        twistable_post_save.disconnect(self.twistable_saved)
+        twistables_bulk_created.disconnect(self.twistables_created)
+
+    def _teardown_delete(self, model):
+        post_delete.disconnect(self.twistable_deleted)
+
+    def twistable_saved(self, sender, instance, **kw):
+        if self.handles(instance):
+            try:
+                self.update_object(instance)
+            except:
+                log.exception("Unable to index %s" % instance)
+
+    def twistables_created(self, sender, instances, **kw):
+        instances = [ instance for instance in instances if self.handles(instance) ]
+        if instances:
+            try:
+                self.backend.update(self, instances)
+            except:
+                log.exception("Unable to index %d bulk-created objects" % len(instances))
+
+    def twistable_deleted(self, sender, instance, **kw):
+        if self.handles(instance):
+            try:
+                self.remove_object(instance)
+            except:
+                log.exception("Unable to unindex %s" % instance)
+
+
+class StatusUpdateIndex(TwistableIndex):
     searchable_text = CharField(document = True, use_template = True)
-    author = CharField(model_attr = 'author')
+    author = CharField(model_attr = 'owner')
     created_at = DateTimeField(model_attr = 'created_at')
 
 site.register(StatusUpdate, StatusUpdateIndex)
 
-class AccountIndex(SearchIndex):
-    searchable_text = CharField(document = True, use_template = True)
+class AccountIndex(TwistableIndex):
+    # Explicit template name, as we index every kind of account
+    index_subclasses = True
+    searchable_text = CharField(document = True, use_template = True, template_name = "search/indexes/twistapp/account_searchable_text.txt")
 
 site.register(Account, AccountIndex)
 
 
-class DocumentIndex(SearchIndex):
+class DocumentIndex(TwistableIndex):
     searchable_text = CharField(document = True, use_template = True)
 
 site.register(Document, DocumentIndex)
@@ -9,8 +9,14 @@ Share(publisher = None) => Share what you just saw ON YOUR OWN WALL.
     If publisher is set, then you can share what you saw on a specific community or 
     on another user's wall (to give a precise insight)
 """
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count
+from django.db.models.signals import post_save, post_delete
 from twistranet.twistapp import Twistable
+from twistranet.core import caches
+
+# Number of likers we display (and cache) for each object
+MAX_FEATURED_LIKERS = 10
 
 class LikeManager(models.Manager):
     """
@@ -22,28 +28,118 @@ class LikeManager(models.Manager):
             "i_like":   boolean
         }
     This is used to display "x and x other ppl like this.
+    
+    n_likes is read from LikeCounter, featured likers (the MAX_FEATURED_LIKERS latest ones)
+    and the ids liked by the current user are cached (see caches.LikesCache and caches.LikedCache).
+    All of them are maintained when a Like is saved or deleted (see signal handlers below).
     """
-    def likes(self, content):
+    def liked_ids(self, account_id):
         """
-        Return a dict of like info (see class docstring) for the given content.
+        Return the (cached) set of Twistable ids liked by the given account.
+        """
+        if account_id is None:
+            return frozenset()
+        c = caches.LikedCache(account_id)
+        ids = c.ids
+        if ids is None:
+            ids = c.ids = frozenset(Like.objects.filter(who__id = account_id).values_list("what", flat = True))
+        return ids
+        
+    def i_like(self, content):
+        auth = Twistable.objects._getAuthenticatedAccount()
+        return auth is not None and content.id in self.liked_ids(auth.id)
+
+    def _likes_for(self, contents):
+        """
+        Return {content_id: like info} for the given contents, with a few queries
+        whatever the number of contents.
         """
         from twistranet.twistapp import UserAccount
+        ids = [ c.id for c in contents if c.id ]
+        if not ids:
+            return {}
         
-        n_likes = Like.objects.filter(what = content).count()
-        if n_likes:
-            auth = Twistable.objects._getAuthenticatedAccount()
-            featured = UserAccount.objects.filter(_liked__what = content).distinct()
-            i_like = Like.objects.filter(what = content, who__id = auth.id).exists()
-        else:
-            featured = []
-            i_like = False
-            
-        # Return the like structure
-        return {
-            "n_likes":  n_likes,
-            "featured": featured,
-            "i_like":   i_like,
-        }
+        # Like counters. Objects liked before counters existed get counted the slow way.
+        counts = dict(LikeCounter.objects.filter(what__id__in = ids).values_list("what", "n_likes"))
+        missing = [ i for i in ids if not counts.has_key(i) ]
+        if missing:
+            for row in Like.objects.filter(what__id__in = missing).values("what").annotate(n_likes = Count("id")):
+                counts[row["what"]] = row["n_likes"]
+        
+        # Featured likers, from the cache if possible
+        featured_ids = {}
+        missing = []
+        for i in ids:
+            if counts.get(i):
+                featured_ids[i] = caches.LikesCache(i).featured_ids
+                if featured_ids[i] is None:
+                    missing.append(i)
+        if missing:
+            for i in missing:
+                featured_ids[i] = []
+            for what_id, who_id in Like.objects.filter(what__id__in = missing).order_by("-id").values_list("what", "who"):
+                if len(featured_ids[what_id]) < MAX_FEATURED_LIKERS:
+                    featured_ids[what_id].append(who_id)
+            for i in missing:
+                caches.LikesCache(i).featured_ids = featured_ids[i]
+        
+        # Fetch likers at once, through the secured manager
+        accounts = {}
+        who_ids = set()
+        for v in featured_ids.values():
+            who_ids.update(v)
+        if who_ids:
+            for account in UserAccount.objects.filter(id__in = who_ids):
+                accounts[account.id] = account
+        
+        # Build the like structures
+        auth = Twistable.objects._getAuthenticatedAccount()
+        liked = self.liked_ids(auth and auth.id)
+        ret = {}
+        for i in ids:
+            ret[i] = {
+                "n_likes":  counts.get(i, 0),
+                "featured": [ accounts[a] for a in featured_ids.get(i, []) if accounts.has_key(a) ],
+                "i_like":   i in liked,
+            }
+        return ret
+        
+    def likes(self, content):
+        """
+        Return a dict of like info (see class docstring) for the given content.
+        """
+        return self._likes_for([content]).get(content.id, {
+            "n_likes":  0,
+            "featured": [],
+            "i_like":   False,
+        })
+
+    def prefetch_likes(self, contents):
+        """
+        Same as likes(), for a whole list of content at once.
+        The result is stored on each object, where the likes() method will find it.
+        """
+        likes = self._likes_for(contents)
+        for content in contents:
+            if likes.has_key(content.id):
+                content._c_likes = likes[content.id]
+                
+    def add_likes(self, what_id, delta):
+        """
+        Atomically add delta to the like counter of what_id.
+        """
+        updated = LikeCounter.objects.filter(what__id = what_id).update(n_likes = F("n_likes") + delta)
+        if not updated and delta > 0:
+            # First like since counters exist: start from the actual number of likes.
+            # If a concurrent first like created the counter meanwhile, just add ours to it.
+            sid = transaction.savepoint()
+            try:
+                LikeCounter.objects.create(what_id = what_id, n_likes = Like.objects.filter(what__id = what_id).count())
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                LikeCounter.objects.filter(what__id = what_id).update(n_likes = F("n_likes") + delta)
+            else:
+                transaction.savepoint_commit(sid)
 
 class Like(models.Model):
     """
@@ -58,6 +154,17 @@ class Like(models.Model):
         app_label = 'twistapp'
 
 
+class LikeCounter(models.Model):
+    """
+    Denormalized number of likes of a Twistable, so that we never count() Like rows to display it.
+    """
+    what = models.OneToOneField("Twistable", primary_key = True, related_name = "_like_counter", )
+    n_likes = models.IntegerField(default = 0, )
+    
+    class Meta:
+        app_label = 'twistapp'
+
+
 def like(self):
     """
     Imply you like something
@@ -65,14 +172,22 @@ def like(self):
     auth = Twistable.objects._getAuthenticatedAccount()
     
     # We don't allow multiple likes for the same person (of course).
-    Like.objects.get_or_create(who = auth, what = self)
+    obj, created = Like.objects.get_or_create(who = auth, what = self)
+    _c = getattr(self, '_c_likes', None)
+    if created and _c is not None:
+        _c["n_likes"] += 1
+        _c["i_like"] = True
+        if len(_c["featured"]) < MAX_FEATURED_LIKERS:
+            _c["featured"] = [ auth ] + _c["featured"]
     
 def likes(self):
     """
     Return likes for current object.
-    WARNING: TIME-CONSUMING! WE SHOULD HEAVILY CACHE THIS!
-    XXX TODO: HEAVILY CACHE THIS!
+    Use Like.objects.prefetch_likes() when displaying a list of content.
     """
+    _c = getattr(self, '_c_likes', None)
+    if _c is not None:
+        return _c
     return Like.objects.likes(self)
     
 def unlike(self):
@@ -80,15 +195,43 @@ def unlike(self):
     Now you don't like anymore
     """
     auth = Twistable.objects._getAuthenticatedAccount()
-    Like.objects.filter(
+    liked = Like.objects.filter(
         who = auth,
         what = self
-    ).delete()
+    )
+    if liked.exists():
+        liked.delete()
+        _c = getattr(self, '_c_likes', None)
+        if _c is not None:
+            _c["n_likes"] -= 1
+            _c["i_like"] = False
+            _c["featured"] = [ a for a in _c["featured"] if a.id != auth.id ]
 
 def share(self, publisher = None):
     """
     """
 
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def like_saved(sender, instance, created, **kw):
+    if created:
+        Like.objects.add_likes(instance.what_id, 1)
+        caches.LikesCache(instance.what_id).invalidate()
+        caches.LikedCache(instance.who_id).invalidate()
+        caches.SummaryCache(instance.what_id).bump_version()
+
+def like_deleted(sender, instance, **kw):
+    Like.objects.add_likes(instance.what_id, -1)
+    caches.LikesCache(instance.what_id).invalidate()
+    caches.LikedCache(instance.who_id).invalidate()
+    caches.SummaryCache(instance.what_id).bump_version()
+
+post_save.connect(like_saved, sender = Like)
+post_delete.connect(like_deleted, sender = Like)
+
 # Monkey-patch the Twistable object
 Twistable.like = like
 Twistable.unlike = unlike
@@ -21,6 +21,7 @@ except:
     import simplejson as json
 
 from twistranet.twistapp.models import Content, Account
+from twistranet.sharing.models import Like
 from twistranet.twistapp.forms import form_registry
 from twistranet.twistapp.lib.log import *
 from twistranet.core.views import *
@@ -41,9 +42,8 @@ class LikeToggleView(BaseObjectActionView):
         """
         """
         super(LikeToggleView, self).prepare_view(*args, **kw)
-        likes = self.content.likes()
-        n_likes = likes['n_likes']
-        if not likes['i_like']:
+        # Counters are updated as we like / unlike, no need to compute the whole like info here.
+        if not Like.objects.i_like(self.content):
             self.content.like()
         else:
             self.content.unlike()
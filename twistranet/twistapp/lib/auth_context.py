@@ -0,0 +1,155 @@
+"""
+Explicit authentication context.
+
+Twistranet used to find the authenticated account by digging the Python stack
+for a 'request' or an '__account__' local variable. That's slow (it's done for
+each and every permission check), so the current account is now bound explicitly:
+
+- AuthContextMiddleware binds the request being processed to the current thread ;
+- acting_as() temporarily overrides it, for example to act as SystemAccount:
+
+    with acting_as(SystemAccount.get()):
+        glob = GlobalCommunity.get()
+
+While a request is bound, request_cache() gives access to dicts living as long
+as the request, typically to memoize permission checks.
+
+Stack inspection is still available as an opt-in fallback (set
+TWISTRANET_AUTH_STACK_FALLBACK = True in your settings). Each time it fires,
+a counter is incremented so that you can track down the remaining callers.
+"""
+import threading
+
+from twistranet.twistapp.lib.log import log
+
+_local = threading.local()
+_counter_lock = threading.Lock()
+_stack_walks = 0
+_memo_stats = {}
+
+
+class acting_as(object):
+    """
+    Context manager used to act as the given account within a block.
+    Can be nested: leaving the block restores the previous account.
+    """
+    def __init__(self, account):
+        self.account = account
+
+    def __enter__(self):
+        _get_stack().append(self.account)
+        return self.account
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _get_stack().pop()
+        return False
+
+
+def _get_stack():
+    """
+    Return the acting_as() accounts stack for the current thread.
+    """
+    stack = getattr(_local, "accounts", None)
+    if stack is None:
+        stack = _local.accounts = []
+    return stack
+
+def get_acting_account():
+    """
+    Return the innermost acting_as() account or None.
+    """
+    stack = _get_stack()
+    if stack:
+        return stack[-1]
+    return None
+
+def bind_request(request):
+    """
+    Bind the request being processed to the current thread.
+    """
+    _local.request = request
+    _local.caches = {}
+
+def unbind_request():
+    """
+    Forget about the current request (and about any acting_as() leftover).
+    """
+    _local.request = None
+    _local.accounts = []
+    _local.caches = {}
+
+def get_bound_request():
+    return getattr(_local, "request", None)
+
+def request_cache(name):
+    """
+    Return the 'name' dict bound to the current request, or None if there's no bound request.
+    Outside of requests (management commands, tests), nothing is memoized.
+    """
+    if get_bound_request() is None:
+        return None
+    caches = getattr(_local, "caches", None)
+    if caches is None:
+        caches = _local.caches = {}
+    return caches.setdefault(name, {})
+
+def clear_request_cache(name):
+    """
+    Empty the 'name' request cache, if any. Call this when a cached decision may have changed.
+    """
+    caches = getattr(_local, "caches", None)
+    if caches and name in caches:
+        caches[name].clear()
+
+def count_memo(name, hit):
+    """
+    Record a hit (or a miss) on the 'name' request cache.
+    """
+    _counter_lock.acquire()
+    try:
+        stats = _memo_stats.setdefault(name, [0, 0])
+        stats[hit and 0 or 1] += 1
+    finally:
+        _counter_lock.release()
+
+def get_memo_stats(name):
+    """
+    Return (hits, misses) for the 'name' request cache.
+    """
+    return tuple(_memo_stats.get(name, (0, 0)))
+
+def reset_memo_stats():
+    _counter_lock.acquire()
+    try:
+        _memo_stats.clear()
+    finally:
+        _counter_lock.release()
+
+
+#                                                                   #
+#                       Stack-walking fallback                      #
+#                                                                   #
+
+def count_stack_walk():
+    """
+    Called each time the authenticated account had to be found by digging the stack.
+    """
+    global _stack_walks
+    _counter_lock.acquire()
+    try:
+        _stack_walks += 1
+        n = _stack_walks
+    finally:
+        _counter_lock.release()
+    log.debug("Authenticated account found by digging the stack (%d times so far)" % n)
+
+def get_stack_walk_count():
+    return _stack_walks
+
+def reset_stack_walk_count():
+    global _stack_walks
+    _counter_lock.acquire()
+    try:
+        _stack_walks = 0
+    finally:
+        _counter_lock.release()
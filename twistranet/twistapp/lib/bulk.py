@@ -0,0 +1,40 @@
+"""
+Bulk loading mode, used by python_fixture.BulkLoader.
+
+Within a bulk_loading() block, Twistable.save() trusts its data (no full_clean()),
+doesn't send post-save signals nor notifications, and memoizes the permissions it reads
+to compute access networks. What was skipped is recorded in the BulkState, so that
+it can be reconciled once at the end of the load.
+"""
+import threading
+
+_local = threading.local()
+
+class BulkState(object):
+    def __init__(self):
+        self.access_info = {}       # twistable id => (_p_can_list, _p_can_view, publisher_id)
+        self.propagations = {}      # twistable id => access network to give to its dependant objects
+        self.created = []           # Twistables created within the block
+        self.created_ids = set()
+        self.updated = {}           # twistable id => last saved version of the (pre-existing) Twistables updated within the block
+        self.accounts = {}          # slug => Account, for Fixture.logged_account
+
+class bulk_loading(object):
+    """
+    Usage:
+        with bulk_loading() as state:
+            ...create objects...
+        ...reconcile state...
+    """
+    def __enter__(self):
+        _local.state = BulkState()
+        return _local.state
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.state = None
+
+def get_bulk_state():
+    """
+    Return the current BulkState, or None if we're not bulk loading.
+    """
+    return getattr(_local, "state", None)
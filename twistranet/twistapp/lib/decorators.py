@@ -11,12 +11,8 @@ def require_access(function=None, ):
         We simply check if GlobalCommunity is visible.
         If not, then that means we certainly need a login here.
         """
-        from twistranet.twistapp.models import GlobalCommunity, AnonymousAccount
-        return GlobalCommunity.objects.exists()
-        # mgr = GlobalCommunity.objects
-        # return not isinstance(mgr._getAuthenticatedAccount(), AnonymousAccount)
-        # # XXX TODO
-        # return mgr.__booster__.filter(mgr.get_public_filter() | mgr.get_network_filter()).exists()
+        from twistranet.twistapp.lib.utils import can_access_site
+        return can_access_site()
         
     actual_decorator = user_passes_test(check_access)
     if function:
@@ -1,6 +1,13 @@
+from __future__ import with_statement
+import time
+from django.db import transaction
 from django.db.models.query import QuerySet
 from twistranet.twistapp.models import Twistable
 from  twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib.auth_context import acting_as
+from twistranet.twistapp.lib.bulk import bulk_loading, get_bulk_state
+from twistranet.twistapp.lib.slugify import bulk_slugs
+from twistranet.twistapp.signals import twistables_bulk_created, twistable_post_save
 
 class Fixture(object):
     """
@@ -19,10 +26,11 @@ class Fixture(object):
     def apply(self,):
         """
         Create / update model. Use the 'slug' attribute to define unicity of the content.
+        If slug is None, one is generated when saving. Apply many of those within
+        a lib.slugify.bulk_slugs() block to allocate them efficiently.
         """
         from twistranet.twistapp.models import Account
         slug = self.dict.get('slug', None)
-        obj = None
         log.debug("Trying to import %s" % slug)
         
         # Check if slug is given. Mandatory.
@@ -31,8 +39,22 @@ class Fixture(object):
         
         # Set auth if necessary
         if self.logged_account:
-            __account__ = Account.objects.get(slug = self.logged_account)
+            bulk = get_bulk_state()
+            if bulk is None:
+                account = Account.objects.get(slug = self.logged_account)
+            else:
+                if not bulk.accounts.has_key(self.logged_account):
+                    bulk.accounts[self.logged_account] = Account.objects.get(slug = self.logged_account)
+                account = bulk.accounts[self.logged_account]
+            with acting_as(account):
+                return self._apply(slug)
+        return self._apply(slug)
         
+    def _apply(self, slug):
+        """
+        Actually create / update model, as the currently authenticated account.
+        """
+        obj = None
         # Create/get object
         if slug:
             obj_q = Twistable.objects.__booster__.filter(slug = slug)
@@ -57,3 +79,79 @@ class Fixture(object):
             raise
         
         return obj
+
+
+class BulkLoader(object):
+    """
+    Apply a (large) list of fixtures quickly, eg. to build load-test datasets:
+    - fixtures are applied in batches, one transaction per batch (in order, as a fixture
+      may refer to objects created by the previous ones) ;
+    - slugs are allocated in memory (see slugify.bulk_slugs) ;
+    - objects are saved in bulk mode (see lib/bulk.py): no full_clean(), no per-object signal
+      nor notification email, access networks computed from memoized permissions ;
+    - then what was skipped is reconciled once (see reconcile()).
+    Throughput is reported in rows/sec.
+    """
+    def __init__(self, fixtures, batch_size = 500, verbose = True):
+        self.fixtures = fixtures
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+    def report(self, label, n, duration):
+        if self.verbose:
+            print "%-24s %8d rows in %8.2fs (%8.1f rows/sec)" % (label, n, duration, n / max(duration, 0.001), )
+
+    def apply_batch(self, fixtures, stats):
+        """
+        Apply fixtures in a single transaction.
+        stats is a {model: [n_rows, duration]} dict we update as we go.
+        """
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                for fixture in fixtures:
+                    start = time.time()
+                    fixture.apply()
+                    model_stats = stats.setdefault(fixture.model, [0, 0.0])
+                    model_stats[0] += 1
+                    model_stats[1] += time.time() - start
+            except:
+                transaction.rollback()
+                raise
+            else:
+                transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+
+    def reconcile(self, state):
+        """
+        Do what bulk mode skipped: propagate access networks, then send twistables_bulk_created
+        (timelines, search index, caches...) for the created objects, batch by batch,
+        and twistable_post_save for the updated ones.
+        """
+        from twistranet.twistapp.models.access_network import access_network_closure, set_access_network
+        for root_id, access_network_id in state.propagations.items():
+            set_access_network(access_network_closure(root_id, access_network_id), access_network_id)
+        for i in range(0, len(state.created), self.batch_size):
+            twistables_bulk_created.send(sender = self.__class__, instances = state.created[i:i + self.batch_size])
+        for instance in state.updated.values():
+            twistable_post_save.send(sender = instance.__class__, instance = instance, created = False)
+
+    def load(self):
+        """
+        Apply every fixture, then reconcile. Return the number of applied fixtures.
+        """
+        start = time.time()
+        stats = {}
+        with bulk_slugs():
+            with bulk_loading() as state:
+                for i in range(0, len(self.fixtures), self.batch_size):
+                    self.apply_batch(self.fixtures[i:i + self.batch_size], stats)
+        for model, (n, duration) in stats.items():
+            self.report(model.__name__, n, duration)
+        reconcile_start = time.time()
+        self.reconcile(state)
+        self.report("(reconciliation)", len(state.created) + len(state.updated), time.time() - reconcile_start)
+        self.report("Total", len(self.fixtures), time.time() - start)
+        return len(self.fixtures)
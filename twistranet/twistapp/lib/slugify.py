@@ -1,4 +1,5 @@
 import re
+import threading
 import unicodedata
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
@@ -54,3 +55,84 @@ def slugify(value):
         return slugify(u"%s0" % value)
     return value[:50]
     
+
+SUFFIX_REGEX = re.compile(r"_(?P<num>[0-9]+)$")
+
+def split_slug(slug):
+    """
+    'foo_3' => ('foo', 3), 'foo' => ('foo', 0)
+    """
+    match = SUFFIX_REGEX.search(slug)
+    if match:
+        return slug[:match.start()], int(match.groupdict()['num'])
+    return slug, 0
+
+
+class SlugAllocator(object):
+    """
+    Find free slugs: 'foo' if it's free, 'foo_<n>' otherwise, n being above every suffix in use.
+    That's at most two queries per slug root, whatever the number of 'foo_xxx' slugs.
+    
+    An allocator remembers the slugs it handed out, so that the following 'foo' slugs
+    don't hit the database at all. Share one allocator when creating many objects (see bulk_slugs).
+    Concurrent inserts can still take a slug we handed out: Twistable.save() retries on IntegrityError.
+    """
+    def __init__(self):
+        self._next = {}         # root => next suffix to hand out
+        self._given = set()
+        
+    def _max_suffix(self, root):
+        """
+        Highest 'root_<n>' suffix in database.
+        We only ask for the 'root_' prefix (a LIKE 'root\_%' the slug index can serve)
+        and check for the digits here.
+        """
+        from twistranet.twistapp.models import Twistable
+        prefix = "%s_" % root
+        suffixes = [ 0, ]
+        for slug in Twistable.objects.__booster__.filter(slug__startswith = prefix).values_list("slug", flat = True).iterator():
+            suffix = slug[len(prefix):]
+            if suffix.isdigit():
+                suffixes.append(int(suffix))
+        return max(suffixes)
+        
+    def allocate(self, slug):
+        from twistranet.twistapp.models import Twistable
+        root, num = split_slug(slug)
+        if not self._next.has_key(root):
+            if not slug in self._given and not Twistable.objects.__booster__.filter(slug = slug).exists():
+                self._given.add(slug)
+                return slug
+            self._next[root] = max(self._max_suffix(root), num) + 1
+        slug = "%s_%i" % (root, self._next[root], )
+        self._next[root] += 1
+        self._given.add(slug)
+        return slug
+
+
+_local = threading.local()
+
+class bulk_slugs(object):
+    """
+    Share a SlugAllocator among the Twistables created within this block, eg:
+        with bulk_slugs():
+            for obj in FIXTURES:    obj.apply()
+    This way, importing 10k "Meeting notes" only queries the database for the first one.
+    """
+    def __enter__(self):
+        if not hasattr(_local, "allocators"):
+            _local.allocators = []
+        _local.allocators.append(SlugAllocator())
+        return _local.allocators[-1]
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.allocators.pop()
+        
+def get_slug_allocator():
+    """
+    Return the allocator of the current bulk_slugs() block, or a new one.
+    """
+    allocators = getattr(_local, "allocators", None)
+    if allocators:
+        return allocators[-1]
+    return SlugAllocator()
@@ -0,0 +1,223 @@
+"""
+Standard thumbnails of twistable objects.
+
+Twistable.thumbnails is a lazy mapping: a size is only resolved when it's asked for.
+Resources get all their standard sizes rendered right after they're saved (synchronously, or
+by a small pool of worker threads once the request's transaction is committed, see ThumbnailPool
+and ThumbnailsMiddleware) and keep the resulting URLs in Resource.thumbnail_urls,
+so that displaying a thumbnail doesn't have to decode any image.
+Those URLs are also kept in the shared cache by picture id (caches.PictureCache),
+so that displaying an avatar doesn't even have to load the picture.
+"""
+from __future__ import with_statement
+import threading
+import Queue
+
+from django.conf import settings
+from twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib import auth_context
+from twistranet.core import caches
+
+# name => (geometry, sorl options)
+# Preview: Max = 500x500; Used when a large version should be available.
+# Summary: Max = 100x100;
+# Summary Preview: Max = Min = 100x100;
+# Medium:  Max = Min = 50x50;
+# Big icon: Max = 32x32;
+# Small:   Max = Min = 32x32;
+# Icon:    Max = Min = 16x16;
+THUMBNAIL_SIZES = {
+    "preview":           ("500x500", {"crop": "", "upscale": False}),
+    "summary":           ("100x100", {"crop": "", "upscale": False}),
+    "summary_preview":   ("100x100", {"crop": "center top", "upscale": True}),
+    "medium":            ("50x50", {"crop": "center top", "upscale": True}),
+    "big_icon":          ("32x32", {"upscale": False}),
+    "small":             ("32x32", {"crop": "center top", "upscale": True}),
+    "icon":              ("16x16", {"crop": "center top", "upscale": True}),
+}
+
+
+class StoredThumbnail(object):
+    """
+    A thumbnail which has already been rendered. Only its URL is known.
+    """
+    def __init__(self, url):
+        self.url = url
+
+    def __unicode__(self):
+        return self.url
+
+
+class Thumbnails(dict):
+    """
+    The standard thumbnails of a twistable, resolved on first access.
+    Use it like a dict: thumbnails['summary'].url (or {{ x.thumbnails.summary.url }} in templates).
+    Stored URLs of the picture are used when available, sorl is only called for the missing ones.
+    """
+    def __init__(self, twistable):
+        super(Thumbnails, self).__init__()
+        self.twistable = twistable
+        self._stored_urls = None
+
+    @property
+    def stored_urls(self):
+        if self._stored_urls is None:
+            self._stored_urls = get_stored_urls(self.twistable)
+        return self._stored_urls
+
+    def __missing__(self, name):
+        if not THUMBNAIL_SIZES.has_key(name):
+            raise KeyError(name)
+        url = self.stored_urls.get(name)
+        if url:
+            thumbnail = StoredThumbnail(url)
+        else:
+            geometry, options = THUMBNAIL_SIZES[name]
+            thumbnail = self.twistable.get_thumbnail(geometry, **options)
+        self[name] = thumbnail
+        return thumbnail
+
+
+def get_stored_urls(twistable):
+    """
+    Return the { name: url } stored thumbnails of twistable's forced picture, from the cache if possible.
+    """
+    picture_id = twistable.forced_picture_id
+    if picture_id is None:
+        return {}
+    cache = caches.PictureCache(picture_id)
+    urls = cache.thumbnail_urls
+    if urls is None:
+        picture = twistable.forced_picture
+        urls = picture and picture.stored_thumbnail_urls or {}
+        if urls:
+            cache.thumbnail_urls = urls
+    return urls
+
+
+def render_thumbnails(image):
+    """
+    Render every standard size of image (anything sorl accepts).
+    Return a { name: url } dict. Sizes sorl can't render are left out.
+    """
+    from sorl.thumbnail import default
+    urls = {}
+    for name, (geometry, options) in THUMBNAIL_SIZES.items():
+        try:
+            urls[name] = default.backend.get_thumbnail(image, geometry, **options).url
+        except:
+            log.warning("Unable to render '%s' thumbnail of %s" % (name, image))
+    return urls
+
+
+def pregenerate(resource_id, image):
+    """
+    Render all standard thumbnails of image and store their URLs on the resource.
+    """
+    from twistranet.twistapp.models import Resource
+    urls = render_thumbnails(image)
+    if urls:
+        if not Resource.objects.store_thumbnail_urls(resource_id, urls):
+            log.warning("Resource %s is gone (or not committed yet), its thumbnails URLs are not stored" % resource_id)
+    return urls
+
+
+class ThumbnailPool(object):
+    """
+    Pre-generate thumbnails with a pool of worker threads.
+    With 0 workers (TWISTRANET_THUMBNAIL_WORKERS), thumbnails are rendered synchronously.
+    """
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.n_workers):
+                worker = threading.Thread(target = self._work, name = "thumbnails-%d" % i)
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+
+    def _work(self):
+        from django.db import connection
+        while True:
+            resource_id, image = self.queue.get()
+            try:
+                try:
+                    pregenerate(resource_id, image)
+                except:
+                    log.exception("Unable to pre-generate thumbnails of resource %s" % resource_id)
+            finally:
+                # Each worker has its own DB connection, don't keep it open while idle.
+                connection.close()
+                self.queue.task_done()
+
+    def submit(self, resource):
+        """
+        Queue the given (saved) resource.
+        Its image is resolved here, in the caller's security context.
+        Return the stored URLs if they were rendered synchronously, None otherwise.
+        
+        Worker threads have their own DB connection, so they can't see a resource
+        before it's committed: within a request, the resource is only kept aside
+        and actually queued by ThumbnailsMiddleware once the transaction is over.
+        """
+        image = resource.image
+        if not image:
+            return None
+        if self.n_workers <= 0:
+            return pregenerate(resource.id, image)
+        pending = auth_context.request_cache("thumbnails")
+        if pending is not None:
+            pending[resource.id] = image
+            return None
+        self.put(resource.id, image)
+        return None
+        
+    def put(self, resource_id, image):
+        self._start()
+        self.queue.put((resource_id, image, ))
+
+    def join(self):
+        """
+        Wait until every queued resource has been processed.
+        """
+        self.queue.join()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_thumbnail_pool():
+    """
+    Return the process-wide ThumbnailPool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThumbnailPool(getattr(settings, "TWISTRANET_THUMBNAIL_WORKERS", 0))
+        return _pool
+
+
+class ThumbnailsMiddleware:
+    """
+    Queue the resources saved during the request once its transaction is committed.
+    Must be placed BEFORE django's TransactionMiddleware (so that it processes the
+    response after it), and after twistranet's AuthContextMiddleware.
+    """
+    def process_exception(self, request, exception):
+        # The transaction is rolled back, forget about its resources
+        auth_context.clear_request_cache("thumbnails")
+
+    def process_response(self, request, response):
+        pending = auth_context.request_cache("thumbnails")
+        if pending:
+            pool = get_thumbnail_pool()
+            for resource_id, image in pending.items():
+                pool.put(resource_id, image)
+            pending.clear()
+        return response
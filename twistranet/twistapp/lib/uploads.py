@@ -0,0 +1,180 @@
+"""
+Streamed (and resumable) XHR uploads.
+
+The request body is written to a temporary file chunk by chunk, so that memory use
+doesn't depend on the file size. It's hashed on the fly when sent in one request,
+and read once more on completion when sent in several ones. The temporary file is then moved
+into the Twistorage (see Twistorage._save and its temporary_file_path() support).
+
+Large files can be sent in several requests. The first one gets an upload id back,
+following ones give it in the X-Upload-Id header, with the position of their chunk in X-Upload-Offset.
+X-File-Size is the total size of the file: the upload is complete once we've got that many bytes,
+and sending more is an error.
+Without X-File-Size, the upload is complete after the first request (the quickupload script's behaviour).
+"""
+import os
+import re
+import time
+import uuid
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+from twistranet.twistapp.lib.log import log
+
+# Size of the chunks the request body is read with
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Partial uploads not resumed within this delay (in seconds) are removed
+UPLOAD_EXPIRY = 24 * 60 * 60
+
+UPLOAD_ID_REGEX = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    """
+    The upload can't go on. code is the error sent back to the quickupload script.
+    """
+    def __init__(self, code, **info):
+        super(UploadError, self).__init__(code)
+        self.code = code
+        self.info = info
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    A completely received upload, stored in a temporary file.
+    content_hash is the SHA-1 of the file.
+    """
+    def __init__(self, path, name, content_type, size, content_hash):
+        super(StreamedUploadedFile, self).__init__(open(path, 'rb'), name, content_type, size, None)
+        self.path = path
+        self.content_hash = content_hash
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def get_upload_dir():
+    path = getattr(settings, "TWISTRANET_UPLOAD_TEMP_DIR", None)
+    if not path:
+        path = os.path.join(getattr(settings, "FILE_UPLOAD_TEMP_DIR", None) or tempfile.gettempdir(), "twistranet_uploads")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def _cleanup(upload_dir):
+    """
+    Remove expired partial uploads.
+    """
+    limit = time.time() - UPLOAD_EXPIRY
+    for fname in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, fname)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            pass            # Removed by someone else meanwhile
+
+def _hash_file(path):
+    sha = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            sha.update(data)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def _body_chunks(request):
+    """
+    Yield the request body, UPLOAD_CHUNK_SIZE at a time.
+    """
+    remaining = int(request.META.get('CONTENT_LENGTH') or 0)
+    if hasattr(request, "_raw_post_data"):
+        # Someone already read the body (eg. request.POST was accessed)
+        from cStringIO import StringIO
+        read = StringIO(request._raw_post_data).read
+    else:
+        read = getattr(request, "read", None) or request.environ['wsgi.input'].read
+    while remaining > 0:
+        data = read(min(UPLOAD_CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+def receive_upload(request, account_id, file_name):
+    """
+    Append the body of request to the (new or resumed) upload.
+    Return (upload_id, offset, uploaded_file). uploaded_file is a StreamedUploadedFile
+    if the upload is complete, None if more chunks are expected.
+    Raise UploadError if the chunk can't be accepted.
+    """
+    upload_dir = get_upload_dir()
+    upload_id = request.META.get('HTTP_X_UPLOAD_ID')
+    if upload_id:
+        if not UPLOAD_ID_REGEX.match(upload_id):
+            raise UploadError("uploadIdError")
+    else:
+        _cleanup(upload_dir)
+        upload_id = uuid.uuid4().hex
+    # Uploads are bound to their account: one can't resume someone else's.
+    path = os.path.join(upload_dir, "%s-%s" % (account_id, upload_id, ))
+    if request.META.get('HTTP_X_UPLOAD_ID') and not os.path.exists(path):
+        raise UploadError("uploadIdError")
+    try:
+        total_size = int(request.META.get('HTTP_X_FILE_SIZE') or 0) or None
+        offset = int(request.META.get('HTTP_X_UPLOAD_OFFSET') or 0)
+    except ValueError:
+        raise UploadError("serverError")
+    max_size = int(getattr(settings, "QUICKUPLOAD_SIZE_LIMIT", 0)) * 1024
+    if max_size and total_size and total_size > max_size:
+        raise UploadError("sizeError")
+
+    # The chunk must start where the previous one stopped
+    current = os.path.exists(path) and os.path.getsize(path) or 0
+    if offset != current:
+        raise UploadError("offsetError", upload_id = upload_id, offset = current)
+
+    # Hash what we receive, unless we're resuming: we'll hash the whole file on completion
+    sha = not current and hashlib.sha1() or None
+    f = open(path, 'ab')
+    try:
+        try:
+            for data in _body_chunks(request):
+                offset += len(data)
+                if max_size and offset > max_size:
+                    raise UploadError("sizeError")
+                if total_size and offset > total_size:
+                    raise UploadError("sizeError")
+                if sha:
+                    sha.update(data)
+                f.write(data)
+        finally:
+            f.close()
+    except UploadError:
+        os.remove(path)
+        raise
+    except:
+        # Connection lost: keep what we've got if the client can resume
+        if not total_size:
+            os.remove(path)
+        raise
+
+    if total_size and offset < total_size:
+        return (upload_id, offset, None, )
+    if not total_size and offset - current < int(request.META.get('CONTENT_LENGTH') or 0):
+        # Truncated body, and no way to resume
+        os.remove(path)
+        raise UploadError("emptyError")
+    if not offset:
+        os.remove(path)
+        raise UploadError("emptyError")
+    log.debug("Upload %s of %s complete (%d bytes)" % (upload_id, file_name, offset, ))
+    return (upload_id, offset, StreamedUploadedFile(path, file_name, None, offset, sha and sha.hexdigest() or _hash_file(path)), )
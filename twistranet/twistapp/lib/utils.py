@@ -1,35 +1,103 @@
+from __future__ import with_statement
+import threading
 from django.core.cache import cache
 from django.conf import settings
 from django.utils.html import *
+from twistranet.twistapp.lib import auth_context
+from twistranet.core import caches
 
+SITE_DOMAIN_CACHE_KEY = "twistranet_site_domain"
+SITE_DOMAIN_CACHE_DELAY = 60 * 60 * 24          # 1 day is enough here
 
-def _get_site_name_or_baseline(return_baseline = False):
+
+class SiteConfig(object):
     """
-    Read the site name from global community.
-    We use tricks to ensure we can get the glob com. even with anonymous requests.
+    Process-wide snapshot of the site configuration:
+    site name, baseline and visibility of the GlobalCommunity, and site domain.
+    Saving the GlobalCommunity or the Site bumps a version in the shared cache, which makes
+    every process reload its snapshot. The version is checked once per request.
     """
-    d = cache.get_many(["twistranet_site_name", "twistranet_baseline"])
-    site_name = d.get("site_name", None)
-    baseline = d.get("baseline", None)
-    if site_name is None or baseline is None:
+    def __init__(self):
+        self._config = None
+        self._version = None
+        self._lock = threading.Lock()
+        
+    def _load(self):
         from twistranet.twistapp.models import SystemAccount, GlobalCommunity
-        __account__ = SystemAccount.get()
-        try:
+        # We use tricks to ensure we can get the glob com. even with anonymous requests.
+        with auth_context.acting_as(SystemAccount.get()):
             glob = GlobalCommunity.get()
-            site_name = glob.site_name
-            baseline = glob.baseline
-        finally:
-            del __account__
-        cache.set('twistranet_site_name', site_name)
-        cache.set("twistranet_baseline", baseline)
-    if return_baseline:
-        return baseline
-    return site_name
+        return {
+            "site_name":            glob.site_name,
+            "baseline":             glob.baseline,
+            "global_id":            glob.id,
+            "global_permissions":   glob.permissions,
+            "global_can_list":      glob._p_can_list,
+            "global_can_view":      glob._p_can_view,
+            "domain":               cache.get(SITE_DOMAIN_CACHE_KEY),
+        }
+        
+    def get(self):
+        """
+        Return the current configuration, as a dict. Don't modify it.
+        """
+        memo = auth_context.request_cache("site_config")
+        if memo and memo.has_key("config"):
+            return memo["config"]
+        version = caches.SiteConfigCache.get_version()
+        with self._lock:
+            if version != self._version or self._config is None:
+                self._config = self._load()
+                self._version = version
+            config = self._config
+        if memo is not None:
+            memo["config"] = config
+        return config
+        
+    def invalidate(self):
+        caches.SiteConfigCache.bump_version()
+        auth_context.clear_request_cache("site_config")
+
+site_config = SiteConfig()
     
 def get_site_name():
-    return _get_site_name_or_baseline(return_baseline = False)
+    return site_config.get()["site_name"]
 def get_baseline():
-    return _get_site_name_or_baseline(return_baseline = True)
+    return site_config.get()["baseline"]
+    
+def get_site_domain():
+    """
+    Return the site's base URL (eg. "http://twistranet.example.com"), or None if we don't know it yet.
+    It's found while processing requests (see BaseView.get_site_domain).
+    """
+    return site_config.get()["domain"]
+    
+def set_site_domain(domain):
+    cache.set(SITE_DOMAIN_CACHE_KEY, domain, SITE_DOMAIN_CACHE_DELAY)
+    site_config.invalidate()
+    
+def can_access_site(request = None):
+    """
+    Return True if the current account (or request's) can see the GlobalCommunity, ie. can access the site.
+    That's decided from the site configuration snapshot and the account's (cached) principal set,
+    so that no query is done in the usual cases.
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    from twistranet.twistapp.models import GlobalCommunity, SystemAccount
+    from twistranet.twistapp.lib import roles
+    try:
+        config = site_config.get()
+    except ObjectDoesNotExist:
+        return False            # Not bootstrapped yet
+    if config["global_can_list"] == roles.public:
+        return True
+    account = GlobalCommunity.objects._getAuthenticatedAccount(request = request)
+    if account.is_anonymous:
+        return False
+    if account.id == SystemAccount.SYSTEMACCOUNT_ID or config["global_id"] in account.principal_ids:
+        return True
+    # Unusual cases (eg. admins who aren't members): ask the secured manager
+    return GlobalCommunity.objects.get_query_set(request = request).exists()
 
 
 def truncate(text, length, ellipsis=u'\u2026'):
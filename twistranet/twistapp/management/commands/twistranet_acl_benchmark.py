@@ -0,0 +1,109 @@
+"""
+Compare the former (join-based) secured queryset with the principal set one.
+Meant to be run against a database populated with fixtures/heavy_load.py.
+"""
+from __future__ import with_statement
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from django.conf import settings
+
+class Command(BaseCommand):
+    args = '[n_accounts]'
+    help = 'Benchmark secured listings (query plan and latency) before and after the principal set optimization.'
+    option_list = BaseCommand.option_list + (
+        make_option('--page-size', dest = 'page_size', type = 'int', default = 25,
+            help = 'Number of content fetched for each account (default: 25).'),
+    )
+
+    def legacy_query_set(self, account):
+        """
+        The secured Content queryset as it was built before principal sets, for comparison purposes.
+        """
+        from twistranet.twistapp.models import Content
+        from twistranet.twistapp.lib import roles
+        return Content.objects.__booster__.filter(
+            Q(
+                owner__id = account.id,
+                _p_can_list = roles.owner,
+            ) | Q(
+                _access_network__targeted_network__target = account,
+                _p_can_list = roles.network,
+            ) | Q(
+                _access_network__targeted_network__target = account,
+                _p_can_list = roles.public,
+            ) | Q(
+                _access_network__isnull = True,
+                _p_can_list = roles.public,
+            )
+        ).distinct()
+
+    def explain(self, qs):
+        """
+        Return the query plan of the given queryset as a list of strings.
+        """
+        sql, params = qs.query.get_compiler(using = qs.db).as_sql()
+        if "sqlite" in settings.DATABASES[qs.db]['ENGINE']:
+            sql = "EXPLAIN QUERY PLAN %s" % sql
+        else:
+            sql = "EXPLAIN %s" % sql
+        cursor = connections[qs.db].cursor()
+        cursor.execute(sql, params)
+        return [ " | ".join([ unicode(c) for c in row ]) for row in cursor.fetchall() ]
+
+    def timed(self, qs, page_size):
+        start = time.time()
+        list(qs.order_by("-id").values_list("id", flat = True)[:page_size])
+        return time.time() - start
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import UserAccount, Content, SystemAccount
+        from twistranet.twistapp.lib.auth_context import acting_as
+        from twistranet.core import caches
+        n_accounts = args and int(args[0]) or 20
+        page_size = options['page_size']
+
+        # Pick regular (ie. non-admin) accounts
+        with acting_as(SystemAccount.get()):
+            account_ids = list(UserAccount.objects.values_list("id", flat = True))
+        if not account_ids:
+            raise CommandError("No user account found. Load fixtures/heavy_load.py first.")
+        accounts = []
+        for account_id in random.sample(account_ids, min(n_accounts, len(account_ids))):
+            account = UserAccount.objects.__booster__.get(id = account_id)
+            if not account.is_admin:
+                accounts.append(account)
+        if not accounts:
+            raise CommandError("Only admin accounts found, they don't go through the secured filter.")
+
+        # Query plans
+        sample = accounts[0]
+        print "Query plan BEFORE (join on Network + distinct):"
+        for line in self.explain(self.legacy_query_set(sample)):
+            print "    %s" % line
+        print "Query plan AFTER (principal set):"
+        for line in self.explain(Content.objects.get_query_set(__account__ = sample)):
+            print "    %s" % line
+
+        # Latency
+        before = after_cold = after_warm = 0.0
+        for account in accounts:
+            before += self.timed(self.legacy_query_set(account), page_size)
+            caches.PrincipalsCache(account.id).invalidate()
+            account = UserAccount.objects.__booster__.get(id = account.id)
+            start = time.time()
+            qs = Content.objects.get_query_set(__account__ = account)
+            after_cold += time.time() - start + self.timed(qs, page_size)
+            account = UserAccount.objects.__booster__.get(id = account.id)
+            start = time.time()
+            qs = Content.objects.get_query_set(__account__ = account)
+            after_warm += time.time() - start + self.timed(qs, page_size)
+        n = len(accounts)
+        print "%d accounts, %d contents per listing, %d contents total" % (n, page_size, Content.objects.__booster__.count())
+        print "  before:                %8.2f ms/listing" % (before * 1000 / n, )
+        print "  after (cold cache):    %8.2f ms/listing" % (after_cold * 1000 / n, )
+        print "  after (warm cache):    %8.2f ms/listing" % (after_warm * 1000 / n, )
@@ -0,0 +1,35 @@
+"""
+Convert the files of the Twistorage to the content-addressed layout (see twistorage.storage),
+ie. store identical files only once. Can be run any time, files already converted are skipped.
+"""
+from __future__ import with_statement
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Store identical files of the Twistorage only once.'
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import SystemAccount
+        from twistranet.twistapp.lib.auth_context import acting_as
+        from twistranet.twistorage.storage import Twistorage, BLOB_DIR
+        storage = Twistorage()
+        if not storage.content_addressed:
+            raise CommandError("Set TWISTRANET_CONTENT_ADDRESSED_STORAGE first (hard links are required).")
+        verbose = options['verbosity'] and int(options['verbosity']) > 1
+        n_files = n_converted = 0
+        with acting_as(SystemAccount.get()):
+            for account_dir in os.listdir(storage.location):
+                if account_dir == BLOB_DIR or not os.path.isdir(os.path.join(storage.location, account_dir)):
+                    continue
+                for root, dirs, files in os.walk(os.path.join(storage.location, account_dir)):
+                    for fname in files:
+                        name = os.path.join(root, fname)[len(storage.location) + 1:]
+                        n_files += 1
+                        if storage.deduplicate(name):
+                            n_converted += 1
+                            if verbose:
+                                print "Converted %s" % name
+        print "%d files, %d converted" % (n_files, n_converted, )
@@ -0,0 +1,45 @@
+"""
+Run the access network propagations that were too large to be done within a request
+(see twistapp.models.access_network). Run this from cron, or with --loop as a daemon.
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Propagate access network changes to large object hierarchies, reporting progress.'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', dest = 'loop', type = 'int', default = 0,
+            help = 'Keep running, checking for jobs every LOOP seconds.'),
+        make_option('--status', dest = 'status', action = 'store_true', default = False,
+            help = 'Only print pending jobs.'),
+    )
+
+    def print_status(self):
+        from twistranet.twistapp.models import AccessNetworkJob
+        stats = AccessNetworkJob.objects.stats()
+        print "%(pending)6d pending jobs" % stats
+        for root_id, done, total in stats["jobs"]:
+            print "    root %6d: %6d / %6d" % (root_id, done, total, )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import AccessNetworkJob
+        if options['status']:
+            self.print_status()
+            return
+        verbose = options['verbosity'] and int(options['verbosity']) > 1
+        def progress(job):
+            if verbose:
+                print "    %s" % (job, )
+        while True:
+            for job in AccessNetworkJob.objects.order_by("id"):
+                if not AccessNetworkJob.objects.filter(id = job.id).exists():
+                    continue        # Replaced by a newer job meanwhile
+                if verbose:
+                    print "Propagating access network of %d" % (job.root_id, )
+                job.run(progress = progress)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
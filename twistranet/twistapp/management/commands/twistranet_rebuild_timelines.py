@@ -0,0 +1,26 @@
+"""
+Rebuild denormalized timelines (see twistapp/models/timeline.py).
+Run this once after upgrading, or whenever timelines seem out of sync.
+"""
+from __future__ import with_statement
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuild every account timeline from its current relations.'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest = 'limit', type = 'int', default = None,
+            help = 'Number of content copied from each followed account (default: TWISTRANET_TIMELINE_BACKFILL).'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import Account, SystemAccount, TimelineEntry
+        from twistranet.twistapp.lib.auth_context import acting_as
+        with acting_as(SystemAccount.get()):
+            n = 0
+            for account in Account.objects.__booster__.all().iterator():
+                TimelineEntry.objects.rebuild(account, limit = options['limit'])
+                n += 1
+        print "%d timelines rebuilt, %d entries" % (n, TimelineEntry.objects.count(), )
@@ -0,0 +1,108 @@
+"""
+Send the mail queued by notifier.handlers.MailHandler (see notifier.models.MailJob and OutgoingMail).
+Run this from cron, or with --loop as a daemon. Several workers can run at once:
+each job or message is claimed by a single one of them.
+"""
+from __future__ import with_statement
+import time
+import traceback
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.mail import get_connection
+from django.conf import settings
+
+from twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib.auth_context import acting_as
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Send queued emails in batches, over one SMTP connection per batch.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest = 'batch_size', type = 'int', default = None,
+            help = 'Number of messages sent over a single connection (default: TWISTRANET_MAIL_BATCH_SIZE).'),
+        make_option('--loop', dest = 'loop', type = 'int', default = 0,
+            help = 'Keep running, checking the queue every LOOP seconds.'),
+        make_option('--status', dest = 'status', action = 'store_true', default = False,
+            help = 'Only print queue metrics.'),
+    )
+
+    def run_job(self, job, connection):
+        """
+        Expand, render and send a mail job over connection.
+        Messages which can't be sent are kept in the OutgoingMail queue to be retried.
+        """
+        from twistranet.twistapp.models import SystemAccount
+        from twistranet.notifier.models import OutgoingMail
+        def send(msg):
+            try:
+                connection.send_messages([ msg ])
+            except:
+                log.warning("Unable to send message to %s" % msg.to)
+                OutgoingMail.objects.enqueue(msg).failed(traceback.format_exc())
+        try:
+            handler, sender, kwargs, author_id = job.job
+            with acting_as(SystemAccount.get()):
+                handler.deliver(sender, handler.thaw(kwargs), send, author_id)
+        except:
+            log.warning("Unable to process mail job %s" % job)
+            job.failed(traceback.format_exc())
+        else:
+            job.delete()
+
+    def send_batch(self, batch_size):
+        """
+        Process at most batch_size due jobs and batch_size due messages.
+        Return the number of items processed.
+        """
+        from twistranet.notifier.models import MailJob, OutgoingMail
+        jobs = MailJob.objects.claim(batch_size)
+        mails = OutgoingMail.objects.claim(batch_size)
+        batch = jobs + mails
+        if not batch:
+            return 0
+        connection = get_connection()
+        try:
+            connection.open()
+        except:
+            # Can't reach the server: all messages of the batch are postponed.
+            error = traceback.format_exc()
+            log.warning("Unable to open mail connection")
+            for m in batch:
+                m.failed(error)
+            return len(batch)
+        try:
+            for job in jobs:
+                self.run_job(job, connection)
+            for m in mails:
+                try:
+                    connection.send_messages([ m.message ])
+                except:
+                    log.warning("Unable to send message to %s" % m.recipient)
+                    m.failed(traceback.format_exc())
+                else:
+                    m.delete()
+        finally:
+            connection.close()
+        return len(batch)
+
+    def print_status(self):
+        from twistranet.notifier.models import MailJob, OutgoingMail
+        for name, model in (("jobs", MailJob), ("messages", OutgoingMail), ):
+            stats = model.objects.stats()
+            stats["name"] = name
+            print "%(name)8s: %(pending)6d pending | %(failed)6d failed | oldest: %(oldest)s" % stats
+
+    def handle(self, *args, **options):
+        if options['status']:
+            self.print_status()
+            return
+        batch_size = options['batch_size'] or getattr(settings, "TWISTRANET_MAIL_BATCH_SIZE", 100)
+        while True:
+            while self.send_batch(batch_size) >= batch_size:
+                pass
+            if options['verbosity'] and int(options['verbosity']) > 1:
+                self.print_status()
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -1,6 +1,7 @@
 """
 Report status over this TN instance, as a table.
 """
+from __future__ import with_statement
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Max
 from django.conf import settings
@@ -15,14 +16,15 @@ class Command(BaseCommand):
         Perform stats
         """
         from twistranet.twistapp import UserAccount, Content, SystemAccount
+        from twistranet.twistapp.lib.auth_context import acting_as
         from django.contrib.auth.models import User
-        __account__ = SystemAccount.get()
         here = os.path.split(settings.HERE)[1]
-        stat_dict = {
-            "here":             here,
-            "n_users":          UserAccount.objects.count(),
-            "n_contents":       Content.objects.count(),
-            "last_login":       User.objects.aggregate(Max("last_login"))['last_login__max'].strftime("%Y-%m-%d"),
-        }
+        with acting_as(SystemAccount.get()):
+            stat_dict = {
+                "here":             here,
+                "n_users":          UserAccount.objects.count(),
+                "n_contents":       Content.objects.count(),
+                "last_login":       User.objects.aggregate(Max("last_login"))['last_login__max'].strftime("%Y-%m-%d"),
+            }
         print "%(here)32s | %(n_users)4d Users | %(n_contents)5d Contents | %(last_login)s" % stat_dict
         
@@ -0,0 +1,47 @@
+"""
+Pre-generate the standard thumbnails of resources which don't have them stored yet
+(eg. after a bulk load or an upgrade). See twistapp.lib.thumbnails.
+"""
+from __future__ import with_statement
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Render and store the standard thumbnails of resources, with a pool of worker threads.'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', dest = 'all', action = 'store_true', default = False,
+            help = 'Render thumbnails of every resource, even if they are already stored.'),
+        make_option('--workers', dest = 'workers', type = 'int', default = None,
+            help = 'Number of worker threads (default: TWISTRANET_THUMBNAIL_WORKERS).'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import Resource, SystemAccount
+        from twistranet.twistapp.lib.auth_context import acting_as
+        from twistranet.twistapp.lib.thumbnails import ThumbnailPool
+        workers = options['workers']
+        if workers is None:
+            workers = getattr(settings, "TWISTRANET_THUMBNAIL_WORKERS", 0)
+        verbose = options['verbosity'] and int(options['verbosity']) > 1
+        pool = ThumbnailPool(workers)
+        start = time.time()
+        n = 0
+        with acting_as(SystemAccount.get()):
+            resources = Resource.objects.order_by("id")
+            if not options['all']:
+                resources = resources.filter(thumbnail_urls = "")
+            for resource in resources:
+                if verbose:
+                    print "Rendering thumbnails of %s" % (resource, )
+                try:
+                    pool.submit(resource)
+                except:
+                    print "Unable to render thumbnails of %s" % (resource, )
+                    continue
+                n += 1
+            pool.join()
+        print "%d resources processed in %.1fs" % (n, time.time() - start, )
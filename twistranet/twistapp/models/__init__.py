@@ -11,6 +11,8 @@ from resource import Resource
 from account import UserAccount, SystemAccount
 from community import GlobalCommunity, AdminCommunity
 from network import Network
+from timeline import TimelineEntry
+from access_network import AccessNetworkJob
 
 # Menu / Taxonomy management
 from menu import Menu, MenuItem
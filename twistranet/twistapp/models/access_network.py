@@ -0,0 +1,140 @@
+"""
+Propagation of _access_network down the publisher hierarchy.
+
+When the listing permission (or the publisher) of a Twistable changes, the public objects
+published on it, the public objects published on those, and so on, must get a new
+access network. We compute that closure one level at a time with set-based queries,
+stopping at objects restricting their own listing (they're their own access network)
+and at objects which already have the right value.
+
+Restrictions are always applied right away, whatever the size of the closure:
+content must never stay visible to people who just lost access to it.
+Widening the visibility of a large hierarchy can wait, so large closures are then handed
+to a background job (see AccessNetworkJob and the twistranet_propagate_access management command),
+and opening a busy community doesn't rewrite thousands of rows within the request.
+"""
+from django.db import models
+from django.db.models import Q
+from django.conf import settings
+from twistable import Twistable
+from account import Account
+from twistranet.twistapp.lib import roles
+from twistranet.core import caches
+
+# Number of ids per query
+CHUNK_SIZE = 500
+
+
+def access_network_closure(root_id, access_network_id, limit = None):
+    """
+    Return the ids of the objects below root_id whose access network must become access_network_id.
+    If limit is set, give up (and return None) as soon as there are more than limit of them.
+    """
+    closure = []
+    seen = set([ root_id, ])
+    frontier = [ root_id, ]
+    first_level = True
+    while frontier:
+        next_frontier = []
+        for i in range(0, len(frontier), CHUNK_SIZE):
+            chunk = frontier[i:i + CHUNK_SIZE]
+            dependant = Q(publisher__id__in = chunk)
+            if first_level:
+                # Objects that got their access network from root before (as the original implementation did)
+                dependant = dependant | Q(_access_network__id = root_id)
+            qs = Twistable.objects.__booster__.filter(dependant, _p_can_list = roles.public)
+            if access_network_id is None:
+                qs = qs.exclude(_access_network__isnull = True)
+            else:
+                qs = qs.exclude(_access_network__id = access_network_id)
+            for twistable_id in qs.values_list("id", flat = True):
+                if twistable_id in seen:
+                    continue
+                seen.add(twistable_id)
+                next_frontier.append(twistable_id)
+        first_level = False
+        closure.extend(next_frontier)
+        if limit is not None and len(closure) > limit:
+            return None
+        frontier = next_frontier
+    return closure
+
+def set_access_network(ids, access_network_id):
+    """
+    Update the given objects' access network, CHUNK_SIZE objects at a time.
+    """
+    for i in range(0, len(ids), CHUNK_SIZE):
+        Twistable.objects.__booster__.filter(
+            id__in = ids[i:i + CHUNK_SIZE],
+        ).update(_access_network = access_network_id)
+    if ids:
+        caches.AccessNetworkCache.bump_version()
+
+def propagate_access_network(root_id, access_network_id, deferrable = False):
+    """
+    Give access_network_id to the public objects below root_id.
+    If deferrable (ie. the change only widens visibility), that's done right away for up to
+    TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT objects, and in a background job otherwise.
+    """
+    limit = None
+    if deferrable:
+        limit = getattr(settings, "TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT", None)
+    ids = access_network_closure(root_id, access_network_id, limit = limit)
+    if ids is None:
+        AccessNetworkJob.objects.enqueue(root_id, access_network_id)
+    else:
+        # Pending jobs for this root are outdated now
+        AccessNetworkJob.objects.filter(root__id = root_id).delete()
+        set_access_network(ids, access_network_id)
+
+
+class AccessNetworkJobManager(models.Manager):
+    def enqueue(self, root_id, access_network_id):
+        """
+        Plan a propagation. It replaces the pending ones for the same root, which are outdated.
+        """
+        self.filter(root__id = root_id).delete()
+        return self.create(root_id = root_id, access_network_id = access_network_id)
+
+    def stats(self):
+        return {
+            "pending":  self.count(),
+            "jobs":     list(self.order_by("id").values_list("root", "done", "total")),
+        }
+
+
+class AccessNetworkJob(models.Model):
+    """
+    A propagation too large to be done within a request.
+    done / total are updated as the job runs, for progress reporting.
+    """
+    root = models.ForeignKey(Twistable, related_name = "+")
+    access_network = models.ForeignKey(Account, null = True, blank = True, related_name = "+")
+    total = models.IntegerField(default = 0)
+    done = models.IntegerField(default = 0)
+    created_at = models.DateTimeField(auto_now_add = True)
+
+    objects = AccessNetworkJobManager()
+
+    def run(self, progress = None):
+        """
+        Compute the closure again (it may have changed since the job was planned) and update it chunk by chunk.
+        progress(job) is called after each chunk.
+        """
+        ids = access_network_closure(self.root_id, self.access_network_id)
+        self.total = len(ids)
+        AccessNetworkJob.objects.filter(id = self.id).update(total = self.total, done = 0)
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            set_access_network(chunk, self.access_network_id)
+            self.done += len(chunk)
+            AccessNetworkJob.objects.filter(id = self.id).update(done = self.done)
+            if progress:
+                progress(self)
+        AccessNetworkJob.objects.filter(id = self.id).delete()
+
+    def __unicode__(self):
+        return u"%s => %s (%d/%d)" % (self.root_id, self.access_network_id, self.done, self.total, )
+
+    class Meta:
+        app_label = 'twistapp'
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from django.db import models
 from django.db.models import Q
 from django.core.cache import cache
@@ -8,6 +9,9 @@ from django.conf import settings
 import twistable
 from resource import Resource
 from twistranet.twistapp.lib import permissions, roles, languages, slugify
+from twistranet.twistapp.lib import auth_context
+from twistranet.twistapp.lib.auth_context import acting_as
+from twistranet.core import caches
 from twistranet.twistapp.signals import request_add_to_network, accept_in_network
 from  twistranet.twistapp.lib.log import log
 
@@ -159,6 +163,24 @@ class Account(twistable.Twistable):
     def has_permission(self, permission, obj):
         """
         Return true if authenticated user has been granted the given permission on obj.
+        Decisions are memoized for the current request (see auth_context.request_cache()),
+        the key including obj's permissions, owner, publisher and modification date so that edits are taken into account.
+        Unsaved objects are not memoized.
+        """
+        memo = auth_context.request_cache("permissions")
+        if memo is None or obj.id is None:
+            return self._has_permission(permission, obj)
+        key = (self.__class__, self.id, permission, obj.id, obj.permissions, obj.owner_id, obj.publisher_id, obj.modified_at, )
+        if key in memo:
+            auth_context.count_memo("permissions", True)
+            return memo[key]
+        auth_context.count_memo("permissions", False)
+        ret = memo[key] = self._has_permission(permission, obj)
+        return ret
+
+    def _has_permission(self, permission, obj):
+        """
+        Actual (non memoized) permission check.
         """
         # Check roles, strongest first to optimize caching.
         try:
@@ -210,16 +232,33 @@ class Account(twistable.Twistable):
     @property
     def network_ids(self,):
         """
-        Return networks available for queries AAAND myself.
-        XXX TODO: Cache this!
+        Return networks available for queries AAAND myself, as a frozenset.
+        That's exactly the principal set, so we share its cache.
         """
-        if hasattr(self, "_c_network_ids"):
-            return self._c_network_ids
-        
-        ids = Account.objects.__booster__.filter(
-            Q(targeted_network__target__id = self.id) | Q(id = self.id)
-            ).values_list("id", flat = True)
-        self._c_network_ids = ids
+        return self.principal_ids
+
+    @property
+    def principal_ids(self,):
+        """
+        Return the 'principal set' of this account: its own id plus the ids of every account
+        which accepted it in its network (that includes the communities it's a member of).
+        That's what the secured querysets check _access_network against.
+        
+        This is cached and invalidated when a Network relation targeting this account changes.
+        """
+        if hasattr(self, "_c_principal_ids"):
+            return self._c_principal_ids
+        if self.id is None:
+            return frozenset()          # Anonymous
+        c = caches.PrincipalsCache(self.id)
+        ids = c.ids
+        if ids is None:
+            from network import Network
+            ids = frozenset(
+                list(Network.objects.filter(target__id = self.id).values_list("client", flat = True)) + [self.id, ]
+            )
+            c.ids = ids
+        self._c_principal_ids = ids
         return ids
 
     @property
@@ -244,13 +283,10 @@ class Account(twistable.Twistable):
     def communities(self):
         """
         Return communities this user is actually a member of.
-        XXX TODO: Cache this!!
         """
         from community import Community
-        return Community.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-        )
+        from twistranet.twistapp.models.network import network_graph
+        return Community.objects.filter(id__in = network_graph.approved_query(self.id))
         
     @property
     def community_ids(self,):
@@ -335,10 +371,9 @@ class UserAccount(Account):
         # XXX Maybe this has to be done BEFORE calling super() ?
         if creation:
             glob = community.GlobalCommunity.objects.get()
-            __account__ = SystemAccount.objects.get()
-            glob.join(self)
-            self.follow(self)
-            del __account__
+            with acting_as(SystemAccount.objects.get()):
+                glob.join(self)
+                self.follow(self)
             
         log.debug("Saved %s (title = %s)" % (self, self.title, ))
         return ret
@@ -365,21 +400,20 @@ class UserAccount(Account):
         """
         Ask currently auth account to follow this one.
         """
-        from twistranet.twistapp.models.network import Network
+        from twistranet.twistapp.models.network import Network, network_graph
 
         # If relation already exists, we silently pass
         auth = Account.objects._getAuthenticatedAccount()
         if self.id == auth.id:
             return
-        you_to_me = Network.objects.filter(client = auth, target = self)
-        if you_to_me.exists():
+        if network_graph.is_following(auth.id, self.id):
             return
             
         # Add the relation itself
         Network.objects.create(client = auth, target = self)
         
         # Then send the proper signal according to the symetry
-        if Network.objects.filter(client = self, target = auth).exists():
+        if network_graph.is_following(self.id, auth.id):
             accept_in_network.send(
                 sender = self.__class__,
                 client = auth,
@@ -413,7 +447,7 @@ class UserAccount(Account):
         True if currently auth user can add the given one to its network.
         False if already in my network ;)
         """
-        from twistranet.twistapp.models.network import Network
+        from twistranet.twistapp.models.network import network_graph
         if not self.can_list:
             return False
         auth = Account.objects._getAuthenticatedAccount()
@@ -421,20 +455,20 @@ class UserAccount(Account):
             return False
         if self.id == auth.id:
             return False
-        return not Network.objects.filter(client = auth, target = self).exists()        
+        return not network_graph.is_following(auth.id, self.id)
         
     @property
     def in_my_network(self):
         """
         True if current object is in auth's user nwk (or at least has a nwk confirmation pending)
         """
-        from twistranet.twistapp.models.network import Network
+        from twistranet.twistapp.models.network import network_graph
         auth = Account.objects._getAuthenticatedAccount()
         if auth.is_anonymous:
             return False
         if self.id == auth.id:
             return False
-        return Network.objects.filter(client = auth, target = self).exists()        
+        return network_graph.is_following(auth.id, self.id)
         
     @property
     def has_pending_network_request(self):
@@ -468,23 +502,13 @@ class UserAccount(Account):
     def get_pending_network_requests(self, returned_model = None):
         """
         List pending nwk user requests, ie. requests I yet have to approve.
-        XXX MORE THAN SUBOPTIMAL !!!
         You can use the 'returned_model' parameter to restrict invitations to a specific model.
         Default is to return only UserAccount requests
         """
         if not returned_model:
             returned_model = UserAccount
-        from twistranet.twistapp.models.network import Network
-        requested_ids = Network.objects.filter(target = self).values_list("client__id", flat = True)
-        accepted_ids = Network.objects.filter(client = self).values_list("target__id", flat = True)
-        
-        unvalidated_ids = []
-        for i in requested_ids:
-            if i in accepted_ids:
-                continue
-            unvalidated_ids.append(i)
-            
-        return returned_model.objects.filter(id__in = unvalidated_ids)
+        from twistranet.twistapp.models.network import network_graph
+        return returned_model.objects.filter(id__in = network_graph.pending_query(self.id))
         
     def get_pending_network_request_ids(self, returned_model = None):
         return self.get_pending_network_requests(returned_model).values_list("id", flat = True)
@@ -497,9 +521,8 @@ class UserAccount(Account):
         Ask current user to follow the other one
         """
         # XXX TODO: Check security
-        from twistranet.twistapp.models.network import Network
-        me_to_you = Network.objects.filter(client = self, target = account)
-        if me_to_you.exists():
+        from twistranet.twistapp.models.network import Network, network_graph
+        if network_graph.is_following(self.id, account.id):
             return
         
         # Add the relation itself
@@ -569,19 +592,19 @@ def create_profile(sender, instance, created, *args, **kw):
             return
             
         # We consider we're the SystemAccount now.
-        __account__ = SystemAccount.get()
-        
-        # Actually create profile
-        log.info("Automatic creation of a UserAccount for %s" % instance)
-        profile = UserAccount(
-            user = instance,
-            slug = slugify.slugify(instance.username),
-        )
-        profile.save()
+        with acting_as(SystemAccount.get()):
+            # Actually create profile
+            log.info("Automatic creation of a UserAccount for %s" % instance)
+            profile = UserAccount(
+                user = instance,
+                slug = slugify.slugify(instance.username),
+            )
+            profile.save()
     
 post_save.connect(create_profile, sender = User)
         
 
+
 class AccountLanguage(models.Model):
     """
     An intermediate model class to handle user -> languages problem.
@@ -1,17 +1,19 @@
 from django.db import models, IntegrityError
+from django.db.models.signals import post_save
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.urlresolvers import NoReverseMatch
 from django.core.cache import cache
 from django.conf import settings
+from django.contrib.sites.models import Site
 
-from twistranet.twistapp.lib import permissions
-from twistranet.twistapp.signals import join_community, invite_community, request_join_community
+from twistranet.twistapp.lib import permissions, utils
+from twistranet.twistapp.signals import join_community, invite_community, request_join_community, twistable_post_save
 
 from account import Account, SystemAccount
 from twistable import Twistable
-from network import Network
+from network import Network, network_graph
 
 from  twistranet.twistapp.lib.log import log
 
@@ -33,22 +35,19 @@ class Community(Account):
     
     @property
     def managers(self):
-        return Account.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-            targeted_network__is_manager = True,
-        )
+        return Account.objects.filter(id__in = network_graph.manager_query(self.id))
+        
+    @property
+    def manager_ids(self):
+        return network_graph.manager_ids(self.id)
         
     @property
     def members(self):
-        return Account.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-        )
+        return Account.objects.filter(id__in = network_graph.approved_query(self.id))
         
     @property
     def member_ids(self):
-        return self.members.values_list("id", flat = True)
+        return network_graph.approved_ids(self.id)
         
     @property
     def members_for_display(self):
@@ -113,30 +112,15 @@ class Community(Account):
         """
         Return True if given account is member.
         If account is None, assume it's current authenticated.
-        XXX HAVE TO OPTIMIZE (PRE-LOAD?) THIS!
+        This is answered by the cached network graph (see network.NetworkManager).
         """
         if not account:
             account = Community.objects._getAuthenticatedAccount()
             if not account:
                 return False    # Anon user
-                
-        if not is_manager:
-            flt = Account.objects.__booster__.filter(
-                targeted_network__target__id = self.id,
-                targeted_network__client__id = account.id,
-                requesting_network__client__id = self.id,
-                requesting_network__target__id = account.id,
-            )
-        else:
-            flt = Account.objects.__booster__.filter(
-                targeted_network__target__id = self.id,
-                targeted_network__client__id = account.id,
-                requesting_network__client__id = self.id,
-                requesting_network__target__id = account.id,
-                targeted_network__is_manager = True,
-            )
-
-        return flt.exists()
+        if account.id is None or self.id is None:
+            return False
+        return network_graph.is_member(account.id, self.id, is_manager = is_manager)
 
             
     @property
@@ -166,7 +150,7 @@ class Community(Account):
         # Special check if we're not the last (human) manager inside
         if self.is_manager:
             log.debug("Is manager on %s" % self)
-            if self.managers.count() == 1:
+            if len(self.manager_ids) == 1:
                 return False
         
         # Regular checks
@@ -179,9 +163,9 @@ class Community(Account):
         True if currently auth user has a pending invitation in this community
         """
         auth = Account.objects._getAuthenticatedAccount()
-        if self.id in auth.get_pending_network_request_ids(returned_model = Community):
-            return True             # Has pending request
-        return False                # No request pending
+        if auth.id is None:
+            return False
+        return network_graph.is_pending(auth.id, self.id)
 
     def invite(self, account):
         """
@@ -284,6 +268,7 @@ class Community(Account):
         if not self.can_edit:
             raise PermissionDenied("You can't name somebody as a community manager")
         Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = True)
+        network_graph.invalidate(account.id, self.id)
 
     def unset_as_manager(self, account):
         """
@@ -295,6 +280,7 @@ class Community(Account):
         if auth.id == account.id:
             raise PermissionDenied("You can't ban yourself from the community managers")
         Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = False)
+        network_graph.invalidate(account.id, self.id)
 
 
 class GlobalCommunity(Community):
@@ -342,3 +328,21 @@ class AdminCommunity(Community):
         """Return main (and only) system account. Will raise if several are set."""
         return cls.objects.get()
 
+
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def invalidate_site_config(sender, instance, **kw):
+    """
+    The site configuration snapshot (see lib.utils.SiteConfig) comes from the GlobalCommunity.
+    """
+    if isinstance(instance, GlobalCommunity):
+        utils.site_config.invalidate()
+
+def site_saved(sender, instance, **kw):
+    utils.site_config.invalidate()
+
+twistable_post_save.connect(invalidate_site_config)
+post_save.connect(site_saved, sender = Site)
@@ -1,5 +1,7 @@
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_delete, class_prepared
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.utils import html, translation
@@ -7,7 +9,9 @@ import twistable
 from account import Account
 from resource import Resource
 from twistranet.twistapp.lib import roles, permissions
+from twistranet.twistapp.lib.bulk import get_bulk_state
 from twistranet.twistapp.signals import *
+from twistranet.core import caches
 
 class ContentManager(twistable.TwistableManager):
     """
@@ -50,6 +54,64 @@ class ContentManager(twistable.TwistableManager):
         - my own content ;
         """
         return self.filter(self.get_follow_filter()).distinct()
+
+    def timeline(self, account = None, before = None):
+        """
+        Same content as followed (minus comments), but read from the denormalized timeline
+        (see models/timeline.py). No join on Network, no distinct().
+        If before is given, only content with an id lower than it is returned.
+        """
+        if account is None:
+            account = self._getAuthenticatedAccount()
+        qs = self.filter(timeline_entries__account__id = account.id)
+        if before is not None:
+            qs = qs.filter(id__lt = before)
+        return qs
+
+    def prefetch_summaries(self, contents, n_comments = 2):
+        """
+        Fetch what summary views display for a whole page of content at once:
+        comment counts, last comments and display owners (for contents and their comments).
+        Results are stored on each object (see last_comments, comment_count and owner_for_display),
+        so rendering the page doesn't issue queries for each item.
+        """
+        from twistranet.content_types.models import Comment
+        from community import Community
+        from network import network_graph
+        contents = [ c for c in contents if c.id ]
+        if not contents:
+            return
+        
+        # Comment ids of each root content, newest first. We only load the last ones.
+        comment_ids = {}
+        for comment_id, root_id in Comment.objects.filter(
+            root_content__id__in = [ c.id for c in contents ],
+        ).order_by("-id").values_list("id", "root_content"):
+            comment_ids.setdefault(root_id, []).append(comment_id)
+        last_ids = []
+        for ids in comment_ids.values():
+            last_ids.extend(ids[:n_comments])
+        comments = {}
+        if last_ids:
+            for comment in Comment.objects.filter(id__in = last_ids).select_related("owner", "publisher"):
+                comments[comment.id] = comment
+        for content in contents:
+            ids = comment_ids.get(content.id, [])
+            content._c_comment_count = len(ids)
+            last = [ comments[i] for i in ids[:n_comments] if i in comments ]
+            last.reverse()
+            content._c_last_comments = last
+        
+        # Display owners: load the network nodes they depend on at once
+        displayed = contents + comments.values()
+        node_ids = set()
+        for content in displayed:
+            if issubclass(content.publisher.model_class, Community):
+                node_ids.add(content.owner_id)
+                node_ids.add(content.publisher_id)
+        network_graph.preload(node_ids)
+        for content in displayed:
+            content.owner_for_display()
                         
 
 class _AbstractContent(twistable.Twistable):
@@ -114,10 +176,22 @@ class Content(_AbstractContent):
 
     @property
     def last_comments(self,):
+        _c = getattr(self, '_c_last_comments', None)
+        if _c is not None:
+            return _c
         if hasattr(self, 'comments'):
             comments = list(self.comments.order_by('-id')[:2])
             comments.reverse()
             return comments
+
+    @property
+    def comment_count(self,):
+        _c = getattr(self, '_c_comment_count', None)
+        if _c is not None:
+            return _c
+        if hasattr(self, 'comments'):
+            return self.comments.count()
+        return 0
         
     class Meta:
         app_label = 'twistapp'
@@ -165,14 +239,19 @@ class Content(_AbstractContent):
         #       - be a member of the publisher ;    (ie. content published on a community)
         #   The comments have one more rule : all the parents that are not in this list are notified
         #   (but this is treated in the Comment class).
-        if creation:
+        # Bulk loads don't notify anybody (see lib/bulk.py).
+        if creation and get_bulk_state() is None:
             if self.model_class.type_text_template_creation:
                 listeners = self.listeners
-                if listeners:
+                if isinstance(listeners, QuerySet):
+                    has_listeners = listeners.exists()      # Don't fetch a whole community here
+                else:
+                    has_listeners = bool(listeners)
+                if has_listeners:
                     content_created.send(
                         sender = self.__class__, 
                         instance = self, 
-                        target = self.listeners,
+                        target = listeners,
                         text_template = self.model_class.type_text_template_creation,
                         html_template = self.model_class.type_html_template_creation,
                     )
@@ -226,13 +305,46 @@ class Content(_AbstractContent):
             return _c
         from community import Community
         from account import SystemAccount
+        from network import network_graph
         display = self.owner
         if issubclass(self.owner.model_class, SystemAccount):
             if self.publisher:
                 display = self.publisher
         if issubclass(self.publisher.model_class, Community):
-            if self.publisher.community.isMember(self.owner):
+            # Same as self.publisher.community.isMember(self.owner), without loading the community
+            if network_graph.is_member(self.owner_id, self.publisher_id):
                 display = self.publisher
         setattr(self, '_c_owner_for_display', display)
         return display
 
+
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def invalidate_summary(sender, instance, **kw):
+    """
+    A content's summary fragments change with it and with its comments (see templatetags.fragments).
+    They also display accounts (their title and picture), which have a summary version of their own.
+    """
+    if isinstance(instance, Account):
+        caches.SummaryCache(instance.id).bump_version()
+        return
+    if not isinstance(instance, Content):
+        return
+    caches.SummaryCache(instance.id).bump_version()
+    root_id = getattr(instance, "root_content_id", None)
+    if root_id:
+        caches.SummaryCache(root_id).bump_version()
+
+def connect_summary_invalidation(sender, **kw):
+    """
+    Listen to the deletion of each content type only, not to every post_delete.
+    """
+    if issubclass(sender, Content):
+        post_delete.connect(invalidate_summary, sender = sender)
+
+twistable_post_save.connect(invalidate_summary)
+post_delete.connect(invalidate_summary, sender = Content)
+class_prepared.connect(connect_summary_invalidation)
@@ -1,14 +1,164 @@
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
+from twistranet.core import caches
+from twistranet.twistapp.lib import auth_context
 from twistranet.twistapp.models import Content
 from twistranet.twistapp.models import Account
 
 
 class NetworkManager(object):
     """
-    Set of methods to handle relations and cache them
-    XXX TODO with pickling and replace Account & Community methods
+    Set of methods to handle relations and cache them.
+    
+    Each account is a node holding the relations it initiated ('out') and the ones
+    targeting it ('in'), both as {account_id: is_manager} dicts. A relation is approved
+    when it's symetrical (A => B and B => A), pending otherwise.
+    Nodes are stored in the cache (see caches.NetworkGraphCache) and memoized for the
+    current request. They're invalidated each time a relation changes (see invalidate_network below),
+    so that questions are answered without SQL once a node is loaded.
     """
+    def node(self, account_id):
+        """
+        Return the (out, in) dicts of the given account.
+        """
+        memo = auth_context.request_cache("network")
+        if memo is not None and account_id in memo:
+            return memo[account_id]
+        c = caches.NetworkGraphCache(account_id)
+        node = c.node
+        if node is None:
+            out_rel, in_rel = {}, {}
+            for client_id, target_id, is_manager in Network.objects.filter(
+                Q(client__id = account_id) | Q(target__id = account_id)
+            ).values_list("client", "target", "is_manager"):
+                if client_id == account_id:
+                    out_rel[target_id] = is_manager
+                if target_id == account_id:
+                    in_rel[client_id] = is_manager
+            node = c.node = (out_rel, in_rel)
+        if memo is not None:
+            memo[account_id] = node
+        return node
+        
+    def preload(self, account_ids):
+        """
+        Load the given nodes at once. The ones that are not in the cache are fetched with a single query.
+        """
+        memo = auth_context.request_cache("network")
+        missing = []
+        for account_id in set(account_ids):
+            if memo is not None and account_id in memo:
+                continue
+            node = caches.NetworkGraphCache(account_id).node
+            if node is None:
+                missing.append(account_id)
+            elif memo is not None:
+                memo[account_id] = node
+        if not missing:
+            return
+        nodes = dict([ (account_id, ({}, {})) for account_id in missing ])
+        for client_id, target_id, is_manager in Network.objects.filter(
+            Q(client__id__in = missing) | Q(target__id__in = missing)
+        ).values_list("client", "target", "is_manager"):
+            if client_id in nodes:
+                nodes[client_id][0][target_id] = is_manager
+            if target_id in nodes:
+                nodes[target_id][1][client_id] = is_manager
+        for account_id, node in nodes.items():
+            caches.NetworkGraphCache(account_id).node = node
+            if memo is not None:
+                memo[account_id] = node
+        
+    def invalidate(self, *account_ids):
+        """
+        Drop the given nodes. Call this each time a relation between them changes.
+        """
+        memo = auth_context.request_cache("network")
+        for account_id in account_ids:
+            caches.NetworkGraphCache(account_id).invalidate()
+            if memo is not None:
+                memo.pop(account_id, None)
+                
+    def version(self, account_id):
+        """
+        A stamp of the given node, which changes with its relations. The node isn't loaded.
+        """
+        return caches.NetworkGraphCache(account_id).get_node_version()
+        
+    def bump_version(self):
+        """
+        Drop the whole graph, for example after a bulk import.
+        """
+        caches.NetworkGraphCache.bump_version()
+        auth_context.clear_request_cache("network")
+
+    def is_following(self, client_id, target_id):
+        """
+        True if there's a client => target relation, approved or not.
+        """
+        return target_id in self.node(client_id)[0]
+        
+    def is_member(self, account_id, community_id, is_manager = False):
+        """
+        True if account and community are in an approved relation.
+        If is_manager is set, account has to be a manager of community as well.
+        """
+        out_rel, in_rel = self.node(account_id)
+        if not (community_id in out_rel and community_id in in_rel):
+            return False
+        return not is_manager or out_rel[community_id]
+        
+    def is_pending(self, account_id, requester_id):
+        """
+        True if requester asked to be in relation with account, and account didn't approve it yet.
+        """
+        out_rel, in_rel = self.node(account_id)
+        return requester_id in in_rel and not requester_id in out_rel
+        
+    def approved_ids(self, account_id):
+        """
+        Accounts in an approved relation with the given one (excluding itself).
+        For a community, that's its members.
+        """
+        out_rel, in_rel = self.node(account_id)
+        return frozenset([ i for i in in_rel if i in out_rel and i != account_id ])
+        
+    def manager_ids(self, community_id):
+        """
+        Members having the manager flag on the given community.
+        """
+        out_rel, in_rel = self.node(community_id)
+        return frozenset([ i for i, is_manager in in_rel.items() if is_manager and i in out_rel ])
+        
+    def pending_ids(self, account_id):
+        """
+        Accounts waiting for the given one to approve their relation.
+        """
+        out_rel, in_rel = self.node(account_id)
+        return frozenset([ i for i in in_rel if not i in out_rel ])
+        
+    # The same sets as subqueries, to build querysets without loading (possibly huge) nodes
+    # nor inlining their ids.
+    
+    def approved_query(self, account_id):
+        return Network.objects.filter(
+            target__id = account_id,
+            client__in = Network.objects.filter(client__id = account_id).values("target"),
+        ).exclude(client__id = account_id).values("client")
+        
+    def manager_query(self, community_id):
+        return self.approved_query(community_id).filter(is_manager = True)
+        
+    def pending_query(self, account_id):
+        return Network.objects.filter(
+            target__id = account_id,
+        ).exclude(
+            client__in = Network.objects.filter(client__id = account_id).values("target"),
+        ).values("client")
+
+network_graph = NetworkManager()
     
 
 class Network(models.Model):
@@ -74,4 +224,15 @@ class Network(models.Model):
         unique_together = ("client", "target", )
 
 
+def invalidate_network(sender, instance, **kw):
+    """
+    A relation changes both ends of the network graph and the principal set of its target,
+    and therefore the permissions memoized for the current request.
+    Note that queryset's update() doesn't trigger this: call network_graph.invalidate() yourself.
+    """
+    network_graph.invalidate(instance.client_id, instance.target_id)
+    caches.PrincipalsCache(instance.target_id).invalidate()
+    auth_context.clear_request_cache("permissions")
 
+post_save.connect(invalidate_network, sender = Network)
+post_delete.connect(invalidate_network, sender = Network)
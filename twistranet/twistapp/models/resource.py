@@ -1,11 +1,22 @@
+from __future__ import with_statement
 import os
 import mimetypes
+import threading
+try:
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.db.models import Q, FileField
 from django.core.exceptions import ObjectDoesNotExist, ValidationError, PermissionDenied, SuspiciousOperation
 
 from twistranet.twistorage.storage import Twistorage
 from twistranet.twistapp.lib import languages, permissions
+from twistranet.twistapp.lib.bulk import get_bulk_state
+from twistranet.twistapp.lib.thumbnails import get_thumbnail_pool
+from twistranet.core import caches
 from  twistranet.twistapp.lib.log import *
 import twistable
 
@@ -27,6 +38,74 @@ class ResourceModelManager(twistable.TwistableManager):
         
         return accounts
 
+    def store_thumbnail_urls(self, resource_id, urls):
+        """
+        Save the { name: url } thumbnails of a resource, without loading (nor re-saving) it.
+        Return False if there's no such resource.
+        """
+        if not self.__booster__.filter(id = resource_id).update(thumbnail_urls = json.dumps(urls)):
+            return False
+        caches.PictureCache(resource_id).thumbnail_urls = urls
+        return True
+
+
+class DefaultPictureRegistry(object):
+    """
+    Process-wide slug => Resource registry of the default pictures and mimetype icons.
+    Each slug is loaded once (missing ones are remembered too).
+    Saving or deleting one of those resources (or renaming a resource) bumps a version in the shared cache,
+    which empties the registry of every process.
+    Those resources are public, so we don't go through the secured manager.
+    """
+    # Mimetype icons are named after the mimetype, eg. 'image_png'
+    MIMETYPE_ICON_PREFIXES = ("application", "audio", "chemical", "image", "message", "model", "multipart", "text", "video", )
+
+    def __init__(self):
+        self._resources = {}
+        self._version = None
+        self._lock = threading.Lock()
+        
+    def get(self, slug):
+        """
+        Return the resource with the given slug, or None.
+        """
+        if not slug:
+            return None
+        version = caches.DefaultPicturesCache.get_version()
+        with self._lock:
+            if version != self._version:
+                self._resources = {}
+                self._version = version
+            if not self._resources.has_key(slug):
+                try:
+                    self._resources[slug] = Resource.objects.__booster__.get(slug = slug)
+                except Resource.DoesNotExist:
+                    self._resources[slug] = None
+            return self._resources[slug]
+            
+    def invalidate(self):
+        caches.DefaultPicturesCache.bump_version()
+        
+    def is_registry_slug(self, slug):
+        """
+        True if slug is (or looks like) a default picture or mimetype icon slug.
+        """
+        if not slug:
+            return False
+        return slug.startswith("default_") or slug.startswith("x-") or slug.split("_", 1)[0] in self.MIMETYPE_ICON_PREFIXES
+        
+    def resource_changed(self, resource):
+        """
+        Empty the registry if it may hold resource.
+        """
+        previous_slug = resource._registry_slug
+        resource._registry_slug = resource.slug
+        renamed = previous_slug is not None and previous_slug != resource.slug
+        if renamed or self.is_registry_slug(resource.slug):
+            self.invalidate()
+
+default_pictures = DefaultPictureRegistry()
+
 def twistorage_upload_to(instance, filename):
     """
     Upload to the instance's publisher's account.
@@ -57,6 +136,9 @@ class Resource(twistable.Twistable):
     filename = models.CharField(max_length = 255, blank = True)     # http://en.wikipedia.org/wiki/Comparison_of_file_systems
     mimetype = models.CharField(max_length = 64)
     encoding = models.CharField(max_length = 64, blank = True)
+    
+    # Pre-generated thumbnails, as a JSON { name: url } dict. See lib.thumbnails.
+    thumbnail_urls = models.TextField(blank = True, default = "")
 
     # Resource securization
     permission_templates = permissions.content_templates        # This is the lazy man's solution, we use same perms as content ;)
@@ -67,15 +149,30 @@ class Resource(twistable.Twistable):
     class Meta:
         app_label = 'twistapp'
 
+    def __init__(self, *args, **kw):
+        super(Resource, self).__init__(*args, **kw)
+        # The file our stored thumbnails were rendered from
+        self._thumbnailed_file = self._get_thumbnail_source()
+        # The slug default_pictures may know this resource by
+        self._registry_slug = self.slug
+
+    def _get_thumbnail_source(self):
+        return (self.resource_file and self.resource_file.name or None, self.resource_url, )
+
     def save(self, *args, **kw):
         """
         Properly set title if not set.
+        Stored thumbnails are dropped if the file changed, they'll be rendered again after saving.
         """
         if not self.title:
             if self.resource_file:
                 self.title = self._pretty_title(self.resource_file.name)
         self.mimetype = self.content_type
-        return super(Resource, self).save(*args, **kw)
+        if self._get_thumbnail_source() != self._thumbnailed_file:
+            self.thumbnail_urls = ""
+        ret = super(Resource, self).save(*args, **kw)
+        self._thumbnailed_file = self._get_thumbnail_source()
+        return ret
         
     def _pretty_title(self, raw_filename):
         """XXX TODO: transform raw filename into a pretty title
@@ -111,13 +208,25 @@ class Resource(twistable.Twistable):
         if self.resource_url:
             return self.mimetype_icon
 
+    @property
+    def stored_thumbnail_urls(self):
+        """
+        The { name: url } dict of pre-generated thumbnails (may be empty or partial).
+        """
+        if not self.thumbnail_urls:
+            return {}
+        try:
+            return json.loads(self.thumbnail_urls)
+        except ValueError:
+            log.warning("Invalid stored thumbnails for resource %s" % self.id)
+            return {}
+
     @property
     def mimetype_icon(self):
         mimetype_slug = self.mimetype.replace('/','_').replace('.','_')
-        try:
-            src = Resource.objects.get(slug = mimetype_slug)
-        except:
-            src = Resource.objects.get(slug = self.default_picture_resource_slug)
+        src = default_pictures.get(mimetype_slug) or default_pictures.get(self.default_picture_resource_slug)
+        if src is None:
+            raise Resource.DoesNotExist("No icon for %s" % self.mimetype)
         return src.image
 
     @property
@@ -134,6 +243,38 @@ class Resource(twistable.Twistable):
         return ct
 
 
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def pregenerate_thumbnails(sender, instance, **kw):
+    """
+    Render the standard thumbnails of a freshly saved resource (unless they're already stored).
+    Bulk loads don't do that, run twistranet_thumbnails afterwards.
+    """
+    default_pictures.resource_changed(instance)
+    if instance.thumbnail_urls or get_bulk_state() is not None:
+        return
+    caches.PictureCache(instance.id).invalidate()
+    try:
+        urls = get_thumbnail_pool().submit(instance)
+    except:
+        # Eg. the mimetype icons aren't there yet. Thumbnails will then be rendered on demand.
+        log.exception("Unable to pre-generate thumbnails of resource %s" % instance.id)
+        return
+    if urls:
+        instance.thumbnail_urls = json.dumps(urls)
+
+def resource_deleted(sender, instance, **kw):
+    if default_pictures.is_registry_slug(instance._registry_slug):
+        default_pictures.invalidate()
+    caches.PictureCache(instance.id).invalidate()
+
+post_save.connect(pregenerate_thumbnails, sender = Resource)
+post_delete.connect(resource_deleted, sender = Resource)
+
+
 # class ImageResource(Resource):
 #     """
 #     An ImageResource if a File with dedicated Image features.
@@ -0,0 +1,177 @@
+"""
+Denormalized (fan-out-on-write) timelines.
+
+Each time a content is created, its id is pushed to the timeline of its publisher
+and of every account having a relation towards the publisher (ie. its followers
+and, for a community, its members). Reading the homepage then becomes a single
+indexed range scan on (account, content) instead of a join on Network + a distinct().
+
+Security is NOT stored here: timelines are always read through the secured
+Content manager (see ContentManager.timeline()).
+"""
+from django.db import models, connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+from twistable import Twistable
+from account import Account
+from content import Content
+from network import Network
+from twistranet.twistapp.signals import twistable_post_save, twistables_bulk_created
+
+
+class TimelineManager(models.Manager):
+    """
+    Write-side of the timelines. Every write to the timeline table goes through
+    those methods, so that another storage (eg. a Redis sorted set) could be plugged in.
+    """
+    def _insert(self, rows):
+        """
+        Insert (account_id, content_id, publisher_id) rows at once.
+        """
+        if not rows:
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany(
+            "INSERT INTO %s (account_id, content_id, publisher_id) VALUES (%%s, %%s, %%s)" % qn(self.model._meta.db_table),
+            rows,
+        )
+        transaction.commit_unless_managed()
+
+    def fan_out(self, content):
+        """
+        Push a freshly created content to its publisher's timeline and to the timeline
+        of each account in a relation with the publisher. That's a single INSERT ... SELECT.
+        """
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO %(timeline)s (account_id, content_id, publisher_id)
+                SELECT client_id, %%s, %%s FROM %(network)s WHERE target_id = %%s
+                UNION
+                SELECT %%s, %%s, %%s
+            """ % {
+                "timeline": qn(self.model._meta.db_table),
+                "network":  qn(Network._meta.db_table),
+            },
+            (
+                content.id, content.publisher_id, content.publisher_id,
+                content.publisher_id, content.id, content.publisher_id,
+            ),
+        )
+        transaction.commit_unless_managed()
+
+    def fan_out_many(self, content_ids):
+        """
+        Same as fan_out(), for many contents at once (eg. after a bulk load).
+        """
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for i in range(0, len(content_ids), 500):
+            chunk = content_ids[i:i + 500]
+            in_clause = ", ".join([ "%s" ] * len(chunk))
+            cursor.execute("""
+                INSERT INTO %(timeline)s (account_id, content_id, publisher_id)
+                    SELECT n.client_id, t.id, t.publisher_id FROM %(twistable)s t
+                        INNER JOIN %(network)s n ON n.target_id = t.publisher_id
+                        WHERE t.id IN (%(in)s)
+                    UNION
+                    SELECT t.publisher_id, t.id, t.publisher_id FROM %(twistable)s t
+                        WHERE t.id IN (%(in)s)
+                """ % {
+                    "timeline":     qn(self.model._meta.db_table),
+                    "twistable":    qn(Twistable._meta.db_table),
+                    "network":      qn(Network._meta.db_table),
+                    "in":           in_clause,
+                },
+                chunk + chunk,
+            )
+        transaction.commit_unless_managed()
+
+    def backfill(self, account_id, publisher_id, limit = None):
+        """
+        Copy the most recent content of publisher to account's timeline.
+        Used when account starts following publisher.
+        """
+        if limit is None:
+            limit = getattr(settings, "TWISTRANET_TIMELINE_BACKFILL", 100)
+        content_ids = Content.objects.__booster__.filter(
+            publisher__id = publisher_id,
+        ).exclude(model_name = "Comment").order_by("-id").values_list("id", flat = True)[:limit]
+        existing = set(self.filter(
+            account__id = account_id,
+            publisher__id = publisher_id,
+        ).values_list("content", flat = True))
+        self._insert([
+            (account_id, content_id, publisher_id)
+            for content_id in content_ids
+            if content_id not in existing
+        ])
+
+    def forget(self, account_id, publisher_id):
+        """
+        Remove publisher's content from account's timeline.
+        Used when account stops following publisher.
+        """
+        self.filter(account__id = account_id, publisher__id = publisher_id).delete()
+
+    def rebuild(self, account, limit = None):
+        """
+        Rebuild account's timeline from scratch, from its current relations.
+        """
+        self.filter(account__id = account.id).delete()
+        publisher_ids = set(Network.objects.filter(client__id = account.id).values_list("target", flat = True))
+        publisher_ids.add(account.id)
+        for publisher_id in publisher_ids:
+            self.backfill(account.id, publisher_id, limit = limit)
+
+
+class TimelineEntry(models.Model):
+    """
+    'content' appears on the timeline of 'account'.
+    publisher is denormalized here so that unfollowing doesn't need a join.
+    """
+    account = models.ForeignKey(Account, related_name = "+")
+    content = models.ForeignKey(Content, related_name = "timeline_entries")
+    publisher = models.ForeignKey(Account, related_name = "+")
+
+    objects = TimelineManager()
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.account_id, self.content_id, )
+
+    class Meta:
+        app_label = 'twistapp'
+        # The unique index on (account, content) is the one our range scans use.
+        unique_together = ("account", "content", )
+
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def fan_out_content(sender, instance, created, **kw):
+    """
+    Content is fanned out on creation only. Comments are never displayed on timelines.
+    """
+    if created and isinstance(instance, Content) and not instance.model_name == "Comment":
+        TimelineEntry.objects.fan_out(instance)
+
+def fan_out_bulk(sender, instances, **kw):
+    TimelineEntry.objects.fan_out_many([
+        instance.id for instance in instances
+        if isinstance(instance, Content) and not instance.model_name == "Comment"
+    ])
+
+def follow_publisher(sender, instance, created, **kw):
+    if created:
+        TimelineEntry.objects.backfill(instance.client_id, instance.target_id)
+
+def unfollow_publisher(sender, instance, **kw):
+    if instance.client_id != instance.target_id:
+        TimelineEntry.objects.forget(instance.client_id, instance.target_id)
+
+twistable_post_save.connect(fan_out_content)
+twistables_bulk_created.connect(fan_out_bulk)
+post_save.connect(follow_publisher, sender = Network)
+post_delete.connect(unfollow_publisher, sender = Network)
@@ -14,19 +14,26 @@ import re
 import inspect
 import logging
 import traceback
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models import Q, loading
 from django.db.utils import DatabaseError
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied, ObjectDoesNotExist
 from django.utils.safestring import mark_safe
 
 from  twistranet.twistapp.lib.log import log
-from twistranet.twistapp.lib import roles, permissions
-from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib import roles, permissions, auth_context
+from twistranet.twistapp.lib.slugify import slugify, get_slug_allocator, SlugAllocator
+from twistranet.twistapp.lib.bulk import get_bulk_state
+from twistranet.twistapp.lib.thumbnails import Thumbnails
 from twistranet.twistapp.signals import twistable_post_save
+from twistranet.core import caches
 from fields import ResourceField, PermissionField, TwistableSlugField
 
+# Number of slugs we try when concurrent inserts take ours
+SLUG_RETRIES = 5
+
 class TwistableManager(models.Manager):
     """
     It's the base of the security model!!
@@ -69,19 +76,16 @@ class TwistableManager(models.Manager):
             log.warning("DB error while checking AdminCommunity. This is NORMAL during syncdb or bootstrap.")
             return base_query_set
 
-        # Regular check. Works for anonymous as well...
-        # network_ids = __account__.network_ids
+        # Regular check, against the account's (cached) principal set.
+        # That's only a few predicates on Twistable columns: no join, no distinct().
         if not __account__.is_anonymous:
             qs = base_query_set.filter(
                 Q(
                     owner__id = __account__.id,
                     _p_can_list = roles.owner,
                 ) | Q(
-                    _access_network__targeted_network__target = __account__,
-                    _p_can_list = roles.network,
-                ) | Q(
-                    _access_network__targeted_network__target = __account__,
-                    _p_can_list = roles.public,
+                    _access_network__in = __account__.principal_ids,
+                    _p_can_list__in = (roles.network, roles.public, ),
                 ) | Q(
                     # Anonymous stuff
                     _access_network__isnull = True,
@@ -90,11 +94,7 @@ class TwistableManager(models.Manager):
             )
         else:
             # Anon query. Easy: We just return public stuff.
-            # Warning: nested query is surely inefficient...
-            free_access_network = Twistable.objects.__booster__.filter(
-                _access_network__isnull = True,
-                _p_can_list = roles.public,
-            )
+            # The free access networks are a subquery: they're about as many as public accounts.
             qs = base_query_set.filter(
                 Q(
                     # Strictly anonymous stuff
@@ -102,12 +102,21 @@ class TwistableManager(models.Manager):
                     _p_can_list = roles.public,
                 ) | Q(
                     # Incidently anonymous stuff (public stuff published by an anon account)
-                    _access_network__isnull = False,
-                    _access_network__id__in = free_access_network,
+                    _access_network__in = self._getFreeAccessNetworks(),
                     _p_can_list = roles.public,
                 )
             )
         return qs
+        
+    def _getFreeAccessNetworks(self, ):
+        """
+        Return the accounts anonymous users can see through, ie. public accounts without
+        any access network, as a subquery.
+        """
+        return Twistable.objects.__booster__.filter(
+            _access_network__isnull = True,
+            _p_can_list = roles.public,
+        ).values("id")
                 
     def getCurrentAccount(self, request):
         """
@@ -129,11 +138,14 @@ class TwistableManager(models.Manager):
                 
     def _getAuthenticatedAccount(self, __account__ = None, request = None):
         """
-        Dig the stack to find the authenticated account object.
+        Return the authenticated account object.
         Return either a (possibly generic) account object or None.
         
-        Views with a "request" parameter magically works with that.
-        If you want to use a system account, declare a '__account__' variable in your caller function.
+        Lookup order is:
+        - the explicit '__account__' or 'request' parameters ;
+        - the innermost acting_as() block (see lib/auth_context.py) ;
+        - the request bound by AuthContextMiddleware ;
+        - if TWISTRANET_AUTH_STACK_FALLBACK is set, the former stack-digging method.
         """
         from account import Account, AnonymousAccount, UserAccount
 
@@ -144,15 +156,39 @@ class TwistableManager(models.Manager):
         # If we have the request object, then we just can use getCurrentAccount() instead
         if request:
             return self.getCurrentAccount(request)
+            
+        # Explicit authentication context
+        acting = auth_context.get_acting_account()
+        if acting is not None:
+            return acting
+        request = auth_context.get_bound_request()
+        if request is not None:
+            return self.getCurrentAccount(request)
+            
+        # Opt-in (and counted) fallback
+        if getattr(settings, "TWISTRANET_AUTH_STACK_FALLBACK", False):
+            auth_context.count_stack_walk()
+            return self._digAuthenticatedAccount()
+
+        # Didn't find anything. We must be anonymous.
+        return AnonymousAccount()
+
+    def _digAuthenticatedAccount(self, ):
+        """
+        Dig the stack to find the authenticated account object.
+        
+        Views with a "request" parameter magically works with that.
+        If you want to use a system account, declare a '__account__' variable in your caller function.
+        This is slow, use acting_as() instead.
+        """
+        from account import Account, AnonymousAccount, UserAccount
 
         # We dig into the stack frame to find the request object.
         frame = inspect.currentframe()
         try:
             while frame:
-                frame_members = dict(inspect.getmembers(frame))
-                
                 # Inspect 'locals' variables to get the request or __account__
-                _locals = frame_members.get('f_locals', None)
+                _locals = frame.f_locals
                 if _locals:
                     # Check for an __acount__ variable holding a generic Account object. It always has precedence over 'request'
                     if _locals.has_key('__account__') and isinstance(_locals['__account__'], Account):
@@ -162,15 +198,10 @@ class TwistableManager(models.Manager):
                     if _locals.has_key('request'):
                         u = getattr(_locals['request'], 'user', None)
                         if isinstance(u, User):
-                            # We use this instead of the get_profile() method to avoid an infinite recursion here.
-                            # We mimic the _profile_cache behavior of django/contrib/auth/models.py to avoid doing a lot of requests on the same object
-                            if not hasattr(u, '_account_cache'):
-                                u._account_cache = UserAccount.objects.__booster__.get(user__id__exact = u.id)
-                                u._account_cache.user = u
-                            return u._account_cache
+                            return self.getCurrentAccount(_locals['request'])
             
                 # Get back to the upper frame
-                frame = frame_members.get('f_back', None)
+                frame = frame.f_back
                         
             # Didn't find anything. We must be anonymous.
             return AnonymousAccount()
@@ -178,8 +209,7 @@ class TwistableManager(models.Manager):
         finally:
             # Avoid circular refs
             frame = None
-            stack = None
-            del _locals
+            _locals = None
 
 
     # Backdoor for performance purposes. Use it at your own risk as it breaks security.
@@ -271,6 +301,14 @@ class Twistable(_AbstractTwistable):
     _ALLOW_NO_PUBLISHER = False         # Prohibit creation of an object of this class with publisher = None.
     _FORCE_SLUG_CREATION = True         # Force creation of a slug if it doesn't exist
     
+    def __init__(self, *args, **kw):
+        super(Twistable, self).__init__(*args, **kw)
+        # What the access network of dependant objects depends on, as loaded (see _update_access_network)
+        self._access_snapshot = self._get_access_snapshot()
+        
+    def _get_access_snapshot(self):
+        return (self.id, self._p_can_list, self._access_network_id, self.publisher_id, )
+    
     @property
     def kind(self):
         """
@@ -320,22 +358,36 @@ class Twistable(_AbstractTwistable):
         """
         Return actual picture for this content or default picture if not available.
         May return None!
-        XXX SHOULD CACHE THIS
+        Default pictures come from the process-wide resource.default_pictures registry.
         """
+        if hasattr(self, "_c_forced_picture"):
+            return self._c_forced_picture
         import resource
         if issubclass(self.model_class, resource.Resource):
-            return self.object
-        try:
-            picture = self.picture
-            if picture is None:
-                raise resource.Resource.DoesNotExist()
-        except resource.Resource.DoesNotExist:
+            picture = self.object
+        else:
             try:
-                picture = resource.Resource.objects.get(slug = self.model_class.default_picture_resource_slug)
+                picture = self.picture
+                if picture is None:
+                    raise resource.Resource.DoesNotExist()
             except resource.Resource.DoesNotExist:
-                return None
+                picture = resource.default_pictures.get(self.model_class.default_picture_resource_slug)
+        self._c_forced_picture = picture
         return picture
         
+    @property
+    def forced_picture_id(self,):
+        """
+        Id of forced_picture, without loading it if possible.
+        """
+        import resource
+        if issubclass(self.model_class, resource.Resource):
+            return self.id
+        if self.picture_id is not None:
+            return self.picture_id
+        picture = resource.default_pictures.get(self.model_class.default_picture_resource_slug)
+        return picture and picture.id
+        
     def get_thumbnail(self, *args, **kw):
         """
         Same arguments as sorl's get_thumbnail method.
@@ -346,30 +398,21 @@ class Twistable(_AbstractTwistable):
         except:
             # in rare situations (CMJK + PNG mode, sorl thumbnail raise an error)
             import resource
-            picture = resource.Resource.objects.get(slug = self.model_class.default_picture_resource_slug)
+            picture = resource.default_pictures.get(self.model_class.default_picture_resource_slug)
+            if picture is None:
+                raise
             return default.backend.get_thumbnail(picture.image, *args, **kw)
         
     @property
     def thumbnails(self,):
         """
-        Return a dict of standard thumbnails methods.
-        XXX TODO: Cache this! And use lazy resolution!
+        Return the (lazy) dict of standard thumbnails, see lib.thumbnails.THUMBNAIL_SIZES.
+        Each size is resolved on first access only, from the URLs stored on the picture if possible.
         Some day resources will be able to have several DIFFERENT previews...
-        
-        Preview: Max = 500x500; Used when a large version should be available.
-        Summary: Max = 100x100;
-        Summary Preview: Max = Min = 100x100;
-        Medium:  Max = Min = 50x50;
-        Icon:    Max = Min = 16x16;
-        """
-        return {
-            "preview":           self.get_thumbnail("500x500", crop = "", upscale = False),
-            "summary":           self.get_thumbnail("100x100", crop = "", upscale = False),
-            "summary_preview":   self.get_thumbnail("100x100", crop = "center top", upscale = True),
-            "medium":            self.get_thumbnail("50x50", crop = "center top", upscale = True),
-            "big_icon":          self.get_thumbnail("32x32", upscale = False),
-            "icon":              self.get_thumbnail("16x16", crop = "center top", upscale = True),
-        }
+        """
+        if not hasattr(self, "_c_thumbnails"):
+            self._c_thumbnails = Thumbnails(self)
+        return self._c_thumbnails
                 
             
     #                                                                   #
@@ -384,6 +427,11 @@ class Twistable(_AbstractTwistable):
         import community
         
         auth = Twistable.objects._getAuthenticatedAccount()
+        
+        # The picture may change: forget what we knew about it
+        for attr in ("_c_forced_picture", "_c_thumbnails", ):
+            if hasattr(self, attr):
+                delattr(self, attr)
 
         # Check if we're saving a real object and not a generic Content one (which is prohibited).
         # This must be a programming error, then.
@@ -459,26 +507,82 @@ class Twistable(_AbstractTwistable):
                 self.slug = slugify(self.model_name)
             self.slug = self.slug[:40]
         if created and self.__class__._FORCE_SLUG_CREATION:
-            while Twistable.objects.__booster__.filter(slug = self.slug).exists():
-                match = re.search("_(?P<num>[0-9]+)$", self.slug)
-                if match:
-                    root = self.slug[:match.start()]
-                    num = int(match.groupdict()['num']) + 1
-                else:
-                    root = self.slug
-                    num = 1
-                self.slug = "%s_%i" % (root, num, )
+            self.slug = get_slug_allocator().allocate(self.slug)
         
-        # Perform a full_clean on the model just to be sure it validates correctly
-        self.full_clean()
+        # Perform a full_clean on the model just to be sure it validates correctly.
+        # Bulk loads are trusted (see lib/bulk.py).
+        bulk = get_bulk_state()
+        if bulk is None:
+            self.full_clean()
             
-        # Save and update access network information
-        ret = super(Twistable, self).save(*args, **kw)
+        # Save. If we're inserting with an allocated slug and another process took it meanwhile,
+        # pick another one and retry. Only those inserts pay for a savepoint.
+        if created and self.__class__._FORCE_SLUG_CREATION:
+            ret = self._insert_with_slug(*args, **kw)
+        else:
+            ret = super(Twistable, self).save(*args, **kw)
+        
+        # Update access network information
         self._update_access_network()
 
-        # Send TN's post-save signal
-        twistable_post_save.send(sender = self.__class__, instance = self, created = created)
+        # Send TN's post-save signal. Bulk loads reconcile that at the end instead
+        # (twistables_bulk_created for new objects, twistable_post_save for updated ones).
+        if bulk is None:
+            twistable_post_save.send(sender = self.__class__, instance = self, created = created)
+        elif created:
+            bulk.created.append(self)
+            bulk.created_ids.add(self.id)
+        elif self.id not in bulk.created_ids:
+            bulk.updated[self.id] = self
         return ret
+        
+    def _insert_with_slug(self, *args, **kw):
+        """
+        Insert the object within a savepoint, allocating another slug if it's been taken meanwhile.
+        """
+        attempt = 0
+        while True:
+            sid = transaction.savepoint()
+            try:
+                ret = super(Twistable, self).save(*args, **kw)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                self._forget_insert()
+                attempt += 1
+                if attempt >= SLUG_RETRIES:
+                    raise
+                if not Twistable.objects.__booster__.filter(slug = self.slug).exists():
+                    raise       # Not a slug issue
+                self.slug = SlugAllocator().allocate(self.slug)
+            else:
+                transaction.savepoint_commit(sid)
+                return ret
+        
+    def _forget_insert(self):
+        """
+        Forget the primary keys set by a rolled back insert: with multi-table inheritance,
+        parent rows may have been inserted before the failing one.
+        """
+        self.id = None
+        for model in [ self.__class__, ] + list(self._meta.get_parent_list()):
+            for link in model._meta.parents.values():
+                if link is not None:
+                    setattr(self, link.attname, None)
+        
+    def _get_access_info(self, twistable_id):
+        """
+        Return (_p_can_list, _p_can_view, publisher_id) of the given twistable, as stored.
+        Memoized while bulk loading.
+        """
+        bulk = get_bulk_state()
+        if bulk is not None and bulk.access_info.has_key(twistable_id):
+            return bulk.access_info[twistable_id]
+        info = Twistable.objects.__booster__.filter(
+            id = twistable_id,
+        ).values_list("_p_can_list", "_p_can_view", "publisher")[0]
+        if bulk is not None:
+            bulk.access_info[twistable_id] = info
+        return info
 
     def _update_access_network(self, ):
         """
@@ -487,61 +591,85 @@ class Twistable(_AbstractTwistable):
         """
         # No id => this twistable doesn't control anything, we pass. Value will be set AFTER saving.
         import account, community
+        from access_network import propagate_access_network
         if not self.id:
             raise ValueError("Can't set _access_network before saving the object.")
             
         # Update current object. We save current access and determine the more restrictive _p_can_list access permission.
         # Remember that a published content has its permissions determined by its publisher's can_VIEW permission!
-        _current_access_network = self._access_network
-        obj = self.object
-        if issubclass(obj.model_class, account.Account):
+        # We work with ids only: no need to load the actual object or its publishers.
+        bulk = get_bulk_state()
+        if issubclass(self.model_class, account.Account):
             _p_can_list = self._p_can_list
         else:
-            _p_can_list = max(self._p_can_list, self.publisher and self.publisher._p_can_view or roles.public)
+            if bulk is not None and self.publisher_id:
+                publisher_can_view = self._get_access_info(self.publisher_id)[1]
+            else:
+                publisher_can_view = self.publisher and self.publisher._p_can_view
+            _p_can_list = max(self._p_can_list, publisher_can_view or roles.public)
+        access_network_id = self._access_network_id
+        dependant_network_id = self.id      # The access network public objects published on us will get
         
         # If restricted to content owner, no access network mentionned here.
         if _p_can_list in (roles.owner, ):
-            self._access_network = None     # XXX We have to double check this, esp. on the GlobalCommunity object.
+            access_network_id = None        # XXX We have to double check this, esp. on the GlobalCommunity object.
             
         # Network role: same as current network for an account, same as publisher's network for a content
         elif _p_can_list == roles.network:
-            if issubclass(obj.model_class, account.Account):
-                self._access_network = obj
+            if issubclass(self.model_class, account.Account):
+                access_network_id = self.id
             else:
-                self._access_network = self.publisher
+                access_network_id = self.publisher_id
             
         # Public content (or so it seems)
         elif _p_can_list == roles.public:
             # GlobalCommunity special case: if can_list goes public, then we can unrestrict the _access_network
             if issubclass(self.model_class, community.GlobalCommunity):
-                self._access_network = None     # Let's go public!
+                access_network_id = None    # Let's go public!
                 
             else:
-                # Regular treatment
-                obj = obj.publisher
-                while obj:
-                    if obj._p_can_list == roles.public:
-                        if obj == obj.publisher:
+                # Regular treatment: walk up the publishers until one restricts its listing
+                dependant_network_id = None
+                ancestor_id = self.publisher_id
+                while ancestor_id:
+                    can_list, can_view, publisher_id = self._get_access_info(ancestor_id)
+                    if can_list == roles.public:
+                        if publisher_id == ancestor_id:
                             # If an object is its own publisher (eg. GlobalCommunity),
                             # we avoid infinite recursions here.
+                            dependant_network_id = ancestor_id
                             break
-                        obj = obj.publisher
-                    elif obj._p_can_list in (roles.owner, roles.network, ):
-                        self._access_network = obj
+                        ancestor_id = publisher_id
+                    elif can_list in (roles.owner, roles.network, ):
+                        access_network_id = dependant_network_id = ancestor_id
                         break
                     else:
-                        raise ValueError("Unexpected can_list role found: %d on object %s" % (obj._p_can_list, obj))
+                        raise ValueError("Unexpected can_list role found: %d on object %s" % (can_list, ancestor_id))
         else:
-            raise ValueError("Unexpected can_list role found: %d on object %s" % (obj._p_can_list, obj))
+            raise ValueError("Unexpected can_list role found: %d on object %s" % (_p_can_list, self))
 
         # Update this object itself without calling the save() method again
-        Twistable.objects.__booster__.filter(id = self.id).update(_access_network = self._access_network)
-
-        # Update dependant objects if current object's network changed for public role
-        Twistable.objects.__booster__.filter(
-            Q(_access_network__id = self.id) | Q(publisher = self.id),
-            _p_can_list = roles.public,
-        ).exclude(id = self.id).update(_access_network = obj)
+        if access_network_id != self._access_network_id:
+            self._access_network_id = access_network_id
+            self.__dict__.pop(Twistable._meta.get_field("_access_network").get_cache_name(), None)
+        Twistable.objects.__booster__.filter(id = self.id).update(_access_network = access_network_id)
+
+        # Update dependant objects (see access_network.py), unless nothing they depend on changed.
+        # A freshly created object doesn't have any dependant object yet.
+        # While bulk loading, that's done once at the end.
+        # Only a loosened listing on the same publisher may be deferred: anything else may restrict access.
+        snapshot = self._get_access_snapshot()
+        if self._access_snapshot[0] is not None and snapshot != self._access_snapshot:
+            if issubclass(self.model_class, account.Account):
+                caches.AccessNetworkCache.bump_version()     # It may have become a free access network, or stopped being one
+            if bulk is None:
+                widening = snapshot[3] == self._access_snapshot[3] and snapshot[1] < self._access_snapshot[1]
+                propagate_access_network(self.id, dependant_network_id, deferrable = widening)
+            else:
+                bulk.propagations[self.id] = dependant_network_id
+        self._access_snapshot = snapshot
+        if bulk is not None:
+            bulk.access_info[self.id] = (self._p_can_list, self._p_can_view, self.publisher_id, )
         
         # This is an additional check to ensure that no _access_network = None object with _p_can_list|_p_can_view = public still remains
         # glob = community.GlobalCommunity.get()
@@ -708,3 +836,22 @@ class Twistable(_AbstractTwistable):
         return self.model_class.type_detail_view
 
 
+
+#                                                                   #
+#                         Signal handlers                           #
+#                                                                   #
+
+def prerender_wiki(sender, instance, **kw):
+    """
+    Warm the wiki cache up with what summary views display. Bulk loads don't do that.
+    """
+    if get_bulk_state() is not None:
+        return
+    from twistranet.twistapp.templatetags.wiki import prerender_twistable
+    try:
+        prerender_twistable(instance)
+    except:
+        # The cache will be filled at display time instead
+        log.exception("Unable to pre-render wiki markup of %s" % instance.id)
+
+twistable_post_save.connect(prerender_wiki)
@@ -10,6 +10,12 @@ twistable_post_save = django.dispatch.Signal(
     providing_args = ["instance", "created", ],
 )
 
+# Sent at the end of a bulk load (see python_fixture.BulkLoader) with the created Twistables,
+# instead of twistable_post_save for each of them. Sent once for each batch of instances.
+twistables_bulk_created = django.dispatch.Signal(
+    providing_args = ["instances", ],
+)
+
 # This one is sent when a content (whichever it is) is created.
 # It's many used to send notification emails on new content.
 content_created = django.dispatch.Signal(
@@ -0,0 +1,207 @@
+"""
+Cache of content summary fragments.
+
+A summary only depends on the content, its comments and likes, and on a small
+'viewer class' (anonymous, or owner / admin / in the publisher's network / manager...).
+So we render it once per such class and keep it in the shared cache:
+
+    {% load fragments %}
+    {% summary_cache content "summary" %}
+        ...
+    {% endsummary_cache %}
+
+The optional fragment name tells apart the blocks rendering the same content differently.
+
+The fragment key includes the fragment name, the content id, modification date and summary version
+(bumped when it's saved, commented or liked, see caches.SummaryCache), the versions of
+the accounts it displays (bumped when they're saved), the viewer class, the comments
+the viewer can see, whether it likes the content, the language and the displayed date.
+The CSRF token is put back in the fragment at each rendering.
+
+Computing the key must be much cheaper than rendering: we don't ask for permissions
+(can_edit...) nor load comments or likes. The viewer class is derived from the principal
+set, which is what permissions are decided upon (see Account.has_role()), and comment
+visibility from the comments' _p_can_list and access network, kept in the cache per summary version.
+"""
+import hashlib
+
+from django import template
+from django.utils import translation
+from django.utils.safestring import mark_safe
+from django.utils.timesince import timesince
+
+from twistranet.twistapp.models import Twistable, SystemAccount
+from twistranet.twistapp.models.network import network_graph
+from twistranet.twistapp.lib import roles
+from twistranet.core import caches
+
+register = template.Library()
+
+CSRF_MARKER = "tn-csrf-token-marker"
+
+# Comments displayed in a summary (see Content.last_comments), and how many recent ones we look at
+SHOWN_COMMENTS = 2
+SCANNED_COMMENTS = 20
+
+
+def _comment_rows(content, version):
+    """
+    Return (id, owner_id, _p_can_list, _access_network_id, free) of the last comments of content, newest first.
+    free tells if the access network is visible to anonymous users (see TwistableManager.get_query_set()).
+    They're kept in the cache for the given summary version (and access networks version),
+    and shared by every viewer.
+    """
+    from twistranet.content_types.models import Comment
+    version = (version, caches.AccessNetworkCache.get_version(), )
+    cache = caches.SummaryCache(content.id)
+    cached = cache.comments
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    rows = Comment.objects.__booster__.filter(
+        root_content__id = content.id,
+    ).order_by("-id").values_list("id", "owner", "_p_can_list", "_access_network")[:SCANNED_COMMENTS]
+    network_ids = set([ row[3] for row in rows if row[3] is not None ])
+    free_ids = network_ids and set(Twistable.objects._getFreeAccessNetworks().filter(
+        id__in = network_ids,
+    ).values_list("id", flat = True)) or set()
+    rows = tuple([ row + (row[3] in free_ids, ) for row in rows ])
+    cache.comments = (version, rows, )
+    return rows
+
+def _can_list(auth, owner_id, can_list, access_network_id, free):
+    """
+    Same decision as TwistableManager.get_query_set(). auth is None for anonymous viewers.
+    """
+    if auth is None:
+        if can_list != roles.public:
+            return False
+        return access_network_id is None or free
+    if auth.id == SystemAccount.SYSTEMACCOUNT_ID:
+        return True
+    if auth.is_admin:
+        return can_list <= roles.manager
+    if can_list == roles.owner:
+        return owner_id == auth.id
+    if access_network_id is None:
+        return can_list == roles.public
+    return access_network_id in auth.principal_ids and can_list in (roles.network, roles.public, )
+
+def _i_like(content, auth):
+    likes = getattr(content, "_c_likes", None)
+    if likes is not None:
+        return likes["i_like"]
+    from twistranet.sharing.models import Like
+    return Like.objects.filter(who__id = auth.id, what__id = content.id).exists()
+
+def viewer_class(content, version):
+    """
+    Return what the summary of content depends on regarding the current viewer,
+    plus the ids of the accounts it displays because of the viewer (comment owners).
+    """
+    auth = Twistable.objects._getAuthenticatedAccount()
+    if auth is not None and auth.is_anonymous:
+        auth = None
+    flags = []
+    if auth is None:
+        flags.append("anonymous")
+    else:
+        flags.extend(_account_flags(content, auth))
+    if content.model_name == "Comment":
+        return ",".join(flags), ()
+    if auth is not None and _i_like(content, auth):
+        flags.append("like")
+    # The comments the viewer can see, and those it wrote (they have their own actions)
+    comments = [ row for row in _comment_rows(content, version) if _can_list(auth, *row[1:]) ][:SHOWN_COMMENTS]
+    owned = [ row[0] for row in comments if auth is not None and row[1] == auth.id ]
+    return "%s:%r:%r" % (",".join(flags), [ row[0] for row in comments ], owned, ), [ row[1] for row in comments ]
+
+def _account_flags(content, auth):
+    """
+    The roles an authenticated viewer may have on the content and its publisher (see Account.has_role()).
+    """
+    flags = []
+    if auth.id == SystemAccount.SYSTEMACCOUNT_ID:
+        flags.append("system")
+    if content.owner_id == auth.id:
+        flags.append("owner")
+    if auth.is_admin:
+        flags.append("admin")
+    if content.publisher_id in auth.principal_ids:
+        flags.append("network")
+    if content.publisher_id == auth.id or content.publisher.owner_id == auth.id:
+        flags.append("publisher_owner")
+    # Community managers get a badge on the community's thumbnail
+    for account_id in (content.owner_id, content.publisher_id, ):
+        if network_graph.is_member(auth.id, account_id, is_manager = True):
+            flags.append("manager:%d" % account_id)
+    return flags
+
+def summary_key(content, context, name = ""):
+    """
+    Return the fragment key of content's summary, or None if it can't be cached.
+    """
+    if not getattr(content, "id", None):
+        return None
+    csrf_token = context.get("csrf_token")
+    version = caches.SummaryCache(content.id).get_version()
+    viewer, account_ids = viewer_class(content, version)
+    versions = caches.SummaryCache.get_versions(set([ content.owner_id, content.publisher_id, ] + list(account_ids)))
+    return hashlib.sha1("|".join([
+        name,
+        str(content.id),
+        content.modified_at and content.modified_at.isoformat() or "",
+        str(version),
+        repr(sorted(versions.items())),
+        viewer,
+        context.get("comment_form") and "form" or "",
+        csrf_token and csrf_token != "NOTPROVIDED" and "csrf" or "",
+        str(translation.get_language()),
+        timesince(content.created_at).encode("utf-8"),
+    ])).hexdigest()
+
+
+class SummaryCacheNode(template.Node):
+    def __init__(self, nodelist, content, name = ""):
+        self.nodelist = nodelist
+        self.content = template.Variable(content)
+        self.name = name
+
+    def render(self, context):
+        content = self.content.resolve(context)
+        key = summary_key(content, context, self.name)
+        if key is None:
+            return self.nodelist.render(context)
+        cache = caches.FragmentCache(key)
+        html = cache.html
+        csrf_token = context.get("csrf_token")
+        if html is None:
+            context.push()
+            try:
+                if csrf_token and csrf_token != "NOTPROVIDED":
+                    context["csrf_token"] = CSRF_MARKER
+                html = self.nodelist.render(context)
+            finally:
+                context.pop()
+            cache.html = html
+        if csrf_token and csrf_token != "NOTPROVIDED":
+            html = html.replace(CSRF_MARKER, unicode(csrf_token))
+        return mark_safe(html)
+
+
+@register.tag
+def summary_cache(parser, token):
+    """
+    {% summary_cache content ["name"] %} ... {% endsummary_cache %}
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2, 3, ):
+        raise template.TemplateSyntaxError("'%s' takes the content and an optional fragment name" % bits[0])
+    name = ""
+    if len(bits) == 3:
+        name = bits[2]
+        if not (name[0] == name[-1] and name[0] in ('"', "'", )):
+            raise template.TemplateSyntaxError("'%s' fragment name must be a quoted string" % bits[0])
+        name = str(name[1:-1])
+    nodelist = parser.parse(('endsummary_cache', ))
+    parser.delete_first_token()
+    return SummaryCacheNode(nodelist, bits[1], name)
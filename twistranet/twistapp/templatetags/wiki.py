@@ -6,11 +6,18 @@ Basically, any 'wikied' page can contain, at your choice:
 - email@test.com to mailto:email@test.com
 - http://www.google.com/xxx to <a href="blabla">www.google.com</a>
 - [slug] or [id] to <a href="/content/slug"> or <a href="/content/id">
+
+The viewer-independent part of the rendering (escaping, links, line breaks) and the whole 'wiki'
+rendering are stored in the shared cache, by hash of the source text (see caches.WikiCache).
+They're computed when a twistable is saved (see prerender_twistable).
+'fullwiki' mentions are resolved with one query per model and lookup field (see MentionResolver).
 """
 import re
+import hashlib
 from django import template
 from django.template.defaultfilters import stringfilter
 from django.utils.html import conditional_escape
+from django.utils.encoding import smart_str
 # XXX mut be changed when django ticket https://code.djangoproject.com/ticket/9655
 # will be resolved
 from twistranet.twistapp.lib.utils import twist_urlize
@@ -18,7 +25,9 @@ from django.utils.safestring import SafeData, mark_safe
 from django.core.urlresolvers import reverse
 from twistranet.twistapp.lib import slugify
 from twistranet.twistapp.models import Account, Content, Resource
+from twistranet.twistapp.lib import auth_context
 from  twistranet.twistapp.lib.log import log
+from twistranet.core import caches
 
 register = template.Library()
 
@@ -30,6 +39,7 @@ account_slug_regex = re.compile(r"@(?P<Alias>%s)" % slugify.SLUG_REGEX)
 account_id_regex = re.compile(r"@(?P<Alias>\d+)")
 content_slug_regex = re.compile(r"\[\s*(?P<Alias>%s)\s*\]" % slugify.SLUG_REGEX)
 content_id_regex = re.compile(r"\[\s*(?P<Alias>\d+)\s*\]")
+tag_regex = re.compile(r'<.*?>')
 
 def resource_image(resource):
     """
@@ -58,13 +68,71 @@ matches = (
 )
 
 
+class MentionResolver(object):
+    """
+    Fetch the objects mentionned in texts, with one (secured) query per model and lookup field.
+    Resolved objects are memoized for the current request, so that a view can fetch
+    all the mentions of a page at once (see prefetch_mentions).
+    """
+    def __init__(self):
+        self.memo = auth_context.request_cache("mentions")
+        if self.memo is None:
+            self.memo = {}
+
+    def _key(self, model, lookup_field, alias):
+        return (model.__name__, lookup_field, alias, )
+
+    def resolve(self, model, lookup_field, aliases):
+        """
+        Fetch the aliases we don't know yet.
+        """
+        missing = [ a for a in set(aliases) if not self.memo.has_key(self._key(model, lookup_field, a)) ]
+        if not missing:
+            return
+        if lookup_field == "id":
+            values = [ int(a) for a in missing ]
+        else:
+            values = missing
+        found = {}
+        for obj in model.objects.filter(**{"%s__in" % str(lookup_field): values}):
+            value = unicode(getattr(obj, lookup_field))
+            found[value] = obj
+            found.setdefault(value.lower(), obj)        # In case the DB compares case-insensitively
+        for alias in missing:
+            self.memo[self._key(model, lookup_field, alias)] = found.get(alias, found.get(alias.lower()))
+
+    def get(self, model, lookup_field, alias):
+        """
+        Return the mentionned object, or None if it doesn't exist (or we can't see it).
+        """
+        key = self._key(model, lookup_field, alias)
+        if not self.memo.has_key(key):
+            self.resolve(model, lookup_field, [alias])
+        return self.memo[key]
+
+    def prefetch(self, texts):
+        """
+        Resolve every mention found in the given (prerendered) texts.
+        """
+        aliases = {}
+        for text in texts:
+            for regex, fast_reverse, func, model, lookup_field in matches:
+                aliases.setdefault((model, lookup_field, ), []).extend([
+                    match.group('Alias') for match in regex.finditer(text)
+                ])
+        for (model, lookup_field), values in aliases.items():
+            if values:
+                self.resolve(model, lookup_field, values)
+
+
 class Subf(object):
-    def __init__(self, lookup, fast_reverse, func, model, lookup_field, ):
+    def __init__(self, lookup, fast_reverse, func, model, lookup_field, resolver = None):
         self.lookup = lookup
         self.fast_reverse = fast_reverse
         self.func = func
         self.model = model
         self.lookup_field = lookup_field
+        self.resolver = resolver
 
 
     def __call__(self, match):
@@ -75,16 +143,14 @@ class Subf(object):
         title = None
         obj = None
         if self.lookup:
-            try:
-                kw = {self.lookup_field: match.groupdict()['Alias']}
-                obj = self.model.objects.get(**kw)
-                url = obj.get_absolute_url()
-                if self.lookup_field != "slug" and obj.slug:
-                    label = match.group(0).replace(match.groupdict()['Alias'], obj.slug)
-                title = obj.title
-            except self.model.DoesNotExist:
+            obj = self.resolver.get(self.model, self.lookup_field, match.groupdict()['Alias'])
+            if obj is None:
                 log.debug("Doesn't exist: %s->%s" % (self.lookup_field, match.groupdict()['Alias']))
                 return match.group(0)
+            url = obj.get_absolute_url()
+            if self.lookup_field != "slug" and obj.slug:
+                label = match.group(0).replace(match.groupdict()['Alias'], obj.slug)
+            title = obj.title
         else:
             url = reverse(self.fast_reverse, args = (match.groupdict()['Alias'],))
 
@@ -96,37 +162,86 @@ class Subf(object):
         return subst
 
 
-def escape_wiki(text, lookup = False, autoescape=None):
+def _cache_key(text, stage):
     """
-    This safely escapes the HTML content and replace all links, @, etc by their TN counterpart.
-    We've got two versions:
-    - the fast one which doesn't lookup actual values
-    - the slow one which may wake every single object mentionned in the text.
-    Use whichever suits you the most.
+    stage is 'prerender' or 'wiki'. Safe (ie. HTML) text isn't rendered like plain text.
     """
+    return hashlib.sha1("%s:%s:%s" % (
+        stage,
+        isinstance(text, SafeData) and "html" or "text",
+        smart_str(text),
+    )).hexdigest()
+
+def prerender(text):
+    """
+    The part of the rendering which doesn't depend on who's looking.
+    """
+    cache = caches.WikiCache(_cache_key(text, "prerender"))
+    html = cache.html
+    if html is not None:
+        return html
 
     # standard text content (statusupdate, description, ...)
     if not isinstance(text, SafeData):
         # strip all tags
-        text = re.compile(r'<.*?>').sub('', text)
+        html = tag_regex.sub('', text)
         # clean escape
-        text = conditional_escape(text)
+        html = conditional_escape(html)
         # urlize the links
-        text = twist_urlize(text,trim_url_limit=50)
+        html = twist_urlize(html,trim_url_limit=50)
         # replace linebreaks
-        text = text.replace('\n', '<br />')
+        html = html.replace('\n', '<br />')
 
     # html rich content (using safe filter)
     else:
-        text = conditional_escape(text)
+        html = conditional_escape(text)
+
+    cache.html = unicode(html)
+    return html
+
+def prefetch_mentions(texts):
+    """
+    Resolve the mentions of all the given texts at once, for the 'fullwiki' rendering of a page.
+    """
+    MentionResolver().prefetch([ prerender(text) for text in texts if text ])
+
+def escape_wiki(text, lookup = False, autoescape=None):
+    """
+    This safely escapes the HTML content and replace all links, @, etc by their TN counterpart.
+    We've got two versions:
+    - the fast one which doesn't lookup actual values (and is cached)
+    - the slow one which wakes every single object mentionned in the text (batched, see MentionResolver).
+    Use whichever suits you the most.
+    """
+    cache = None
+    if not lookup:
+        cache = caches.WikiCache(_cache_key(text, "wiki"))
+        html = cache.html
+        if html is not None:
+            return mark_safe(html)
+
+    text = prerender(text)
+    resolver = None
+    if lookup:
+        resolver = MentionResolver()
+        resolver.prefetch([text])
 
     # Replace the global matches
     for regex, fast_reverse, func, model_class, lookup_field in matches:
-        subf = Subf(lookup, fast_reverse, func, model_class, lookup_field )
+        subf = Subf(lookup, fast_reverse, func, model_class, lookup_field, resolver)
         text = regex.sub(subf, text)
 
-    
+    if cache is not None:
+        cache.html = unicode(text)
     return mark_safe(text)
+
+def prerender_twistable(instance):
+    """
+    Render what the summary views of instance display, so that they're ready in the cache.
+    """
+    for text in (instance.description, instance.title_or_description, ):
+        if text:
+            escape_wiki(text)
     
 
 
@@ -5,6 +5,9 @@ from wall import WallTest
 from resources import ResourcesTest
 from account_security import AccountSecurityTest
 from menu import MenuTest
+from auth_context import AuthContextTest
+from mail_queue import MailQueueTest
+from search import SearchIndexTest
 # all brokens i think we can remove it
 # from views_test import ViewsTest
 
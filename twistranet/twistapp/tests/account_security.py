@@ -256,6 +256,35 @@ class AccountSecurityTest(TNBaseTest):
         self.failIf(c.is_manager)
         
         
+    def test_actions_cache(self,):
+        """
+        Actions are cached per viewer, and follow the relations of the object.
+        """
+        from django.test.client import Client
+        admin_client = Client()
+        admin_client.post("/login/", {'username': 'admin', 'password': 'azerty1234'})
+        B_client = Client()
+        B_client.post("/login/", {'username': 'B', 'password': 'dummy'})
+        def labels(client, url):
+            response = client.get(url)
+            self.failUnlessEqual(response.status_code, 200)
+            actions = response.context["actions"]
+            return sorted([ action.label for category in actions.values() for action in category ])
+        home = [ labels(client, "/") for client in (admin_client, admin_client, B_client, ) ]
+        self.failUnless(home[0])
+        self.failUnlessEqual(home[0], home[1])
+        self.failIfEqual(home[0], home[2])
+        
+        # The only manager can't leave the community, until another one joins
+        __account__ = self.admin
+        c = Community.objects.create(title = "Cached actions", permissions = "workgroup")
+        url = "/community/%d" % c.id
+        before = labels(admin_client, url)
+        self.failUnlessEqual(before, labels(admin_client, url))
+        __account__ = self.system
+        c.join(self.A, is_manager = True)
+        self.failIfEqual(before, labels(admin_client, url))
+        
     def test_08_private_community(self,):
         """
         Check if admin can see its own private communities
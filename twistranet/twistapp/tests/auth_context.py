@@ -0,0 +1,90 @@
+"""
+Authentication context tests: acting_as() and the stack-walking fallback.
+"""
+from __future__ import with_statement
+from django.conf import settings
+from django.http import HttpRequest
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.twistapp.lib import auth_context
+from twistranet.twistapp.lib.auth_context import acting_as
+from twistranet.content_types.models import StatusUpdate
+
+class AuthContextTest(TNBaseTest):
+    """
+    Just to remember:
+    A <=> admin
+    B  => admin
+    """
+    def setUp(self):
+        super(AuthContextTest, self).setUp()
+        self._fallback = settings.TWISTRANET_AUTH_STACK_FALLBACK
+        auth_context.reset_stack_walk_count()
+        
+    def tearDown(self):
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = self._fallback
+        super(AuthContextTest, self).tearDown()
+
+    def test_acting_as(self):
+        """
+        acting_as() blocks can be nested and restore the previous account.
+        """
+        with acting_as(self.A):
+            self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+            with acting_as(self.B):
+                self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.B.id)
+            self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+        self.failUnlessEqual(auth_context.get_stack_walk_count(), 0)
+        
+    def test_no_stack_walk_by_default(self):
+        """
+        Without the fallback, a forgotten '__account__' isn't seen anymore.
+        """
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = False
+        __account__ = self.A
+        self.failUnless(Twistable.objects._getAuthenticatedAccount().is_anonymous)
+        self.failUnlessEqual(auth_context.get_stack_walk_count(), 0)
+        
+    def test_stack_walk_is_counted(self):
+        """
+        The fallback still works, but we know when it fires.
+        """
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = True
+        __account__ = self.A
+        self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+        self.failUnlessEqual(auth_context.get_stack_walk_count(), 1)
+
+    def test_permission_memo(self):
+        """
+        Permission decisions are memoized while a request is bound, and only then.
+        """
+        auth_context.reset_memo_stats()
+        with acting_as(self.A):
+            s = StatusUpdate(description = "Memo", permissions = "public")
+            s.save()
+            self.failUnless(s.can_edit)
+        self.failUnlessEqual(auth_context.get_memo_stats("permissions"), (0, 0))
+        auth_context.bind_request(HttpRequest())
+        try:
+            with acting_as(self.A):
+                self.failUnless(s.can_edit)
+                self.failUnless(s.can_edit)
+        finally:
+            auth_context.unbind_request()
+        self.failUnlessEqual(auth_context.get_memo_stats("permissions"), (1, 1))
+
+    def test_site_access(self):
+        """
+        The site access gate follows the GlobalCommunity permissions.
+        """
+        from twistranet.twistapp.lib.utils import can_access_site
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = False
+        self.failIf(can_access_site())          # Intranet by default
+        with acting_as(self.A):
+            self.failUnless(can_access_site())
+        with acting_as(SystemAccount.get()):
+            self.failUnless(can_access_site())
+            glob = GlobalCommunity.get()
+            glob.permissions = "internet"
+            glob.save()
+        self.failUnless(can_access_site())
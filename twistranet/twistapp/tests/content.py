@@ -1,6 +1,7 @@
 """
 This is a set of account permissions tests
 """
+from __future__ import with_statement
 from twistranet.twistapp.tests.base import TNBaseTest
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
@@ -18,3 +19,106 @@ class ContentTest(TNBaseTest):
     """
 
 
+
+    def test_slug_allocation(self):
+        """
+        Similarly titled objects get the next free suffix, in bulk or not.
+        """
+        from twistranet.twistapp.lib.slugify import bulk_slugs, split_slug
+        self.failUnlessEqual(split_slug("meeting_notes_12"), ("meeting_notes", 12))
+        self.failUnlessEqual(split_slug("meeting_notes"), ("meeting_notes", 0))
+        __account__ = self.A
+        slugs = []
+        for i in range(3):
+            slugs.append(Document.objects.create(title = "Meeting notes", text = "Hello").slug)
+        with bulk_slugs():
+            for i in range(3):
+                slugs.append(Document.objects.create(title = "Meeting notes", text = "Hello").slug)
+        self.failUnlessEqual(slugs, ["meeting_notes", ] + [ "meeting_notes_%d" % i for i in range(1, 6) ])
+
+    def test_bulk_loader(self):
+        """
+        Bulk-loaded content gets the same slugs, access network and timelines as regular content.
+        """
+        from twistranet.twistapp.lib.python_fixture import Fixture, BulkLoader
+        __account__ = self.A
+        regular = Document.objects.create(title = "Bulk notes", text = "Hello", permissions = "public")
+        fixtures = [
+            Fixture(Document, logged_account = self.A.slug, slug = None, title = "Bulk notes", text = "Hello", permissions = "public")
+            for i in range(3)
+        ]
+        self.failUnlessEqual(BulkLoader(fixtures, batch_size = 2, verbose = False).load(), 3)
+        docs = Document.objects.filter(title = "Bulk notes").order_by("id")
+        self.failUnlessEqual([ d.slug for d in docs ], ["bulk_notes", "bulk_notes_1", "bulk_notes_2", "bulk_notes_3", ])
+        access_networks = set(Twistable.objects.__booster__.filter(
+            id__in = [ d.id for d in docs ],
+        ).values_list("_access_network", flat = True))
+        self.failUnlessEqual(access_networks, set([ regular._access_network_id, ]))
+        self.failUnlessEqual(TimelineEntry.objects.filter(account__id = self.A.id, content__id__in = [ d.id for d in docs ]).count(), 4)
+        
+        # Updated objects get their twistable_post_save once the load is over
+        from twistranet.twistapp.signals import twistable_post_save
+        saved = []
+        def record(sender, instance, created, **kw):
+            saved.append((instance.id, created, ))
+        twistable_post_save.connect(record)
+        try:
+            fixture = Fixture(Document, logged_account = self.A.slug, force_update = True, slug = regular.slug, title = "Bulk update")
+            BulkLoader([ fixture, ], verbose = False).load()
+        finally:
+            twistable_post_save.disconnect(record)
+        self.failUnlessEqual(saved, [ (regular.id, False, ), ])
+
+    def test_wiki_rendering(self):
+        """
+        Fast and full wiki renderings, from the cache or not, give the same markup.
+        """
+        from twistranet.twistapp.templatetags.wiki import fast_wiki, slow_wiki, escape_wiki, MentionResolver
+        from twistranet.core import caches
+        __account__ = self.A
+        doc = Document.objects.create(title = "Wiki target", text = "Hello", permissions = "public")
+        text = u"See [%s] by @%s, <b>not bold</b>\nhttp://www.numericube.com" % (doc.slug, self.A.slug, )
+        fast = fast_wiki(text)
+        self.failUnless('<br />' in fast)
+        self.failIf('<b>' in fast)
+        self.failIf('title="Wiki target"' in fast)
+        self.failUnlessEqual(fast_wiki(text), fast)
+        full = slow_wiki(text)
+        self.failUnless('title="Wiki target"' in full)
+        self.failUnless(doc.get_absolute_url() in full)
+        self.failUnless(self.A.get_absolute_url() in full)
+
+        # Mentions are resolved with the viewer's permissions
+        private = Document.objects.create(title = "Private target", text = "Hello", permissions = "private")
+        __account__ = self.B
+        self.failIf("Private target" in escape_wiki(u"[%s]" % private.slug, True))
+        resolver = MentionResolver()
+        resolver.prefetch([u"@%s [%s] [%s]" % (self.A.slug, doc.slug, private.slug, )])
+        self.failUnlessEqual(resolver.get(Account, "slug", self.A.slug).id, self.A.id)
+        self.failUnlessEqual(resolver.get(Content, "slug", doc.slug).id, doc.id)
+        self.failUnlessEqual(resolver.get(Content, "slug", private.slug), None)
+
+    def test_summary_fragments(self):
+        """
+        Summary fragments are served from the cache until the content changes.
+        """
+        from django.template import Template, Context
+        from twistranet.twistapp.lib.auth_context import acting_as
+        t = Template("{% load fragments %}{% summary_cache content %}{{ content.title }}{% endsummary_cache %}")
+        with acting_as(self.A):
+            doc = Document.objects.create(title = "Cached summary", text = "Hello", permissions = "public")
+            self.failUnlessEqual(t.render(Context({"content": doc})), "Cached summary")
+            Twistable.objects.__booster__.filter(id = doc.id).update(title = "Changed behind our back")
+            doc.title = "Changed behind our back"
+            self.failUnlessEqual(t.render(Context({"content": doc})), "Cached summary")
+            doc.save()
+            self.failUnlessEqual(t.render(Context({"content": doc})), "Changed behind our back")
+
+            # Displayed accounts are followed too
+            t = Template("{% load fragments %}{% summary_cache content 'owner' %}{{ content.owner.title }}{% endsummary_cache %}")
+            title = self.A.title
+            self.failUnlessEqual(t.render(Context({"content": Document.objects.get(id = doc.id)})), title)
+            self.failUnlessEqual(t.render(Context({"content": Document.objects.get(id = doc.id)})), title)
+            self.A.title = "Renamed owner"
+            self.A.save()
+            self.failUnlessEqual(t.render(Context({"content": Document.objects.get(id = doc.id)})), "Renamed owner")
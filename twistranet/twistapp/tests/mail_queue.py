@@ -0,0 +1,129 @@
+"""
+Outgoing mail queue tests.
+"""
+from __future__ import with_statement
+from django.core import mail
+from django.core.mail import EmailMessage
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from django.conf import settings
+from twistranet.notifier.models import MailJob, OutgoingMail
+from twistranet.notifier.handlers import MailHandler
+from twistranet.twistapp.management.commands.twistranet_send_mail import Command
+
+class MailQueueTest(TNBaseTest):
+
+    def test_enqueue_and_send(self):
+        """
+        Queued messages are sent by the worker, then removed from the queue.
+        """
+        OutgoingMail.objects.all().delete()
+        mail.outbox = []
+        OutgoingMail.objects.enqueue(EmailMessage("Hello", "World", "twistranet@example.com", ["A@example.com"]))
+        self.failUnlessEqual(OutgoingMail.objects.stats()["pending"], 1)
+        self.failUnlessEqual(len(mail.outbox), 0)
+        Command().send_batch(10)
+        self.failUnlessEqual(len(mail.outbox), 1)
+        self.failUnlessEqual(mail.outbox[0].subject, "Hello")
+        self.failUnlessEqual(OutgoingMail.objects.stats()["pending"], 0)
+
+    def test_backoff(self):
+        """
+        Failed messages are postponed, then given up.
+        """
+        m = OutgoingMail.objects.enqueue(EmailMessage("Hello", "World", "twistranet@example.com", ["A@example.com"]))
+        first = m.next_attempt_at
+        m.failed("Boom")
+        self.failUnless(m.next_attempt_at > first)
+        self.failIf(m in OutgoingMail.objects.due(10))
+        for i in range(10):
+            m.failed("Boom")
+        self.failUnless(m.next_attempt_at is None)
+        self.failUnlessEqual(OutgoingMail.objects.stats()["failed"], 1)
+
+    def test_mail_job(self):
+        """
+        A notification is queued as a single job, expanded by the worker.
+        """
+        MailJob.objects.all().delete()
+        mail.outbox = []
+        handler = MailHandler(
+            recipient_arg = "target",
+            text_template = "email/reset_password.txt",
+            html_template = "email/reset_password.html",
+        )
+        previous = getattr(settings, "TWISTRANET_MAIL_QUEUE", False), settings.EMAIL_HOST
+        settings.TWISTRANET_MAIL_QUEUE, settings.EMAIL_HOST = True, "localhost"
+        try:
+            handler(self.__class__, target = [ self.A, self.B, ], reset_password_uri = "/reset/")
+        finally:
+            settings.TWISTRANET_MAIL_QUEUE, settings.EMAIL_HOST = previous
+        self.failUnlessEqual(MailJob.objects.stats()["pending"], 1)
+        self.failUnlessEqual(len(mail.outbox), 0)
+        Command().send_batch(10)
+        self.failUnlessEqual(MailJob.objects.stats()["pending"], 0)
+        self.failUnlessEqual(len(mail.outbox), 2)
+        self.failUnlessEqual(OutgoingMail.objects.stats()["pending"], 0)
+
+    def test_claim(self):
+        """
+        A due message is leased to a single worker.
+        """
+        OutgoingMail.objects.all().delete()
+        m = OutgoingMail.objects.enqueue(EmailMessage("Hello", "World", "twistranet@example.com", ["A@example.com"]))
+        stale = list(OutgoingMail.objects.due(10))        # What a concurrent worker has just read
+        self.failUnlessEqual([ c.id for c in OutgoingMail.objects.claim(10) ], [ m.id ])
+        self.failUnlessEqual(OutgoingMail.objects.claim(10), [])
+        for c in stale:
+            self.failIf(OutgoingMail.objects.filter(id = c.id, next_attempt_at = c.next_attempt_at).update(next_attempt_at = None))
+
+    def test_iter_recipients(self):
+        """
+        Community members are streamed as (id, email, language) tuples, once each.
+        """
+        from twistranet.notifier.handlers import iter_recipients
+        __account__ = self.system
+        members = GlobalCommunity.get().members.exclude(id = self.A.id)
+        rows = list(iter_recipients(members, chunk_size = 2))
+        ids = [ row[0] for row in rows ]
+        self.failUnlessEqual(len(ids), len(set(ids)))
+        self.failIf(self.A.id in ids)
+        self.failIf([ row for row in rows if not row[1] ])
+        
+        # Each address gets a single mail, and the author none
+        for username, email in (("A", "shared@example.com"), ("B", " Shared@Example.com"), ):
+            user = UserAccount.objects.__booster__.get(user__username = username).user
+            user.email = email
+            user.save()
+        rows = list(iter_recipients(GlobalCommunity.get().members, chunk_size = 2))
+        ids = [ row[0] for row in rows ]
+        self.failUnlessEqual(len([ i for i in ids if i in (self.A.id, self.B.id, ) ]), 1)
+        self.failUnless(self.C.id in ids)
+        rows = list(iter_recipients(GlobalCommunity.get().members, author_id = self.C.id, chunk_size = 2))
+        self.failIf(self.C.id in [ row[0] for row in rows ])
+
+    def test_author_not_notified(self):
+        """
+        The account sending a notification doesn't get it.
+        """
+        from twistranet.twistapp.lib.auth_context import acting_as
+        mail.outbox = []
+        handler = MailHandler(
+            recipient_arg = "target",
+            text_template = "email/reset_password.txt",
+            html_template = "email/reset_password.html",
+        )
+        for username, email in (("B", "b@example.com"), ("C", "c@example.com"), ):
+            user = UserAccount.objects.__booster__.get(user__username = username).user
+            user.email = email
+            user.save()
+        previous = getattr(settings, "TWISTRANET_MAIL_QUEUE", False), settings.EMAIL_HOST
+        settings.TWISTRANET_MAIL_QUEUE, settings.EMAIL_HOST = False, "localhost"
+        try:
+            with acting_as(self.C):
+                handler(self.__class__, target = [ self.B, GlobalCommunity.get(), ], reset_password_uri = "/reset/")
+        finally:
+            settings.TWISTRANET_MAIL_QUEUE, settings.EMAIL_HOST = previous
+        recipients = [ m.to[0] for m in mail.outbox ]
+        self.failIf("c@example.com" in recipients)
+        self.failUnlessEqual(recipients.count("b@example.com"), 1)
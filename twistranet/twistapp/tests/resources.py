@@ -20,6 +20,154 @@ class ResourcesTest(TNBaseTest):
         self.failUnless(self.A.picture)
         self.failUnless(self.B.picture)
 
+    def test_thumbnails(self):
+        """
+        Resources store their thumbnails URLs when saved, and Twistable.thumbnails only resolves what's asked.
+        """
+        from twistranet.twistapp.lib.thumbnails import THUMBNAIL_SIZES, StoredThumbnail
+        __account__ = self.A
+        picture = self.A.forced_picture
+        stored = picture.stored_thumbnail_urls
+        self.failUnlessEqual(set(stored.keys()), set(THUMBNAIL_SIZES.keys()))
+        thumbnails = self.A.thumbnails
+        self.failUnlessEqual(len(thumbnails), 0)
+        icon = thumbnails['icon']
+        self.failUnless(isinstance(icon, StoredThumbnail))
+        self.failUnlessEqual(icon.url, stored['icon'])
+        self.failUnlessEqual(thumbnails.keys(), ['icon'])
+        self.failUnlessRaises(KeyError, lambda: thumbnails['huge'])
+
+    def test_default_pictures(self):
+        """
+        Default pictures come from the registry, which is emptied when a resource changes.
+        Stored thumbnails URLs are then served from the cache, by picture id.
+        """
+        from twistranet.twistapp.models.resource import default_pictures
+        from twistranet.core import caches
+        __account__ = self.A
+        community = Community.objects.create(title = "No picture")
+        default = default_pictures.get(Community.default_picture_resource_slug)
+        self.failUnlessEqual(community.forced_picture.id, default.id)
+        self.failUnlessEqual(community.forced_picture_id, default.id)
+        self.failUnless(default_pictures.get(Community.default_picture_resource_slug) is default)
+        self.failUnlessEqual(default_pictures.get("no_such_picture"), None)
+        
+        url = community.thumbnails['medium'].url
+        self.failUnlessEqual(caches.PictureCache(default.id).thumbnail_urls['medium'], url)
+        
+        # Only saving one of the registry's resources empties it
+        self.failUnless(default_pictures.is_registry_slug("default_tn_picture"))
+        self.failUnless(default_pictures.is_registry_slug("application_pdf"))
+        self.failIf(default_pictures.is_registry_slug("holidays_picture"))
+        class FakeResource(object):
+            slug = _registry_slug = "holidays_picture"
+        holidays = FakeResource()
+        default_pictures.resource_changed(holidays)
+        self.failUnless(default_pictures.get(Community.default_picture_resource_slug) is default)
+        holidays.slug = "holidays_pictures"
+        default_pictures.resource_changed(holidays)
+        self.failIf(default_pictures.get(Community.default_picture_resource_slug) is default)
+        default = default_pictures.get(Community.default_picture_resource_slug)
+        __account__ = self.system
+        Resource.objects.get(id = default.id).save()
+        self.failIf(default_pictures.get(Community.default_picture_resource_slug) is default)
+
+    def test_streamed_upload(self):
+        """
+        XHR uploads are written to disk as they come, possibly in several chunks.
+        """
+        import os
+        import hashlib
+        from StringIO import StringIO
+        from twistranet.twistapp.lib.uploads import receive_upload, UploadError
+        class FakeRequest(object):
+            def __init__(self, body, **meta):
+                self.read = StringIO(body).read
+                self.META = dict(meta, CONTENT_LENGTH = str(len(body)))
+        data = "0123456789" * 10000
+        
+        # Single request
+        upload_id, offset, uploaded = receive_upload(FakeRequest(data), self.A.id, "test.txt")
+        self.failUnlessEqual(offset, len(data))
+        self.failUnlessEqual(uploaded.content_hash, hashlib.sha1(data).hexdigest())
+        self.failUnlessEqual(open(uploaded.temporary_file_path(), "rb").read(), data)
+        uploaded.close()
+        os.remove(uploaded.temporary_file_path())
+        
+        # Two chunks, the second one being sent at the wrong offset first
+        size = str(len(data))
+        upload_id, offset, uploaded = receive_upload(FakeRequest(data[:60000], HTTP_X_FILE_SIZE = size), self.A.id, "test.txt")
+        self.failUnlessEqual((offset, uploaded), (60000, None))
+        try:
+            receive_upload(FakeRequest(data[50000:], HTTP_X_FILE_SIZE = size, HTTP_X_UPLOAD_ID = upload_id, HTTP_X_UPLOAD_OFFSET = "50000"), self.A.id, "test.txt")
+        except UploadError, e:
+            self.failUnlessEqual(e.code, "offsetError")
+            self.failUnlessEqual(e.info['offset'], 60000)
+        else:
+            self.fail("Chunk accepted at the wrong offset")
+        upload_id, offset, uploaded = receive_upload(
+            FakeRequest(data[60000:], HTTP_X_FILE_SIZE = size, HTTP_X_UPLOAD_ID = upload_id, HTTP_X_UPLOAD_OFFSET = "60000"),
+            self.A.id, "test.txt",
+        )
+        self.failUnlessEqual(uploaded.content_hash, hashlib.sha1(data).hexdigest())
+        uploaded.close()
+        os.remove(uploaded.temporary_file_path())
+        
+        # One can't send more than the announced size
+        upload_id, offset, uploaded = receive_upload(FakeRequest(data[:60000], HTTP_X_FILE_SIZE = "70000"), self.A.id, "test.txt")
+        try:
+            receive_upload(FakeRequest(data[60000:], HTTP_X_FILE_SIZE = "70000", HTTP_X_UPLOAD_ID = upload_id, HTTP_X_UPLOAD_OFFSET = "60000"), self.A.id, "test.txt")
+        except UploadError, e:
+            self.failUnlessEqual(e.code, "sizeError")
+        else:
+            self.fail("Chunk accepted beyond the file size")
+        
+        # One can't resume someone else's upload
+        self.failUnlessRaises(UploadError, receive_upload,
+            FakeRequest(data, HTTP_X_UPLOAD_ID = upload_id), self.B.id, "test.txt",
+        )
+
+    def test_resource_download(self):
+        """
+        Resources are streamed, with cache validation and byte ranges.
+        """
+        from django.test.client import Client
+        client = Client()
+        client.post("/login/", {'username': 'admin', 'password': 'azerty1234'})
+        url = "/resource/default_tn_picture/"
+        response = client.get(url)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(response["Accept-Ranges"], "bytes")
+        size = int(response["Content-Length"])
+        self.failUnlessEqual(len(response.content), size)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+        
+        response = client.get(url, HTTP_IF_NONE_MATCH = etag)
+        self.failUnlessEqual(response.status_code, 304)
+        response = client.get(url, HTTP_IF_MODIFIED_SINCE = last_modified)
+        self.failUnlessEqual(response.status_code, 304)
+        response = client.get(url, HTTP_IF_MODIFIED_SINCE = "Sat, 01 Jan 2000 00:00:00 GMT")
+        self.failUnlessEqual(response.status_code, 200)
+        
+        response = client.get(url, HTTP_RANGE = "bytes=0-9")
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(response["Content-Range"], "bytes 0-9/%d" % size)
+        self.failUnlessEqual(len(response.content), 10)
+        
+        response = client.get(url, HTTP_RANGE = "bytes=-5")
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(len(response.content), 5)
+        
+        response = client.get(url, HTTP_RANGE = "bytes=%d-" % size)
+        self.failUnlessEqual(response.status_code, 416)
+        
+        # A matching If-Range gets the range, a stale one gets the whole file
+        response = client.get(url, HTTP_RANGE = "bytes=0-9", HTTP_IF_RANGE = etag)
+        self.failUnlessEqual(response.status_code, 206)
+        response = client.get(url, HTTP_RANGE = "bytes=0-9", HTTP_IF_RANGE = '"stale"')
+        self.failUnlessEqual(response.status_code, 200)
+
     # XXX PJ test is failing > renamed twist
     def twist_public_resource(self):
         """
@@ -32,3 +180,32 @@ class ResourcesTest(TNBaseTest):
         self.failUnless(r.resource_file)
 
 
+
+    def test_content_addressed_storage(self):
+        """
+        Identical files are stored once, and removed with their last name.
+        """
+        import os
+        from django.conf import settings
+        from django.core.files.base import ContentFile
+        from twistranet.twistorage.storage import Twistorage
+        __account__ = self.A
+        storage = Twistorage()
+        if not hasattr(os, "link"):
+            return
+        former = getattr(settings, "TWISTRANET_CONTENT_ADDRESSED_STORAGE", False)
+        settings.TWISTRANET_CONTENT_ADDRESSED_STORAGE = True
+        try:
+            name1 = storage.save("%d/dedup.txt" % self.A.id, ContentFile("Same content"))
+            name2 = storage.save("%d/dedup.txt" % self.A.id, ContentFile("Same content"))
+            self.failIfEqual(name1, name2)
+            self.failUnless(os.path.samefile(storage.path(name1), storage.path(name2)))
+            self.failUnlessEqual(storage.open(name2).read(), "Same content")
+            blob_path = storage.blob_path(storage._hash_file(storage.path(name1)))
+            self.failUnlessEqual(os.stat(blob_path).st_nlink, 3)
+            storage.delete(name1)
+            self.failUnless(os.path.exists(blob_path))
+            storage.delete(name2)
+            self.failIf(os.path.exists(blob_path))
+        finally:
+            settings.TWISTRANET_CONTENT_ADDRESSED_STORAGE = former
@@ -0,0 +1,53 @@
+"""
+Search index tests.
+"""
+from haystack.query import SearchQuerySet
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.content_types.models import *
+from twistranet.search.haystack_index_backend import tokenize, InvertedIndex
+
+class SearchIndexTest(TNBaseTest):
+
+    def test_tokenize(self):
+        self.failUnlessEqual(tokenize(u"H\xe9llo, World!"), [u"hello", u"world", ])
+
+    def test_inverted_index(self):
+        """
+        Every term must match (as a prefix), best match first.
+        """
+        index = InvertedIndex(":memory:")
+        index.index([
+            ("twistapp.document", "1", u"Hello world, hello John"),
+            ("twistapp.document", "2", u"John Doe world"),
+            ("twistapp.account", "3", u"Nothing here"),
+        ])
+        self.failUnlessEqual([ r[3] for r in index.search([u"hello", ]) ], ["1", ])
+        self.failUnlessEqual(set([ r[3] for r in index.search([u"jo", u"world", ]) ]), set(["1", "2", ]))
+        self.failUnlessEqual(index.search([u"world", ], set(["twistapp.account", ])), [])
+        index.remove("twistapp.document", "1")
+        self.failUnlessEqual([ r[3] for r in index.search([u"world", ]) ], ["2", ])
+
+    def test_indexed_on_save(self):
+        """
+        Content is indexed as it's saved, and search results are filtered by security.
+        """
+        __account__ = self.A
+        doc = Document.objects.create(title = "Zorglub", text = "<p>Zorglub rules</p>", permissions = "private")
+        results = SearchQuerySet().models(Document).auto_query("zorglub")
+        self.failUnlessEqual([ r.pk for r in results ], [ unicode(doc.id), ])
+        __account__ = self.B
+        self.failUnlessEqual(SearchQuerySet().models(Document).auto_query("zorglub").count(), 0)
+        __account__ = self.A
+        doc.delete()
+        self.failUnlessEqual(SearchQuerySet().models(Document).auto_query("zorglub").count(), 0)
+
+    def test_indexed_as_own_model(self):
+        """
+        Comments are not indexed as status updates.
+        """
+        __account__ = self.A
+        status = StatusUpdate.objects.create(description = "Blorfinate")
+        comment = Comment.objects.create(description = "Blorfinate too", in_reply_to = status)
+        results = SearchQuerySet().models(StatusUpdate).auto_query("blorfinate")
+        self.failUnlessEqual([ r.pk for r in results ], [ unicode(status.id), ])
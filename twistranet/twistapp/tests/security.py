@@ -118,6 +118,88 @@ class SecurityTest(TNBaseTest):
         self.failUnless(s.content_ptr in Content.objects.all())
         __account__ = self.B        # B is not
         self.failUnless(s.content_ptr not in Content.objects.all())
+        
+    def test_principal_ids(self):
+        """
+        Check that the principal set follows network changes.
+        """
+        self.failUnless(self.A.id in self.admin.principal_ids)
+        self.failIf(self.B.id in UserAccount.objects.__booster__.get(id = self.A.id).principal_ids)
+        self.B.object.follow(self.A)
+        self.failUnless(self.B.id in UserAccount.objects.__booster__.get(id = self.A.id).principal_ids)
+        self.B.object.unfollow(self.A)
+        self.failIf(self.B.id in UserAccount.objects.__booster__.get(id = self.A.id).principal_ids)
+
+    def test_network_graph(self):
+        """
+        Check that the cached network graph follows relation changes.
+        """
+        from twistranet.twistapp.models.network import network_graph
+        self.failUnless(self.A.id in network_graph.approved_ids(self.admin.id))
+        self.failIf(self.B.id in network_graph.approved_ids(self.admin.id))
+        self.failUnless(network_graph.is_pending(self.admin.id, self.B.id))
+        self.failUnless(network_graph.is_following(self.B.id, self.admin.id))
+        self.A.object.follow(self.B)
+        self.failUnless(network_graph.is_following(self.A.id, self.B.id))
+        self.A.object.unfollow(self.B)
+        self.failIf(network_graph.is_following(self.A.id, self.B.id))
+        
+        # Membership is answered from the account's own node, listings are subqueries on Network
+        __account__ = self.system
+        glob = GlobalCommunity.get()
+        self.failUnless(network_graph.is_member(self.A.id, glob.id))
+        self.failUnless(self.A.id in glob.members.values_list("id", flat = True))
+        self.failIf(glob.id in glob.members.values_list("id", flat = True))
+        self.failUnless(glob.id in self.A.communities.values_list("id", flat = True))
+        self.failUnless(self.B.id in self.admin.object.get_pending_network_request_ids())
+        
+        # Bumping the graph version twice within the same millisecond still drops it
+        from twistranet.core import caches
+        v = caches.NetworkGraphCache.get_version()
+        caches.NetworkGraphCache.bump_version()
+        v2 = caches.NetworkGraphCache.get_version()
+        caches.NetworkGraphCache.bump_version()
+        self.failUnless(v < v2 < caches.NetworkGraphCache.get_version())
+        
+    def test_access_network_propagation(self):
+        """
+        Public content follows its community's listing restrictions right away.
+        Only opening a large hierarchy is deferred to a job.
+        """
+        from django.conf import settings
+        __account__ = self.system
+        c = Community.objects.create(title = "Propagation", permissions = "interest")
+        s = StatusUpdate(description = "Hello community", permissions = "public", publisher = c)
+        s.save()
+        def access_network_id():
+            return Twistable.objects.__booster__.filter(id = s.id).values_list("_access_network", flat = True)[0]
+        self.failIfEqual(access_network_id(), c.id)
+        c.permissions = "private"
+        c.save()
+        self.failUnlessEqual(access_network_id(), c.id)
+        c.permissions = "interest"
+        c.save()
+        public_network_id = access_network_id()
+        self.failIfEqual(public_network_id, c.id)
+        
+        # Too large a closure: restricting is still done right away, opening is deferred to a job
+        limit = getattr(settings, "TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT", None)
+        settings.TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT = 0
+        try:
+            c.permissions = "private"
+            c.save()
+            self.failUnlessEqual(access_network_id(), c.id)
+            self.failIf(AccessNetworkJob.objects.filter(root__id = c.id).exists())
+            c.permissions = "interest"
+            c.save()
+        finally:
+            settings.TWISTRANET_ACCESS_NETWORK_SYNC_LIMIT = limit
+        self.failUnlessEqual(access_network_id(), c.id)
+        jobs = list(AccessNetworkJob.objects.filter(root__id = c.id))
+        self.failUnlessEqual(len(jobs), 1)
+        jobs[0].run()
+        self.failUnlessEqual(access_network_id(), public_network_id)
+        self.failIf(AccessNetworkJob.objects.filter(root__id = c.id).exists())
             
     # def test_silent_permissions(self):
     #     """
@@ -223,6 +305,22 @@ class SecurityTest(TNBaseTest):
         self.failUnlessEqual(len(self.system.communities), 0)
         self.failUnlessEqual(len(Community.objects.all()), 2)
         
+    def test_site_config(self):
+        """
+        The site configuration snapshot follows GlobalCommunity and domain changes.
+        """
+        from twistranet.twistapp.lib import utils
+        __account__ = self.system
+        glob = GlobalCommunity.get()
+        self.failUnlessEqual(utils.get_site_name(), glob.site_name)
+        self.failUnlessEqual(utils.get_baseline(), glob.baseline)
+        self.failUnlessEqual(utils.site_config.get()["global_id"], glob.id)
+        glob.site_name = "Renamed site"
+        glob.save()
+        self.failUnlessEqual(utils.get_site_name(), "Renamed site")
+        utils.set_site_domain("http://twistranet.example.com")
+        self.failUnlessEqual(utils.get_site_domain(), "http://twistranet.example.com")
+        
     def test_membership(self):
         __account__ = self.system
         self.failUnlessEqual(len(self.A.communities), 1)
@@ -76,5 +76,3 @@ class ViewsTest(TNBaseTest):
         response = self.admin_client.get("/community/administrators/") # XXX TODO: Follow redirect
         self.failUnlessEqual(response.status_code, 200)
         # self.print_query_stats()
-
-
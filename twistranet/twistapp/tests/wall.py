@@ -65,6 +65,70 @@ class WallTest(TNBaseTest):
         self.failUnlessEqual(len(latest), 5)
         self.failUnless(latest[0].created_at >= latest[3].created_at, "Invalid date order for the wall")
         
+    def test_03_timeline(self):
+        """
+        Content is fanned out to the followers' timelines, and removed on unfollow.
+        """
+        __account__ = self.A
+        s = StatusUpdate(description = "Timeline", permissions = "public")
+        s.save()
+        self.failUnless(s.content_ptr in Content.objects.timeline())
+        self.failUnless(s.content_ptr in Content.objects.followed.all())
+        __account__ = self.B
+        self.failIf(s.content_ptr in Content.objects.timeline())
+        self.B.object.follow(self.A)
+        self.failUnless(s.content_ptr in Content.objects.timeline())
+        self.failIf(s.content_ptr in Content.objects.timeline(before = s.id))
+        self.B.object.unfollow(self.A)
+        self.failIf(s.content_ptr in Content.objects.timeline())
+
+    def test_04_enrichment(self):
+        """
+        Batched summary information is the same as what each content computes by itself.
+        """
+        from twistranet.sharing.models import Like
+        __account__ = self.A
+        s = StatusUpdate(description = "Enrich me", permissions = "public")
+        s.save()
+        for i in range(3):
+            Comment.objects.create(in_reply_to = s, description = "Comment %d" % i)
+        s.like()
+        lazy = Content.objects.get(id = s.id)
+        batched = Content.objects.get(id = s.id)
+        Content.objects.prefetch_summaries([batched, ])
+        Like.objects.prefetch_likes([batched, ])
+        self.failUnlessEqual(batched.comment_count, 3)
+        self.failUnlessEqual([ c.id for c in batched.last_comments ], [ c.id for c in lazy.last_comments ])
+        self.failUnlessEqual(batched.owner_for_display(), lazy.owner_for_display())
+        self.failUnlessEqual(batched.likes()["n_likes"], lazy.likes()["n_likes"])
+        self.failUnless(batched.likes()["i_like"])
+        self.failUnlessEqual(batched.likes()["featured"], list(lazy.likes()["featured"]))
+
+    def test_05_like_counters(self):
+        """
+        Like counters are maintained as we like / unlike.
+        """
+        from twistranet.sharing.models import Like, LikeCounter
+        __account__ = self.A
+        s = StatusUpdate(description = "Like me", permissions = "public")
+        s.save()
+        s.like()
+        s.like()
+        self.failUnlessEqual(LikeCounter.objects.get(what__id = s.id).n_likes, 1)
+        self.failUnless(Like.objects.i_like(s))
+        __account__ = self.B
+        self.failIf(Like.objects.i_like(s))
+        s.like()
+        likes = Like.objects.likes(s)
+        self.failUnlessEqual(likes["n_likes"], 2)
+        self.failUnless(likes["i_like"])
+        self.failUnlessEqual(set([ a.id for a in likes["featured"] ]), set([ self.A.id, self.B.id, ]))
+        s.unlike()
+        likes = Like.objects.likes(s)
+        self.failUnlessEqual(likes["n_likes"], 1)
+        self.failIf(likes["i_like"])
+        self.failUnlessEqual([ a.id for a in likes["featured"] ], [ self.A.id, ])
+        
     # XXX PJ test is failing > renamed twist
     def twist_03_wall_security(self):
         """
@@ -119,3 +183,46 @@ class WallTest(TNBaseTest):
         
         
         
+
+    def test_06_keyset_pagination(self):
+        """
+        Paging a wall with ?before= lists every content once, and knows where to stop
+        without counting. Old ?page= links still work.
+        """
+        from django.conf import settings
+        from django.test.client import Client
+        __account__ = self.A
+        for i in range(7):
+            StatusUpdate.objects.create(description = "Page me %d" % i, permissions = "public")
+        expected = list(Content.objects.getActivityFeed(self.A).order_by("-id").values_list("id", flat = True))
+        client = Client()
+        client.post("/login/", {'username': 'A', 'password': 'dummy'})
+        url = "/account/%d/" % self.A.id
+        page_size = settings.TWISTRANET_CONTENT_PER_PAGE
+        settings.TWISTRANET_CONTENT_PER_PAGE = 3
+        try:
+            seen = []
+            before = None
+            while True:
+                response = client.get(before and "%s?before=%d" % (url, before) or url)
+                self.failUnlessEqual(response.status_code, 200)
+                batch = [ c.id for c in response.context["latest_content_list"] ]
+                self.failUnless(len(batch) <= 3)
+                seen.extend(batch)
+                before = response.context["nextbefore"]
+                if before is None:
+                    break
+                self.failUnlessEqual(len(batch), 3)
+                self.failUnlessEqual(before, batch[-1])
+            self.failUnlessEqual(seen, expected)
+            
+            # Exactly one page: the look-ahead says there's nothing more
+            response = client.get("%s?before=%d" % (url, expected[-4]))
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], expected[-3:])
+            self.failUnlessEqual(response.context["nextbefore"], None)
+            
+            # Offset fallback
+            response = client.get("%s?page=2" % url)
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], expected[3:6])
+        finally:
+            settings.TWISTRANET_CONTENT_PER_PAGE = page_size
@@ -12,9 +12,11 @@ from django.template import RequestContext, loader
 from django.shortcuts import *
 from django.contrib import messages
 from django.utils.translation import ugettext as _
+from django.utils.safestring import mark_safe
 
 from twistranet.twistapp.models import Content, Account
 from twistranet.twistapp.forms import form_registry
+from twistranet.twistapp.templatetags.wiki import prefetch_mentions
 from twistranet.twistapp.lib.log import *
 from twistranet.content_types.forms import *
 from twistranet.actions import *
@@ -52,6 +54,9 @@ class ContentView(BaseIndividualView):
             self.template = self.content.detail_view
         if not self.template:
             raise ValueError("No correct template set for '%s' content type" % self.content.model_name)
+        # Fetch every object mentionned in the page at once (see the 'fullwiki' filter)
+        text = getattr(self.content, "text", None)
+        prefetch_mentions([self.content.description, text and mark_safe(text), ])
 
 class ContentEdit(ContentView):
     """
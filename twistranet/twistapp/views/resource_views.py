@@ -17,7 +17,7 @@ except:
     import simplejson as json
 
 from django.template import Context, RequestContext, loader
-from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified, HttpResponseForbidden
 from django.core.urlresolvers import reverse
 from django.template.loader import get_template
 from django.contrib.auth.decorators import login_required
@@ -25,8 +25,9 @@ from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, Suspici
 from django.utils.http import http_date                 
 from django.conf import settings
 from django.views.static import was_modified_since
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.context_processors import csrf
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import ugettext as _
 
 from twistranet.twistapp.models import *
@@ -35,13 +36,92 @@ from twistranet.twistapp.lib.decorators import require_access
 from twistranet.twistapp.lib.log import log
 from twistranet.twistorage.storage import Twistorage
 from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib.uploads import receive_upload, UploadError, StreamedUploadedFile
 from twistranet.core.views import *
 
-def serve(request, path, document_root = None, show_indexes = False, nocache = False):
+# Size of the chunks files are streamed with
+STREAM_CHUNK_SIZE = 64 * 1024
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def _file_iterator(fullpath, offset = 0, length = None, chunk_size = STREAM_CHUNK_SIZE):
+    """
+    Yield length bytes (or up to the end) of the file from offset, chunk_size at a time.
+    """
+    f = open(fullpath, 'rb')
+    try:
+        f.seek(offset)
+        while length is None or length > 0:
+            if length is None:
+                data = f.read(chunk_size)
+            else:
+                data = f.read(min(chunk_size, length))
+                length -= len(data)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+def _parse_range(header, size):
+    """
+    Return the (start, end) (inclusive) byte range asked by a 'Range: bytes=...' header, None if there's
+    no range we can handle (ie. we should send the whole file) or False if the range can't be satisfied.
+    Multiple ranges are not supported: we send the whole file instead.
+    """
+    if not header:
+        return None
+    match = RANGE_REGEX.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix: the last 'end' bytes
+        length = int(end)
+        if not length:
+            return False
+        return (max(size - length, 0), size - 1, )
+    start = int(start)
+    if start >= size:
+        return False
+    if not end:
+        return (start, size - 1, )
+    end = int(end)
+    if end < start:
+        return None
+    return (start, min(end, size - 1), )
+
+def _sendfile_response(fullpath):
+    """
+    Return an empty response asking the front web server to send the file, according to TWISTRANET_SENDFILE
+    ("x-sendfile" for Apache's mod_xsendfile or lighttpd, "x-accel-redirect" for nginx), or None.
+    With nginx, TWISTRANET_SENDFILE_PREFIX is prepended to the absolute file path
+    and must point to an 'internal' location.
+    """
+    backend = getattr(settings, "TWISTRANET_SENDFILE", None)
+    if not backend:
+        return None
+    response = HttpResponse()
+    if backend == "x-sendfile":
+        response["X-Sendfile"] = fullpath
+    elif backend == "x-accel-redirect":
+        prefix = getattr(settings, "TWISTRANET_SENDFILE_PREFIX", "/protected")
+        response["X-Accel-Redirect"] = urllib.quote("%s%s" % (prefix.rstrip('/'), fullpath))
+    else:
+        raise ValueError("Invalid TWISTRANET_SENDFILE value: %s" % backend)
+    return response
+
+def serve(request, path, document_root = None, show_indexes = False, nocache = False, last_modified = None, etag = None):
     """
     Adapted from django.views.static to handle the creation/modification date of the resource's publisher
     instead of only the file's value.
     
+    The file is streamed (memory use doesn't depend on its size) or delegated to the front
+    web server (see _sendfile_response). Single byte ranges are supported.
+    last_modified (a timestamp) and etag replace the file's own values for cache validation.
+    
     Serve static files below a given point in the directory structure.
 
     To use, put a URL pattern such as::
@@ -78,29 +158,53 @@ def serve(request, path, document_root = None, show_indexes = False, nocache = F
     if not os.path.exists(fullpath):
         raise Http404('"%s" does not exist' % fullpath)
     
-    # Respect the If-Modified-Since header.
+    # Respect the If-None-Match and If-Modified-Since headers.
     statobj = os.stat(fullpath)
+    size = statobj[stat.ST_SIZE]
+    if last_modified is None:
+        last_modified = statobj[stat.ST_MTIME]
     mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
-    # XXX TODO: Handle this correctly!!! Disabled to avoid using file mod. time instead of obj mod. time
     if not nocache:
-        if not was_modified_since(
-            request.META.get(
-                'HTTP_IF_MODIFIED_SINCE'),
-                    statobj[stat.ST_MTIME], statobj[stat.ST_SIZE]
-        ):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if etag and if_none_match:
+            if etag in [ e.strip() for e in if_none_match.split(",") ] or if_none_match.strip() == "*":
+                return HttpResponseNotModified(mimetype=mimetype)
+        elif not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), last_modified, size):
             return HttpResponseNotModified(mimetype=mimetype)
-            
-    # XXX This is subsubsuboptimal!
-    contents = open(fullpath, 'rb').read()
-    response = HttpResponse(contents, mimetype=mimetype)
-    response["Last-Modified"] = http_date(statobj[stat.ST_MTIME])
-    response["Content-Length"] = len(contents)
+
+    # Ranges are only honoured if the file didn't change since the client got its first part (If-Range)
+    byte_range = None
+    if request.method == "GET":
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or if_range in (etag, http_date(last_modified)):
+            byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        response = HttpResponse(status = 416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+
+    # Let the front web server send the file if we can (it handles ranges itself)
+    response = _sendfile_response(fullpath)
+    if response is not None:
+        response["Content-Type"] = mimetype
+    elif byte_range:
+        start, end = byte_range
+        response = HttpResponse(_file_iterator(fullpath, start, end - start + 1), mimetype = mimetype, status = 206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (start, end, size, )
+        response["Content-Length"] = end - start + 1
+    else:
+        response = HttpResponse(_file_iterator(fullpath), mimetype = mimetype)
+        response["Content-Length"] = size
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    if etag:
+        response["ETag"] = etag
     return response
 
 def _getResourceResponse(request, resource, last_modified = None, force_download = False):
     """
     Return the proper HTTP stream for a resource object
-    XXX TODO: Handle the last_modified parameter
+    Cache validation is based on the resource's modification date (or last_modified, a datetime, if given).
     If force_download is True, then we return attachment instead of inline.
     """
     # Determinate the appropriate rendering scheme: file or URL
@@ -120,7 +224,11 @@ def _getResourceResponse(request, resource, last_modified = None, force_download
         raise ValueError("Invalid resource: %s" % resource)
 
     # Return the underlying file, adapt the Last-Modified header as necessary
-    response = serve(request, path, document_root = storage.location, show_indexes = False, nocache = True)
+    last_modified = last_modified or resource.modified_at
+    if last_modified:
+        last_modified = int(time.mktime(last_modified.timetuple()))
+    etag = last_modified and '"%s-%s-%s"' % (resource.id, last_modified, storage.size(path), ) or None
+    response = serve(request, path, document_root = storage.location, show_indexes = False, last_modified = last_modified, etag = etag)
     response["Content-Type"] = resource.mimetype
     content_disposition = force_download and "attachment" or "inline"
     response["Content-Disposition"] = "%s; filename=\"%s\"" % (content_disposition, urllib.quote(resource.filename.encode("ascii", "ignore")))
@@ -430,21 +538,43 @@ def resource_quickupload(request):
     t = loader.get_template('resource/resource_quickupload.html')
     return HttpResponse(t.render(c))
 
+def _check_upload_csrf(request):
+    """
+    CSRF check of resource_quickupload_file.
+    The CSRF middleware would read request.POST, ie. load the whole XHR body in memory,
+    so XHR uploads are checked here against the X-CSRFToken header instead.
+    """
+    expected = request.META.get("CSRF_COOKIE", "")
+    if request.is_ajax():
+        given = request.META.get('HTTP_X_CSRFTOKEN', '')
+    else:
+        given = request.POST.get('csrfmiddlewaretoken', '')
+    return expected and constant_time_compare(given, expected)
+
+@csrf_exempt
 @require_access
 def resource_quickupload_file(request):
     """
     json view used by quikupload script
     when uploading a file
     return success/error + file infos (url/preview/title ...)
+    XHR uploads are streamed to disk and may be sent in several chunks, see lib.uploads.
     """               
     msg = {}
+    if request.method == "POST" and not _check_upload_csrf(request):
+        return HttpResponseForbidden()
     if request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest':
         file_name = urllib.unquote(request.META.get('HTTP_X_FILE_NAME'))
         title = request.GET.get('title', '')
         upload_with = "XHR"        
+        account = Twistable.objects.getCurrentAccount(request)
         try:
-            # the solution for sync ajax file upload
-            file_data = SimpleUploadedFile(file_name, request.raw_post_data)
+            upload_id, offset, file_data = receive_upload(request, account.id, file_name)
+        except UploadError, e:
+            log.debug("XHR Upload of %s rejected: %s" % (file_name, e.code, ))
+            file_data = None
+            msg = dict(e.info)
+            msg[u'error'] = e.code
         except:
             log.debug("XHR Upload of %s has been aborted" %file_name)
             file_data = None
@@ -452,6 +582,16 @@ def resource_quickupload_file(request):
             # is removed by "cancel" action, but
             # could be useful if someone change the js behavior
             msg = {u'error': u'emptyError'}
+        else:
+            if file_data is None:
+                # More chunks to come
+                msg = {
+                    'success':      True,
+                    'complete':     False,
+                    'upload_id':    upload_id,
+                    'offset':       offset,
+                }
+                return HttpResponse(json.dumps(msg), mimetype='text/html')
     else:
         # MSIE fallback behavior (classic upload with iframe)
         file_data = request.FILES.get("qqfile", None)
@@ -465,7 +605,11 @@ def resource_quickupload_file(request):
             msg = {u'error': u'sizeError'}
 
     if file_data and not msg:
-        publisher_id = request.GET.get('publisher_id', request.POST.get('publisher_id', ''))
+        if upload_with == "XHR":
+            # Don't touch request.POST: the body has been consumed already
+            publisher_id = request.GET.get('publisher_id', '')
+        else:
+            publisher_id = request.GET.get('publisher_id', request.POST.get('publisher_id', ''))
         try:                publisher_id = int(publisher_id)
         except ValueError:  publisher_id = None
         content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
@@ -501,7 +645,12 @@ def resource_quickupload_file(request):
         except:
             log.exception("Unexpected error while trying to upload a file.")
             msg = {u'error': u'unexpectedError'}
-    else:
+        # The streamed upload is moved to the storage on success only
+        if isinstance(file_data, StreamedUploadedFile):
+            file_data.close()
+            if os.path.exists(file_data.temporary_file_path()):
+                os.remove(file_data.temporary_file_path())
+    elif not msg:
         msg = {u'error': u'serverError'}
 
     return HttpResponse( json.dumps(msg),
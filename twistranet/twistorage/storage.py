@@ -1,6 +1,8 @@
 import os
 import sys
 import errno
+import hashlib
+import uuid
 import urlparse
 import itertools
 
@@ -18,6 +20,10 @@ from django.core.files.storage import FileSystemStorage
 
 from django.conf import settings
 
+# Where blobs are stored, below the storage location, in content-addressed mode
+BLOB_DIR = ".blobs"
+BLOB_CHUNK_SIZE = 64 * 1024
+
 class Twistorage(FileSystemStorage):
     """
     The Twistorage gives you a way to make upload/download of files
@@ -32,6 +38,11 @@ class Twistorage(FileSystemStorage):
     
     name is always 'publisher_id/filename'.
     base_url can't be specified: URLs will be handled by Django views. 
+    
+    In content-addressed mode (TWISTRANET_CONTENT_ADDRESSED_STORAGE), file contents are stored once,
+    as blobs named after their SHA-1 (.blobs/ab/cd/abcd...), and 'publisher_id/filename' is a hard link
+    to its blob. The link count of a blob is its reference count: it's removed with its last name.
+    Names (and therefore permission checks and downloads) don't change.
     """
     def __init__(self, location = None, ):
         if location is None:
@@ -42,6 +53,113 @@ class Twistorage(FileSystemStorage):
     def _open(self, name, mode='rb'):
         return File(open(self.path(name, 'r'), mode))
 
+    @property
+    def content_addressed(self):
+        return getattr(settings, "TWISTRANET_CONTENT_ADDRESSED_STORAGE", False) and hasattr(os, "link")
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.location, BLOB_DIR, content_hash[:2], content_hash[2:4], content_hash)
+
+    def _hash_file(self, full_path):
+        sha = hashlib.sha1()
+        f = open(full_path, 'rb')
+        try:
+            while True:
+                data = f.read(BLOB_CHUNK_SIZE)
+                if not data:
+                    break
+                sha.update(data)
+        finally:
+            f.close()
+        return sha.hexdigest()
+
+    def _reference(self, content_hash):
+        """
+        Make a temporary link to the blob, so that it can't be removed while we use it.
+        Return its path, or None if there's no such blob.
+        """
+        ref = os.path.join(self.location, BLOB_DIR, "ref-%s" % uuid.uuid4().hex)
+        try:
+            os.link(self.blob_path(content_hash), ref)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return ref
+
+    def _store_blob(self, content):
+        """
+        Store content as a blob if it's not there yet.
+        Return the path of a temporary link to the blob, which the caller must remove.
+        If content knows its hash (see lib.uploads.StreamedUploadedFile) and we've got it already,
+        nothing is written at all.
+        """
+        root = os.path.join(self.location, BLOB_DIR)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        content_hash = getattr(content, 'content_hash', None)
+        if content_hash:
+            ref = self._reference(content_hash)
+            if ref:
+                content.close()
+                return ref
+        tmp_path = os.path.join(root, "ref-%s" % uuid.uuid4().hex)
+        if content_hash and hasattr(content, 'temporary_file_path'):
+            file_move_safe(content.temporary_file_path(), tmp_path)
+            content.close()
+        else:
+            # Write it while computing its hash
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+            sha = hashlib.sha1()
+            try:
+                for chunk in content.chunks():
+                    sha.update(chunk)
+                    os.write(fd, chunk)
+            finally:
+                os.close(fd)
+            content_hash = sha.hexdigest()
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+
+        # Publish it, unless someone did it meanwhile
+        blob_path = self.blob_path(content_hash)
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        while True:
+            try:
+                os.link(tmp_path, blob_path)
+                return tmp_path
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            ref = self._reference(content_hash)
+            if ref:
+                os.remove(tmp_path)
+                return ref
+
+    def _save_content_addressed(self, name, content, full_path):
+        ref = self._store_blob(content)
+        try:
+            while True:
+                try:
+                    os.link(ref, full_path)
+                except OSError, e:
+                    if e.errno == errno.EEXIST:
+                        # The name exists. We need a new file name.
+                        name = self.get_available_name(name)
+                        full_path = self.path(name, 'w')
+                    else:
+                        raise
+                else:
+                    break
+        finally:
+            os.remove(ref)
+        return name
+
     def _save(self, name, content):
         full_path = self.path(name, 'w')
         directory = os.path.dirname(full_path)
@@ -50,6 +168,9 @@ class Twistorage(FileSystemStorage):
         elif not os.path.isdir(directory):
             raise IOError("%s exists and is not a directory." % directory)
 
+        if self.content_addressed:
+            return self._save_content_addressed(name, content, full_path)
+
         # There's a potential race condition between get_available_name and
         # saving the file; it's possible that two threads might return the
         # same name, at which point all sorts of fun happens. So we need to
@@ -94,7 +215,34 @@ class Twistorage(FileSystemStorage):
         name = self.path(name, 'w')
         # If the file exists, delete it from the filesystem.
         if os.path.exists(name):
+            # If that's the last name of a blob, remove the blob as well
+            blob_path = None
+            if os.stat(name).st_nlink == 2:
+                blob_path = self.blob_path(self._hash_file(name))
+                if not (os.path.exists(blob_path) and os.path.samefile(blob_path, name)):
+                    blob_path = None
             os.remove(name)
+            if blob_path and os.stat(blob_path).st_nlink == 1:
+                os.remove(blob_path)
+
+    def deduplicate(self, name):
+        """
+        Turn an existing file into a link to its blob (eg. for files stored before the content-addressed mode).
+        Return True if it's been done.
+        """
+        full_path = self.path(name, 'w')
+        if os.stat(full_path).st_nlink > 1:
+            return False
+        content = File(open(full_path, 'rb'))
+        content.content_hash = self._hash_file(full_path)
+        ref = self._store_blob(content)
+        try:
+            tmp_path = "%s.dedup" % full_path
+            os.link(ref, tmp_path)
+            os.rename(tmp_path, full_path)
+        finally:
+            os.remove(ref)
+        return True
 
     def exists(self, name):
         return os.path.exists(self.path(name, 'r'))